@@ -27,6 +27,11 @@ Also, just a place holder for the package.
 """
 import json
 
+import beem.stats
+
+# Where each message's ack time went, see beem.load.TrackingSender
+SEGMENTS = ("queue_time", "wire_time")
+
 
 def print_publish_stats(stats):
     """
@@ -41,8 +46,157 @@ def print_publish_stats(stats):
     print("Message timing stddev %.2f ms" % stats["time_stddev"])
     print("Message timing min    %.2f ms" % stats["time_min"])
     print("Message timing max    %.2f ms" % stats["time_max"])
+    pcts = stats.get("time_percentiles", {})
+    for p in sorted(pcts, key=float):
+        print("Message timing p%-6s%.2f ms" % (p, pcts[p]))
+    if stats.get("delivery_count") is not None:
+        print("Round trip deliveries %d (%d missing, %d duplicates)"
+              % (stats["delivery_count"], stats.get("delivery_missing", 0),
+                 stats.get("delivery_duplicates", 0)))
+    if stats.get("delivery_mean") is not None:
+        print("Delivery timing mean  %.2f ms" % stats["delivery_mean"])
+        print("Delivery timing max   %.2f ms" % stats["delivery_max"])
+        pcts = stats.get("delivery_percentiles", {})
+        for p in sorted(pcts, key=float):
+            print("Delivery timing p%-5s%.2f ms" % (p, pcts[p]))
+    if stats.get("queue_time_mean") is not None:
+        print("Client queueing       %.2f ms mean, %.2f ms max"
+              % (stats["queue_time_mean"], stats["queue_time_max"]))
+    if stats.get("wire_time_mean") is not None:
+        print("Network/broker        %.2f ms mean, %.2f ms max"
+              % (stats["wire_time_mean"], stats["wire_time_max"]))
+    if stats.get("out_packets_max") is not None:
+        print("Client max out queue  %d packets, %d messages"
+              % (stats["out_packets_max"], stats["out_messages_max"]))
+    if stats.get("self_cpu") is not None:
+        print("Publisher cpu         %.0f%%" % (100 * stats["self_cpu"]))
+    if stats.get("self_process_cpu") is not None:
+        print("Process cpu           %.0f%%" % (100 * stats["self_process_cpu"]))
+    if stats.get("self_generator_time") is not None:
+        print("Publisher time        %.2f generating, %.2f in publish(), "
+              "%.2f in callbacks (secs)"
+              % (stats["self_generator_time"], stats["self_publish_time"],
+                 stats["self_callback_time"]))
+    if stats.get("self_lateness_mean") is not None:
+        print("Scheduler lateness    %.2f ms mean, %.2f ms max"
+              % (stats["self_lateness_mean"], stats["self_lateness_max"]))
+    if stats.get("self_rss_max") is not None:
+        print("Publisher max rss     %.1f MB" % (stats["self_rss_max"] / 1e6))
+    if stats.get("self_saturated"):
+        print("WARNING: the publisher was cpu bound, so these results are "
+              "probably measuring it, not the broker")
     print("Messages per second   %.2f" % stats["msgs_per_sec"])
     print("Total time            %.2f secs" % stats["time_total"])
+    if stats.get("bridge_setup_time") is not None:
+        print("Bridge setup time     %.2f secs" % stats["bridge_setup_time"])
+    if stats.get("bridge_teardown_time") is not None:
+        print("Bridge teardown time  %.2f secs" % stats["bridge_teardown_time"])
+    if stats.get("bridge_queue_max") is not None:
+        print("Bridge max queued     %d msgs" % stats["bridge_queue_max"])
+    if stats.get("bridge_disconnects"):
+        print("Bridge disconnects    %d" % stats["bridge_disconnects"])
+    if stats.get("bridge_rtt_mean") is not None:
+        print("Bridge round trip     %.2f ms mean, %.2f ms max"
+              % (stats["bridge_rtt_mean"], stats["bridge_rtt_max"]))
+        pcts = stats.get("bridge_rtt_percentiles", {})
+        for p in sorted(pcts, key=float):
+            print("Bridge round trip p%-3s%.2f ms" % (p, pcts[p]))
+
+
+def histogram_stats(prefix, hist):
+    """
+    prefix_mean, prefix_max etc, and the histogram itself, for including
+    a latency distribution in publish stats.  Empty if hist is empty
+    """
+    if not hist.count:
+        return {}
+    summary = hist.summary()
+    return {
+        prefix + "_mean": summary["mean"],
+        prefix + "_stddev": summary["stddev"],
+        prefix + "_min": summary["min"],
+        prefix + "_max": summary["max"],
+        prefix + "_percentiles": summary["percentiles"],
+        prefix + "_histogram": hist.to_dict()
+    }
+
+
+def merge_histogram_stats(stats_set, prefix):
+    """Exact histogram_stats() over a set of stats, from their histograms"""
+    hist = beem.stats.Histogram()
+    for x in stats_set:
+        if prefix + "_histogram" in x:
+            hist.merge(beem.stats.Histogram.from_dict(x[prefix + "_histogram"]))
+    return histogram_stats(prefix, hist)
+
+
+def merge_series(stats_set, key="msgs_per_sec_series", width=1.0):
+    """
+    Sum the per second rate series of a set of stats, lined up on each
+    one's time_start.  Returns None unless every one has both.
+    """
+    if not all(key in x and "time_start" in x for x in stats_set):
+        return None
+    start = min(x["time_start"] for x in stats_set)
+    rval = []
+    for x in stats_set:
+        offset = int(round((x["time_start"] - start) / width))
+        series = x[key]
+        if offset + len(series) > len(rval):
+            rval.extend([0.0] * (offset + len(series) - len(rval)))
+        for i, v in enumerate(series):
+            rval[offset + i] += v
+    return rval
+
+
+def merge_delivery_stats(stats_set):
+    """
+    Exact round trip delivery stats over a set of publish stats,
+    from their delivery histograms
+    """
+    rval = dict((k, sum(x.get(k, 0) for x in stats_set)) for k in
+                ["delivery_count", "delivery_missing", "delivery_duplicates"])
+    rval.update(merge_histogram_stats(stats_set, "delivery"))
+    return rval
+
+
+def merge_segment_stats(stats_set):
+    """
+    Exact client queueing and network/broker time stats over a set of
+    publish stats, and the deepest client out queue seen
+    """
+    rval = {}
+    for prefix in SEGMENTS:
+        rval.update(merge_histogram_stats(stats_set, prefix))
+    for k in ["out_packets_max", "out_messages_max"]:
+        values = [x[k] for x in stats_set if k in x]
+        if values:
+            rval[k] = max(values)
+    return rval
+
+
+def merge_overhead_stats(stats_set):
+    """
+    Publisher self overhead over a set of publish stats.  Times are totals,
+    cpu and process cpu are means, (the latter over publishers, not
+    processes, as each thread reports its process's) and saturated if any
+    publisher was
+    """
+    stats_set = [x for x in stats_set if "self_generator_time" in x]
+    if not stats_set:
+        return {}
+    rval = dict((k, sum(x[k] for x in stats_set)) for k in
+                ["self_generator_time", "self_publish_time",
+                 "self_callback_time", "self_callback_count", "self_sleep_time"])
+    for k in ["self_cpu", "self_process_cpu"]:
+        values = [x[k] for x in stats_set if x.get(k) is not None]
+        rval[k] = sum(values) / len(values) if values else None
+    rss = [x["self_rss_max"] for x in stats_set if x.get("self_rss_max")]
+    if rss:
+        rval["self_rss_max"] = max(rss)
+    rval["self_saturated"] = any(x["self_saturated"] for x in stats_set)
+    rval.update(merge_histogram_stats(stats_set, "self_lateness"))
+    return rval
 
 
 def json_dump_stats(stats, path):
@@ -63,8 +217,8 @@ def aggregate_publish_stats(stats_set):
     timings are a simple mean of the input timings. ie the aggregate
     "minimum" is the average of the minimum of each process, not the
     absolute minimum of any process.
-    Likewise, aggregate "stddev" is a simple mean of the stddev from each
-    process, not an entire population stddev.
+    Likewise, aggregate "stddev" and percentiles are a simple mean of those
+    from each process, not of the entire population.
     """
     def naive_average(the_set):
         return sum(the_set) / len(the_set)
@@ -72,7 +226,12 @@ def aggregate_publish_stats(stats_set):
     count_total = sum([x["count_total"] for x in stats_set])
     cid = "Aggregate stats (simple avg) for %d processes" % len(stats_set)
     avg_msgs_per_sec = naive_average([x["msgs_per_sec"] for x in stats_set])
-    return {
+    pkeys = set.intersection(*[set(x.get("time_percentiles", {}))
+                               for x in stats_set])
+    percentiles = dict(
+        (k, naive_average([x["time_percentiles"][k] for x in stats_set]))
+        for k in pkeys)
+    rval = {
         "clientid": cid,
         "count_ok": count_ok,
         "count_total": count_total,
@@ -81,5 +240,34 @@ def aggregate_publish_stats(stats_set):
         "time_max": naive_average([x["time_max"] for x in stats_set]),
         "time_mean": naive_average([x["time_mean"] for x in stats_set]),
         "time_stddev": naive_average([x["time_stddev"] for x in stats_set]),
+        "time_percentiles": percentiles,
         "msgs_per_sec": avg_msgs_per_sec * len(stats_set)
     }
+    for k in ["bridge_setup_time", "bridge_teardown_time", "bridge_rtt_mean"]:
+        times = [x[k] for x in stats_set if x.get(k) is not None]
+        if times:
+            rval[k] = naive_average(times)
+    for k in ["bridge_queue_max", "bridge_rtt_max"]:
+        values = [x[k] for x in stats_set if x.get(k) is not None]
+        if values:
+            rval[k] = max(values)
+    if any("bridge_disconnects" in x for x in stats_set):
+        rval["bridge_disconnects"] = sum(x.get("bridge_disconnects", 0)
+                                         for x in stats_set)
+    # Carried along exactly, so "malaria merge" can combine runs properly
+    if all("time_histogram" in x for x in stats_set):
+        hist = beem.stats.Histogram()
+        for x in stats_set:
+            hist.merge(beem.stats.Histogram.from_dict(x["time_histogram"]))
+        rval["time_histogram"] = hist.to_dict()
+    if any("delivery_count" in x for x in stats_set):
+        rval.update(merge_delivery_stats(stats_set))
+    rval.update(merge_segment_stats(stats_set))
+    rval.update(merge_overhead_stats(stats_set))
+    if all("time_start" in x for x in stats_set):
+        rval["time_start"] = min(x["time_start"] for x in stats_set)
+        rval["time_end"] = max(x["time_end"] for x in stats_set)
+    series = merge_series(stats_set)
+    if series is not None:
+        rval["msgs_per_sec_series"] = series
+    return rval
@@ -0,0 +1,313 @@
+# Copyright (c) 2013, ReMake Electric ehf
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""
+Benchmarks of malaria's own hot paths, no broker required.
+
+These drive the same code the paho thread would, with prebuilt messages,
+so they measure what malaria itself can sustain, not the network.
+
+There's also a suite of microbenchmarks, (see SUITE) whose results can be
+saved as a JSON baseline, and later runs compared against it, to catch
+performance regressions.  Senders and listeners in the suite connect to
+an in process StubBroker, so it all runs offline.
+"""
+
+from __future__ import division
+
+import argparse
+import collections
+import platform
+import sys
+import threading
+import time
+
+import beem
+import beem.msgs
+import beem.stats
+from beem.census import WatcherStats
+from beem.listen import TrackingListener
+from beem.load import TrackingSender
+from beem.trackers import ObservedMessage, SentMessage
+
+# Just enough of paho's MQTTMessage for our message handlers
+BenchMessage = collections.namedtuple("BenchMessage", ["topic", "payload"])
+
+
+def make_messages(count, clients=100, size=100, timed=True):
+    """
+    A list of count messages, spread over clients publishing on the
+    usual mqtt-malaria topics, half of them timed if timed is set.
+    """
+    msgs = []
+    now = time.time()
+    filler = "x" * size
+    for i in range(count):
+        topic = "mqtt-malaria/bench-%d/data/%d/%d" % (i % clients, i, count)
+        if timed and i % 2:
+            payload = "{:f},{:s}".format(now, filler)
+        else:
+            payload = filler
+        msgs.append(BenchMessage(topic, payload.encode("utf-8")))
+    return msgs
+
+
+def _watcher_options():
+    return argparse.Namespace(
+        clientid="malaria-bench", topic=["#"], prefix_depth=3,
+        prefix_max=10000, sys_history=360, latency_depth=1,
+        latency_prefixes=100)
+
+
+def _fs_reader(fs, stop):
+    """Keep reading every file in the statsfs, like a busy poller"""
+    while not stop.is_set():
+        for d in ["/", "/rates", "/topics", "/latency"]:
+            for name in fs.readdir(d, None)[2:]:
+                path = d.rstrip("/") + "/" + name
+                attrs = fs.getattr(path)
+                if attrs["st_mode"] & 0o040000:
+                    continue
+                fh = fs.open(path, 0)
+                fs.read(path, attrs["st_size"], 0, fh)
+                fs.release(path, fh)
+
+
+def statsfs_missing():
+    """
+    Why the statistics filesystem can't be benchmarked here, (fusepy is
+    optional) or None if it can.
+    """
+    try:
+        import beem.statsfs
+    except (ImportError, EnvironmentError) as e:
+        return "needs fusepy (%s)" % e
+    return None
+
+
+def bench_watcher(msgs, readers=0):
+    """
+    Feed msgs through a WatcherStats message handler, with its ticker
+    running and readers threads hammering a statistics filesystem on it.
+    Returns a dict of results, including msgs_per_sec.
+    """
+    watcher = WatcherStats(_watcher_options())
+    fs = None
+    threads = []
+    stop = threading.Event()
+    if readers:
+        missing = statsfs_missing()
+        if missing:
+            raise Exception("Benchmarking FUSE readers %s" % missing)
+        from beem.statsfs import MalariaWatcherStatsFS
+        fs = MalariaWatcherStatsFS(watcher)
+        for _ in range(readers):
+            t = threading.Thread(target=_fs_reader, args=(fs, stop))
+            t.daemon = True
+            threads.append(t)
+    watcher.ticker.start()
+    [t.start() for t in threads]
+    handler = watcher.msg_handler
+    time_start = time.time()
+    for msg in msgs:
+        handler(None, None, msg)
+    elapsed = time.time() - time_start
+    stop.set()
+    [t.join() for t in threads]
+    watcher.ticker.stop()
+    rval = {
+        "readers": readers,
+        "msg_count": len(msgs),
+        "time_total": elapsed,
+        "msgs_per_sec": len(msgs) / elapsed,
+    }
+    if fs:
+        rval["fs_ops"] = fs.counters.totals()
+    return rval
+
+
+# Microbenchmarks.  Each takes a broker port and returns (op, n), where
+# calling op() does n operations of whatever is being measured.
+
+def _bench_gaussian(port):
+    n = 20000
+
+    def op():
+        for _ in beem.msgs.GaussianSize("bench", n, 100):
+            pass
+    return op, n
+
+
+def _bench_time_tracking(port):
+    n = 100000
+    prebuilt = [(i, "mqtt-malaria/bench/data/%d/%d" % (i, n), "x" * 100)
+                for i in range(n)]
+
+    def op():
+        for _ in beem.msgs.TimeTracking(prebuilt):
+            pass
+    return op, n
+
+
+def _bench_observed_message(port):
+    msgs = make_messages(100000, timed=False)
+    now = "{:f},".format(time.time()).encode("utf-8")
+    msgs = [BenchMessage(m.topic, now + m.payload) for m in msgs]
+
+    def op():
+        for m in msgs:
+            ObservedMessage(m)
+    return op, len(msgs)
+
+
+def _bench_sent_message(port):
+    n = 100000
+
+    def op():
+        for mid in range(n):
+            sm = SentMessage(mid, 100)
+            sm.receive()
+            sm.time_flight()
+    return op, n
+
+
+def _bench_sender_stats(port):
+    n = 200000
+    ts = TrackingSender("127.0.0.1", port, "bench-sender")
+    ts.overhead.start()
+    now = time.time()
+    ts.time_start = now - 100
+    ts.time_end = now
+    for mid in range(n):
+        sm = SentMessage(mid, 100, ts.time_start + mid / 2000)
+        sm.receive(sm.time_created + 0.001 + (mid % 100) / 10000)
+        ts.flight_times.append(sm.time_flight() * 1000)
+        ts.ack_times.append(sm.time_received)
+        ts.queue_times.append(0.1)
+        ts.wire_times.append(sm.time_flight() * 1000 - 0.1)
+    ts.publish_count = n
+    ts.overhead.stop()
+    ts.mqttc.disconnect()
+    ts.mqttc.loop_stop()
+    return ts.stats, 1
+
+
+def _bench_listener_stats(port):
+    n = 200000
+    options = argparse.Namespace(clientid="bench-listener", topic="#",
+                                 msg_count=n // 100, client_count=100,
+                                 capture=None)
+    tl = TrackingListener("127.0.0.1", port, options)
+    tl.mqttc.disconnect()
+    tl.mqttc.loop_stop()
+    msgs = [BenchMessage(m.topic, b"1.0," + m.payload)
+            for m in make_messages(n, timed=False)]
+    tl.msg_statuses = [ObservedMessage(m) for m in msgs]
+    for m in tl.msg_statuses:
+        tl.flight_times.append(m.time_flight())
+        tl.arrival_times.append(m.time_received)
+    tl.time_start = tl.msg_statuses[0].time_received
+    tl.time_end = tl.msg_statuses[-1].time_received
+    return tl.stats, 1
+
+
+def _bench_aggregate(port):
+    op, _ = _bench_sender_stats(port)
+    one = op()
+    stats_set = [dict(one, clientid="bench-%d" % i) for i in range(200)]
+    return lambda: beem.aggregate_publish_stats(stats_set), 1
+
+
+def _bench_watcher(port):
+    msgs = make_messages(100000)
+    return lambda: bench_watcher(msgs), len(msgs)
+
+
+SUITE = collections.OrderedDict([
+    ("msgs.GaussianSize", _bench_gaussian),
+    ("msgs.TimeTracking", _bench_time_tracking),
+    ("trackers.ObservedMessage", _bench_observed_message),
+    ("trackers.SentMessage", _bench_sent_message),
+    ("load.TrackingSender.stats", _bench_sender_stats),
+    ("listen.TrackingListener.stats", _bench_listener_stats),
+    ("aggregate_publish_stats", _bench_aggregate),
+    ("census.WatcherStats.msg_handler", _bench_watcher),
+])
+
+
+def run_suite(names=None, repeat=5):
+    """
+    Run the named benchmarks, (default all of SUITE) each repeat times,
+    returning a dict of results, keyed by name, ready to save as JSON.
+    The best time of the repeats is used, as the least disturbed.
+    """
+    # needs asyncio, (python 3) so the plain watcher benchmark doesn't
+    from beem.stubbroker import StubBroker
+    broker = StubBroker(fanout=False)
+    broker.start()
+    results = collections.OrderedDict()
+    try:
+        for name in names or SUITE:
+            op, n = SUITE[name](broker.port)
+            times = []
+            for _ in range(repeat):
+                time_start = time.time()
+                op()
+                times.append((time.time() - time_start) / n)
+            times.sort()
+            results[name] = {
+                "ops": n,
+                "best": times[0],
+                "median": times[len(times) // 2],
+                "ops_per_sec": 1 / times[0],
+            }
+    finally:
+        broker.stop()
+    return {
+        "meta": {
+            "time": time.time(),
+            "python": sys.version.split()[0],
+            "implementation": platform.python_implementation(),
+            "machine": platform.machine(),
+            "node": platform.node(),
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+
+
+def compare_suite(baseline, current, threshold=10):
+    """
+    Compare two run_suite() results.  Returns a list of
+    (name, baseline secs per op, current secs per op, % change, regressed)
+    for every benchmark in both, where regressed means more than
+    threshold percent slower.
+    """
+    rval = []
+    for name, cur in current["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+        change = (cur["best"] - base["best"]) / base["best"] * 100
+        rval.append((name, base["best"], cur["best"], change, change > threshold))
+    return rval
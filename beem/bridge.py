@@ -25,30 +25,60 @@
 This is a module for a single message publishing process,
 that publishes to it's own private bridge. The _bridge_ is configured
 to bridge out to the designated target.
+
+Threaded publishers can instead share a single bridge, with a separate
+bridge connection for each thread.
 """
 
 from __future__ import division
 
+import errno
+import fcntl
 import logging
 import os
+import random
 import socket
 import subprocess
 import tempfile
 import threading
 import time
 
+import paho.mqtt.client as mqtt
+
+import beem.latency
 import beem.load
 import beem.msgs
-
-MOSQ_BRIDGE_CFG_TEMPLATE = """
+import beem.stats
+from beem.sysseries import SYS_PREFIX, SysSeries
+
+# How long to wait for a bridge to start listening, and to drain its queue
+READY_TIMEOUT = 10
+DRAIN_TIMEOUT = 30
+# Local ports bridges listen on, shared by every malaria process on a node
+BRIDGE_PORTS = (20000, 29999)
+# How many times to try a new port if mosquitto fails to start
+START_ATTEMPTS = 5
+
+MOSQ_LISTENER_CFG_TEMPLATE = """
 log_dest topic
 #log_dest stdout
 bind_address 127.0.0.1
 port %(listen_port)d
+sys_interval 1
+"""
 
+MOSQ_BRIDGE_CFG_TEMPLATE = """
 connection mal-bridge-%(cid)s
 address %(malaria_target)s
-topic mqtt-malaria/# out %(qos)d
+topic mqtt-malaria/# out %(qos)d%(topic_remap)s
+"""
+
+# Bounce timed pings off the target, to measure the round trip through the
+# bridge.  The target has to treat us as a normal client to echo them back.
+MOSQ_BRIDGE_CFG_TEMPLATE_RTT = """
+try_private false
+topic ping out 1 %(rtt_local)s %(rtt_remote)s
+topic ping in 1 %(rtt_echo)s %(rtt_remote)s
 """
 
 MOSQ_BRIDGE_CFG_TEMPLATE_PSK = """
@@ -58,67 +88,152 @@ bridge_tls_version tlsv1
 """
 
 
+class PortReservation():
+    """A reserved port, held until release() or the process exits"""
+    def __init__(self, port, lock_file):
+        self.port = port
+        self._lock_file = lock_file
+
+    def release(self):
+        if self._lock_file:
+            self._lock_file.close()
+            self._lock_file = None
+
+
+class PortAllocator():
+    """
+    Hands out local ports from a fixed range, for bridges to listen on.
+
+    Each port is reserved by holding an exclusive flock on a lock file for
+    it, (in lock_dir, shared by all processes) so any number of threads and
+    processes on a node can allocate ports at once without ever being given
+    the same one.  Locks go away with the process, so a crashed worker
+    never leaks ports.  Ports that something else is already listening on
+    are skipped.
+    """
+    def __init__(self, low=BRIDGE_PORTS[0], high=BRIDGE_PORTS[1], lock_dir=None):
+        self.low = low
+        self.high = high
+        if lock_dir is None:
+            lock_dir = os.path.join(tempfile.gettempdir(), "malaria-ports")
+        self.lock_dir = lock_dir
+        try:
+            os.makedirs(lock_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _bindable(self, port):
+        s = socket.socket()
+        try:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.bind(("127.0.0.1", port))
+            return True
+        except socket.error:
+            return False
+        finally:
+            s.close()
+
+    def reserve(self):
+        """
+        Reserve a free port, starting from a random point in the range,
+        so concurrent callers rarely contend for the same lock.
+        """
+        span = self.high - self.low + 1
+        start = random.randrange(span)
+        for i in range(span):
+            port = self.low + (start + i) % span
+            f = open(os.path.join(self.lock_dir, "%d.lock" % port), "a")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                f.close()
+                continue
+            if self._bindable(port):
+                return PortReservation(port, f)
+            f.close()
+        raise Exception("No free local ports left in %d-%d" % (self.low, self.high))
+
+
 class BridgingSender():
     """
     A MQTT message publisher that publishes to it's own personal bridge
     """
-    def __init__(self, target_host, target_port, cid, auth=None):
+    def __init__(self, target_host, target_port, cid, auth=None, ports=None,
+                 rtt=False):
         self.cid = cid
         self.auth = auth
         self.log = logging.getLogger(__name__ + ":" + cid)
 
-        self.mb = MosquittoBridgeBroker(target_host, target_port, cid, auth)
+        self.mb = MosquittoBridgeBroker(target_host, target_port, cid, auth,
+                                        ports, rtt)
 
     def run(self, generator, qos=1):
         with self.mb as mb:
-            launched = False
-            while not launched:
-                try:
-                    self.ts = beem.load.TrackingSender("localhost", mb.port, "ts_" + mb.label)
-                    launched = True
-                except:
-                    # TrackingSender fails if it can't connect
-                    time.sleep(0.5)
+            self.ts = beem.load.TrackingSender("localhost", mb.port, "ts_" + mb.label)
             self.ts.run(generator, qos)
 
     def stats(self):
-        return self.ts.stats()
+        stats = self.ts.stats()
+        stats.update(self.mb.lifecycle_stats())
+        return stats
+
+
+def _topic_prefixed(generator, prefix):
+    """
+    Wrap an existing generator, prepending prefix to every topic, so a
+    shared bridge knows which connection to send the message out on.
+    """
+    for a, b, c in generator:
+        yield (a, prefix + b, c)
 
 
 class _ThreadedBridgeWorker(threading.Thread):
-    def __init__(self, mb, options):
+    """
+    Publishes through one connection of a bridge.  Unless the bridge is
+    shared, the worker starts and stops the bridge itself.
+    """
+    def __init__(self, mb, options, index=0):
         threading.Thread.__init__(self)
         self.mb = mb
         self.options = options
+        self.index = index
 
     def run(self):
-        with self.mb as mb:
-            launched = False
-            while not launched:
-                try:
-                    ts = beem.load.TrackingSender("localhost", mb.port, "ts_" + mb.label)
-                    launched = True
-                except:
-                    # TrackingSender fails if it can't connect
-                    time.sleep(0.5)
-
-            # This is probably what you want for psk setups with ACLs
-            if self.mb.auth:
-                cid = self.mb.auth.split(":")[0]
-                gen = beem.msgs.createGenerator(cid, self.options)
-            else:
-                gen = beem.msgs.createGenerator(self.mb.label, self.options)
-            ts.run(gen)
-            self.stats = ts.stats()
+        if isinstance(self.mb, SharedBridgeBroker):
+            self._publish()
+        else:
+            with self.mb:
+                self._publish()
+            self.stats.update(self.mb.lifecycle_stats())
+
+    def _publish(self):
+        label, auth, prefix = self.mb.connections()[self.index]
+        ts = beem.load.TrackingSender("localhost", self.mb.port, "ts_" + label)
+
+        # This is probably what you want for psk setups with ACLs
+        if auth:
+            cid = auth.split(":")[0]
+            gen = beem.msgs.createGenerator(cid, self.options)
+        else:
+            gen = beem.msgs.createGenerator(label, self.options)
+        if prefix:
+            gen = _topic_prefixed(gen, prefix)
+        ts.run(gen)
+        self.stats = ts.stats()
 
 
 class ThreadedBridgingSender():
     """
-    A MQTT message publisher that publishes to it's own personal bridge,
-    unlike BridgingSender, this fires up X brokers, and X threads to publish.
-    This _can_ be much softer on memory usage, and as long as the per thread
-    message rate stays low enough, and the ratio not too unreasonable, there
-    should be no performance problems
+    A MQTT message publisher that publishes through a bridge, unlike
+    BridgingSender, this fires up X threads to publish, all through a single
+    shared broker with X bridge connections.  This _can_ be much softer on
+    memory usage, and as long as the per thread message rate stays low
+    enough, and the ratio not too unreasonable, there should be no
+    performance problems.
+
+    With options.bridge_per_client, each thread gets its own broker instead,
+    for complete isolation between clients, at the cost of X brokers.
     """
 
     def __init__(self, options, proc_num, auth=None):
@@ -137,22 +252,41 @@ class ThreadedBridgingSender():
             assert len(auth) == self.ratio
         self.log = logging.getLogger(__name__ + ":" + self.cid_base)
 
+        ports = PortAllocator(*getattr(options, "bridge_ports", BRIDGE_PORTS))
+        rtt = getattr(options, "bridge_rtt", False)
+        if not getattr(options, "bridge_per_client", False):
+            self.shared = SharedBridgeBroker(
+                options.host, options.port, "%s_%d" % (self.cid_base, proc_num),
+                self.ratio, [a.strip() for a in auth] if auth else None, ports,
+                rtt)
+            return
+
+        self.shared = None
         # Create all the config files immediately
         for x in range(self.ratio):
             label = "%s_%d_%d" % (self.cid_base, proc_num, x)
             mb = MosquittoBridgeBroker(options.host,
                                              options.port,
-                                             label)
+                                             label, ports=ports, rtt=rtt)
             if auth:
                 mb.auth = auth[x].strip()
             self.mosqs.append(mb)
 
     def run(self):
-        worker_threads = []
-        for mb in self.mosqs:
-            t = _ThreadedBridgeWorker(mb, self.options)
+        if self.shared:
+            with self.shared:
+                self._run([_ThreadedBridgeWorker(self.shared, self.options, x)
+                           for x in range(self.ratio)])
+            # one bridge for the whole process, so only counted once, or
+            # aggregating would count every disconnect ratio times
+            self.stats[0].update(self.shared.lifecycle_stats())
+        else:
+            self._run([_ThreadedBridgeWorker(mb, self.options)
+                       for mb in self.mosqs])
+
+    def _run(self, worker_threads):
+        for t in worker_threads:
             t.start()
-            worker_threads.append(t)
 
         # Wait for all threads to complete
         self.stats = []
@@ -174,72 +308,369 @@ class MosquittoBridgeBroker():
         with mm as b:
             post_messages_to_broker(b.port)
 
+    Entering returns as soon as mosquitto is accepting connections, and
+    exiting waits only until the bridge's queue has drained, (according to
+    its $SYS tree) up to drain_timeout seconds.  The time both took is
+    available from lifecycle_stats() afterwards.
     """
+    drain_timeout = DRAIN_TIMEOUT
 
-    def _get_free_listen_port(self):
+
+    def connections(self):
         """
-        Find a free local TCP port that we can listen on,
-        we want this to be able to give to mosquitto.
+        (label, auth, local topic prefix) for each bridge connection
         """
-        # python 2.x doesn't have __enter__ and __exit__ on socket objects
-        # so can't use with: clauses
-        # Yes, there is a race condition between closing the socket and
-        # starting mosquitto.
-        s = socket.socket()
-        s.bind(("localhost", 0))
-        chosen_port = s.getsockname()[1]
-        s.close()
-        return chosen_port
+        return [(self.label, self.auth, "")]
 
     def _make_config(self):
         """
         Make an appropriate mosquitto config snippet out of
         our params and saved state
         """
-        self.port = self._get_free_listen_port()
-        template = MOSQ_BRIDGE_CFG_TEMPLATE
-        inputs = {
-            "listen_port": self.port,
-            "malaria_target": "%s:%d" % (self.target_host, self.target_port),
-            "cid": self.label,
-            "qos": 1
-        }
-        if self.auth:
-            template = template + MOSQ_BRIDGE_CFG_TEMPLATE_PSK
-            aa = self.auth.split(":")
-            inputs["psk_id"] = aa[0]
-            inputs["psk_key"] = aa[1]
+        conf = MOSQ_LISTENER_CFG_TEMPLATE % {"listen_port": self.port}
+        for label, auth, prefix in self.connections():
+            template = MOSQ_BRIDGE_CFG_TEMPLATE
+            inputs = {
+                "malaria_target": "%s:%d" % (self.target_host, self.target_port),
+                "cid": label,
+                "qos": 1,
+                "topic_remap": ""
+            }
+            if prefix:
+                # strip our local prefix again on the way out
+                inputs["topic_remap"] = ' %s ""' % prefix
+            if self.rtt:
+                template = template + MOSQ_BRIDGE_CFG_TEMPLATE_RTT
+                inputs.update(self._rtt_prefixes(label, auth))
+            if auth:
+                template = template + MOSQ_BRIDGE_CFG_TEMPLATE_PSK
+                aa = auth.split(":")
+                inputs["psk_id"] = aa[0]
+                inputs["psk_key"] = aa[1]
+            conf += template % inputs
 
-        return template % inputs
+        return conf
 
-    def __init__(self, target_host, target_port, label=None, auth=None):
+    def _rtt_prefixes(self, label, auth):
+        """
+        Local topic prefixes for pings out and echos back, and the prefix
+        they have on the target, which is under the client's own topics so
+        the usual ACLs apply.
+        """
+        cid = auth.split(":")[0] if auth else label
+        return {
+            "rtt_local": "malaria-rtt/%s/" % label,
+            "rtt_echo": "malaria-rtt-echo/%s/" % label,
+            "rtt_remote": "mqtt-malaria/%s/rtt/" % cid
+        }
+
+    def rtt_topics(self):
+        """(ping topic, echo topic) for every connection, if rtt is on"""
+        if not self.rtt:
+            return []
+        rval = []
+        for label, auth, prefix in self.connections():
+            p = self._rtt_prefixes(label, auth)
+            rval.append((p["rtt_local"] + "ping", p["rtt_echo"] + "ping"))
+        return rval
+
+    def __init__(self, target_host, target_port, label=None, auth=None,
+                 ports=None, rtt=False):
         self.target_host = target_host
         self.target_port = target_port
         self.label = label
         self.auth = auth
+        self.rtt = rtt
+        self.ports = ports or PortAllocator()
+        self.port = None
+        self._reservation = None
         self.log = logging.getLogger(__name__ + "_" + label)
+        self.monitor = None
+        self.monitor_stats = {}
+        self.setup_time = None
+        self.teardown_time = None
 
-    def __enter__(self):
+    def _wait_ready(self, timeout=READY_TIMEOUT):
+        """
+        Wait until mosquitto accepts connections on our port.
+        Returns False if it exits instead, (normally because it couldn't
+        listen on the port after all) raises if it just never listens.
+        """
+        give_up = time.time() + timeout
+        delay = 0.005
+        while True:
+            rc = self._mosq.poll()
+            if rc is not None:
+                self.log.warn("mosquitto exited (rc=%d) before listening on %d",
+                              rc, self.port)
+                return False
+            try:
+                s = socket.create_connection(("127.0.0.1", self.port), 1)
+                s.close()
+                return True
+            except socket.error:
+                if time.time() > give_up:
+                    raise Exception("mosquitto not listening on port %d after %ds"
+                                    % (self.port, timeout))
+                time.sleep(delay)
+                delay = min(delay * 2, 0.1)
+
+    def lifecycle_stats(self):
+        """
+        How long the bridge took to start and to drain and stop, and what
+        its monitor saw while it was running
+        """
+        rval = {
+            "bridge_setup_time": self.setup_time,
+            "bridge_teardown_time": self.teardown_time
+        }
+        rval.update(self.monitor_stats)
+        return rval
+
+    def _start(self):
+        """
+        Start mosquitto on a newly reserved port, returning True once it's
+        listening, or False (with everything cleaned up) if it exited.
+        """
+        self._reservation = self.ports.reserve()
+        self.port = self._reservation.port
         conf = self._make_config()
         # Save it to a temporary file
         self._f = tempfile.NamedTemporaryFile(delete=False)
-        self._f.write(conf)
+        self._f.write(conf.encode("utf-8"))
         self._f.close()
         self.log.debug("Creating config file %s: <%s>", self._f.name, conf)
 
-        # too important, even though _f.close() has finished :(
-        time.sleep(1)
         args = ["mosquitto", "-c", self._f.name]
         self._mosq = subprocess.Popen(args)
+        try:
+            if self._wait_ready():
+                return True
+        except:
+            self._stop()
+            raise
+        self._stop()
+        return False
+
+    def __enter__(self):
+        time_start = time.time()
+        attempt = 1
+        while not self._start():
+            if attempt >= START_ATTEMPTS:
+                raise Exception("mosquitto failed to start %d times" % attempt)
+            attempt += 1
+        try:
+            self.monitor = BridgeMonitor(self.port, self.label,
+                                         self.rtt_topics())
+            if not self.monitor.wait_baseline(READY_TIMEOUT):
+                self.log.warn("No $SYS from the bridge, can't tell when it has drained")
+        except:
+            self._stop()
+            raise
+        self.setup_time = time.time() - time_start
+        self.log.debug("Bridge ready in %.3f secs", self.setup_time)
         return self
 
+    def _stop(self):
+        try:
+            if self.monitor:
+                self.monitor.stop()
+                self.monitor_stats = self.monitor.stats()
+                self.monitor = None
+        finally:
+            os.unlink(self._f.name)
+            if self._mosq.poll() is None:
+                self._mosq.terminate()
+            self._mosq.wait()
+            self._reservation.release()
+
     def __exit__(self, exc_type, exc_value, traceback):
+        time_start = time.time()
+        # Let messages still get out of the broker...
+        if self.monitor.baseline is None:
+            # no way of knowing, so just give it a moment, as we always have
+            time.sleep(2)
+        elif not self.monitor.wait_drained(self.drain_timeout):
+            self.log.warn("Bridge still had %s messages queued after %ds",
+                          self.monitor.queued(), self.drain_timeout)
         self.log.debug("Swatting mosquitto on exit")
-        os.unlink(self._f.name)
-        # Attempt to let messages still get out of the broker...
-        time.sleep(2)
-        self._mosq.terminate()
-        self._mosq.wait()
+        self._stop()
+        self.teardown_time = time.time() - time_start
+
+
+class BridgeMonitor():
+    """
+    Follows the $SYS tree of a local bridging mosquitto, to see how many
+    messages it still has queued to send to the target.
+
+    Queued is the number of messages in its store that aren't retained
+    messages, (such as its own $SYS topics) plus any in flight.  This is
+    compared with the queue when the monitor started, so messages the
+    broker always keeps don't count.
+
+    Every $SYS round, (once a second) the queue, messages in flight, bytes
+    sent and number of bridge connections up are sampled, and, if given
+    rtt_topics, a list of (ping topic, echo topic) pairs, a timed ping is
+    published on each ping topic, for the bridge to send to the target and
+    back again to the echo topic.
+    """
+    def __init__(self, port, label, rtt_topics=None):
+        self.log = logging.getLogger(__name__ + "_" + label)
+        self.sys = SysSeries(size=60)
+        self.baseline = None
+        self.time_start = time.time()
+        self.samples = []
+        self.connections = {}
+        self.disconnects = 0
+        self.rtt_topics = rtt_topics or []
+        self.rtt_times = beem.stats.Samples()
+        self._updated = threading.Event()
+        self.mqttc = mqtt.Client("mon_" + label)
+        self.mqttc.on_message = self._msg_handler
+        rc = self.mqttc.connect("127.0.0.1", port, 60)
+        if rc:
+            raise Exception("Couldn't connect to bridge! rc=%d" % rc)
+        self.mqttc.subscribe(SYS_PREFIX + "#", 0)
+        for ping, echo in self.rtt_topics:
+            self.mqttc.subscribe(echo, 1)
+        self.mqttc.loop_start()
+
+    def _msg_handler(self, mosq, userdata, msg):
+        now = time.time()
+        if msg.topic.startswith(SYS_PREFIX + "connection/"):
+            self._update_connection(msg.topic, msg.payload)
+            return
+        if not msg.topic.startswith(SYS_PREFIX):
+            sent = beem.latency.payload_time(msg.payload, now)
+            if sent is not None:
+                self.rtt_times.append((now - sent) * 1000)
+            return
+        name, value = self.sys.ingest(msg.topic, msg.payload, now)
+        if name == "uptime":
+            # uptime comes once per $SYS round, so whenever it arrives,
+            # everything else we hold is from one whole round
+            if self.baseline is None:
+                self.baseline = self._queued()
+            self._sample(now)
+            self._updated.set()
+
+    def _update_connection(self, topic, payload):
+        """Bridge notifications, "1" when a connection is up, "0" if not"""
+        if not topic.endswith("/state"):
+            return
+        up = payload.strip() in (b"1", "1")
+        if self.connections.get(topic, False) and not up:
+            self.disconnects += 1
+            self.log.warn("Bridge connection lost: %s", topic)
+        self.connections[topic] = up
+
+    def _sample(self, now):
+        self.samples.append((
+            round(now - self.time_start, 3),
+            self.queued(),
+            self.sys.latest("messages_inflight"),
+            self.sys.latest("bytes_sent"),
+            sum(self.connections.values())))
+        for ping, echo in self.rtt_topics:
+            self.mqttc.publish(ping, "{:f},ping".format(time.time()), 1)
+
+    def _queued(self):
+        stored = self.sys.latest("messages_stored")
+        if stored is None:
+            return None
+        return (stored - self.sys.latest("retained_messages", 0)
+                + self.sys.latest("messages_inflight", 0))
+
+    def wait_baseline(self, timeout):
+        """
+        Wait for the queue to be known, (retained $SYS messages normally
+        arrive as soon as we subscribe) returning False on timeout.
+        """
+        give_up = time.time() + timeout
+        while self.baseline is None and time.time() < give_up:
+            self._updated.clear()
+            self._updated.wait(0.1)
+        return self.baseline is not None
+
+    def queued(self):
+        """Messages queued beyond our baseline, or None if not known yet"""
+        q = self._queued()
+        if q is None or self.baseline is None:
+            return None
+        return max(q - self.baseline, 0)
+
+    def wait_drained(self, timeout):
+        """
+        Wait until a fresh $SYS update shows nothing queued.
+        Returns False if that didn't happen within timeout seconds.
+        """
+        give_up = time.time() + timeout
+        while time.time() < give_up:
+            self._updated.clear()
+            if not self._updated.wait(min(2, give_up - time.time())):
+                continue
+            if self.queued() == 0:
+                return True
+        return False
+
+    def stats(self):
+        """
+        What the bridge did, for including in a sender's stats.
+        bridge_samples is a list of
+        [secs since start, queued, in flight, bytes sent, connections up]
+        """
+        queued = [x[1] for x in self.samples if x[1] is not None]
+        rval = {
+            "bridge_queue_max": max(queued) if queued else None,
+            "bridge_bytes_sent": self.sys.latest("bytes_sent"),
+            "bridge_disconnects": self.disconnects,
+            "bridge_samples": [list(x) for x in self.samples]
+        }
+        if self.rtt_topics:
+            rval["bridge_rtt_count"] = len(self.rtt_times)
+            # nothing echoed back, (denied, bridge down, or a short run)
+            if len(self.rtt_times):
+                rtt = beem.stats.summarize(self.rtt_times)
+                rval["bridge_rtt_mean"] = rtt["mean"]
+                rval["bridge_rtt_max"] = rtt["max"]
+                rval["bridge_rtt_percentiles"] = rtt["percentiles"]
+        return rval
+
+    def stop(self):
+        self.mqttc.disconnect()
+        self.mqttc.loop_stop()
+
+
+class SharedBridgeBroker(MosquittoBridgeBroker):
+    """
+    A single external mosquitto process with count bridge connections to
+    the target host/port, each optionally with its own tls-psk identity.
+
+    Connection x only bridges messages published locally under its own
+    topic prefix, (see connections()) and strips that prefix again on the
+    way out, so each publisher still appears to the target as a separate
+    client, while only needing one broker process and one listener.
+
+        sb = SharedBridgeBroker(host, port, "my label", 2,
+                                ["id1:key1", "id2:key2"])
+        with sb as b:
+            label, auth, prefix = b.connections()[1]
+            post_messages_to_broker(b.port, prefix)
+    """
+    def __init__(self, target_host, target_port, label, count, auths=None,
+                 ports=None, rtt=False):
+        MosquittoBridgeBroker.__init__(self, target_host, target_port, label,
+                                       ports=ports, rtt=rtt)
+        if auths:
+            assert len(auths) == count
+        self.count = count
+        self.auths = auths
+
+    def connections(self):
+        return [("%s_%d" % (self.label, x),
+                 self.auths[x] if self.auths else None,
+                 "bridge/%d/" % x)
+                for x in range(self.count)]
 
 
 if __name__ == "__main__":
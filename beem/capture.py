@@ -0,0 +1,215 @@
+# Copyright (c) 2013, ReMake Electric ehf
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""
+Append-only binary capture of received messages, for offline analysis.
+
+Every message heard by a listener can be written out as a single fixed width
+record, so that a run can be re-analysed later with different windows or
+percentiles, without having to repeat it.  Records are little endian, and
+laid out so that the whole file can be memory mapped as a numpy record array.
+
+The capture file itself only holds numeric client indexes, the matching
+client ids are appended, one per line, to a "<capture>.clients" side file.
+"""
+
+from __future__ import division
+
+import os
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = b"MALCAP01"
+HEADER = struct.Struct("<8sI")
+# client index, sequence number, send ns, receive ns, payload size
+RECORD = struct.Struct("<IIqqI")
+RECORD_DTYPE = [
+    ("client", "<u4"),
+    ("seq", "<u4"),
+    ("sent_ns", "<i8"),
+    ("received_ns", "<i8"),
+    ("size", "<u4")
+]
+DEFAULT_PERCENTILES = [50, 90, 99, 99.9]
+
+
+def clients_path(path):
+    """The side file holding the client ids for a capture file"""
+    return path + ".clients"
+
+
+class CaptureWriter():
+    """
+    Appends fixed width message records to a capture file.
+
+    Writes are buffered, so this is cheap enough to call from a paho
+    message handler.  Appending to an existing capture continues it,
+    keeping the existing client index.
+
+        with CaptureWriter("run1.cap") as cap:
+            cap.append("client_1", 1, time_sent, time_received, 100)
+    """
+    def __init__(self, path, buffer_size=1024 * 1024):
+        self.path = path
+        self.clients = {}
+        if os.path.exists(clients_path(path)):
+            with open(clients_path(path), "r") as f:
+                for line in f:
+                    self.clients[line.rstrip("\n")] = len(self.clients)
+        fresh = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._f = open(path, "ab", buffer_size)
+        if fresh:
+            self._f.write(HEADER.pack(MAGIC, RECORD.size))
+        self._cf = open(clients_path(path), "a")
+
+    def _client_index(self, cid):
+        idx = self.clients.get(cid, None)
+        if idx is None:
+            idx = len(self.clients)
+            self.clients[cid] = idx
+            self._cf.write("%s\n" % cid)
+            self._cf.flush()
+        return idx
+
+    def append(self, cid, seq, time_sent, time_received, size):
+        """
+        Record a single message, times are in (float) seconds
+        """
+        self._f.write(RECORD.pack(self._client_index(cid), seq,
+                                  int(time_sent * 1e9),
+                                  int(time_received * 1e9),
+                                  size))
+
+    def close(self):
+        self._f.close()
+        self._cf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def load(path):
+    """
+    Memory map a capture file.
+    Returns a tuple of (list of client ids, numpy record array)
+    """
+    if numpy is None:
+        raise RuntimeError("numpy is required to analyse capture files")
+    with open(path, "rb") as f:
+        magic, record_size = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC or record_size != RECORD.size:
+        raise ValueError("Not a malaria capture file (or wrong version)", path)
+    clients = []
+    if os.path.exists(clients_path(path)):
+        with open(clients_path(path), "r") as f:
+            clients = [line.rstrip("\n") for line in f]
+    count = (os.path.getsize(path) - HEADER.size) // RECORD.size
+    if count == 0:
+        return clients, numpy.zeros(0, dtype=RECORD_DTYPE)
+    # A partially written trailing record (crashed run) is simply ignored
+    records = numpy.memmap(path, dtype=RECORD_DTYPE, mode="r",
+                           offset=HEADER.size, shape=(count,))
+    return clients, records
+
+
+def analyze(path, percentiles=DEFAULT_PERCENTILES, window=1.0,
+            msg_count=None):
+    """
+    Calculate summary stats for a capture file.
+
+    flight time percentiles are in milliseconds, throughput is bucketed into
+    "window" second intervals of receive time.  Per client loss is against
+    msg_count if provided, otherwise against the highest sequence number
+    seen for that client.
+    """
+    clients, records = load(path)
+    count = len(records)
+    if count == 0:
+        raise ValueError("Capture file contains no records", path)
+
+    received = records["received_ns"]
+    flight = (received - records["sent_ns"]) / 1e6
+    pvals = numpy.percentile(flight, percentiles)
+
+    t_first = received.min()
+    t_last = received.max()
+    buckets = (received - t_first) // int(window * 1e9)
+    throughput = numpy.bincount(buckets) / window
+
+    # (client, seq) packed into one key, so a single sort both finds
+    # duplicates and leaves the highest sequence last for each client
+    keys = (records["client"].astype(numpy.uint64) << numpy.uint64(32)) \
+        | records["seq"].astype(numpy.uint64)
+    keys.sort()
+    first = numpy.ones(count, dtype=bool)
+    numpy.not_equal(keys[1:], keys[:-1], out=first[1:])
+    unique = keys[first]
+    u_clients = (unique >> numpy.uint64(32)).astype(numpy.int64)
+    u_seqs = (unique & numpy.uint64(0xffffffff)).astype(numpy.int64)
+    nclients = int(u_clients[-1]) + 1
+    seen = numpy.bincount(u_clients, minlength=nclients)
+    if msg_count:
+        expected = numpy.where(seen > 0, msg_count, 0)
+    else:
+        last = numpy.ones(len(unique), dtype=bool)
+        numpy.not_equal(u_clients[1:], u_clients[:-1], out=last[:-1])
+        expected = numpy.zeros(nclients, dtype=numpy.int64)
+        expected[u_clients[last]] = u_seqs[last]
+    lost = expected - seen
+
+    per_client = {}
+    for idx in numpy.nonzero(seen)[0]:
+        cid = clients[idx] if idx < len(clients) else "client-%d" % idx
+        per_client[cid] = {
+            "received": int(seen[idx]),
+            "expected": int(expected[idx]),
+            "lost": int(max(lost[idx], 0))
+        }
+
+    time_total = (t_last - t_first) / 1e9
+    return {
+        "path": path,
+        "msg_count": int(count),
+        "msg_duplicates": int(count - len(unique)),
+        "msg_lost": int(numpy.clip(lost, 0, None).sum()),
+        "client_count": len(per_client),
+        "bytes_total": int(records["size"].sum(dtype=numpy.uint64)),
+        "time_total": float(time_total),
+        "msg_per_sec": float(count / time_total) if time_total else 0.0,
+        "flight_time_mean": float(flight.mean()),
+        "flight_time_stddev": float(flight.std()),
+        "flight_time_min": float(flight.min()),
+        "flight_time_max": float(flight.max()),
+        "flight_time_percentiles": dict(
+            ("%g" % p, float(v)) for p, v in zip(percentiles, pvals)),
+        "throughput_window": window,
+        "throughput": [float(x) for x in throughput],
+        "per_client": per_client
+    }
@@ -0,0 +1,215 @@
+# Copyright (c) 2013, ReMake Electric ehf
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""
+Passive, long running statistics about whatever messages go past.
+
+WatcherStats holds all the state for "malaria watch", and is shared by
+the different ways of publishing it, such as the FUSE statistics
+filesystem in beem.statsfs, or the HTTP exporter in beem.exporter.
+"""
+
+import collections
+import logging
+import time
+
+import paho.mqtt.client as mqtt
+
+from beem.counters import Counters
+from beem.latency import PassiveLatency
+from beem.rates import CounterRates, Ticker
+from beem.sysseries import SYS_PREFIX, SysSeries
+from beem.topictrie import TopicTrie
+
+
+# counters the paho thread increments, and their slot indices
+COUNTERS = ("msgs", "bytes", "timed")
+_MSGS, _BYTES, _TIMED = range(len(COUNTERS))
+
+
+WatcherSnapshot = collections.namedtuple("WatcherSnapshot", [
+    "seq",             # increments with every snapshot
+    "time",            # when the snapshot was taken
+    "uptime",
+    "msgs_total",
+    "msgs_stored",
+    "drop_count",
+    "bytes_total",
+    "rates",           # {counter: {window: rate}}
+    "peaks",           # {counter: peak rate}
+    "topics",          # [(prefix, msgs, bytes), ...]
+    "topics_evicted",
+    "listen_topics",
+    "sys_series",      # {metric: ((time, value), ...)} oldest first
+    "sys_info",        # {$SYS subtopic: text} for non numeric $SYS topics
+    "timed_total",     # messages with a send time in their payload
+    "latency_all",     # {window: (count, p50, p99, max)} in ms
+    "latency"          # {window: {prefix: (count, p50, p99, max)}} in ms
+])
+
+
+class WatcherStats():
+    """
+    Subscribes to a set of topics (and the broker's $SYS tree) and keeps
+    counters, per topic prefix counts and decaying rates on what it sees,
+    as well as a short history of every broker $SYS metric.  Messages from
+    publishers using --timing also get their flight times tracked, over
+    each of LATENCY_WINDOWS.
+
+    The paho thread only increments counters, (in its own Counters slot, so
+    nothing else ever writes to them) and adds to its own flight time
+    histograms.  The topic trie is the exception, as there's only one paho
+    thread to write it, and readers only take atomic copies of each level,
+    where a trie per thread would multiply its memory bound.  Anything more
+    expensive is done by a background ticker, which also publishes an immutable
+    WatcherSnapshot of everything as .snapshot on every tick.  Readers
+    should use the snapshot, so that all the values they see are consistent
+    with each other.
+    """
+    # counters we keep rates for, and the windows (seconds) to average over
+    RATE_COUNTERS = {
+        "msgs": "Messages",
+        "bytes": "Payload bytes",
+        "drops": "Dropped messages"
+    }
+    RATE_WINDOWS = (1, 10, 60)
+    RATE_INTERVAL = 0.25
+    LATENCY_WINDOWS = (10, 60)
+
+    def __init__(self, options):
+        self.options = options
+        self.cid = options.clientid
+        self.log = logging.getLogger(__name__ + ":" + self.cid)
+        self.listen_topics = options.topic
+        self.time_start = time.time()
+        self.counters = Counters(COUNTERS)
+        self.msgs_stored = 0
+        self.drop_count = 0
+        self.drop_count_initial = None
+        self.topics = TopicTrie(options.prefix_depth, options.prefix_max)
+        self.sys = SysSeries(options.sys_history)
+        self.latency = PassiveLatency(self.LATENCY_WINDOWS,
+                                      prefix_depth=options.latency_depth,
+                                      max_prefixes=options.latency_prefixes)
+        self.rates = dict((c, CounterRates(self.RATE_WINDOWS, self.RATE_INTERVAL))
+                          for c in self.RATE_COUNTERS)
+        self.ticker = Ticker(self.RATE_INTERVAL, self._tick)
+        self.mqttc = None
+        self.snapshot = None
+        self._take_snapshot()
+
+    def uptime(self):
+        return time.time() - self.time_start
+
+    def _tick(self):
+        """
+        Runs in the ticker thread, so that reads never have to do any work
+        """
+        totals = self.counters.totals()
+        self.rates["msgs"].update(totals["msgs"])
+        self.rates["bytes"].update(totals["bytes"])
+        self.rates["drops"].update(self.drop_count)
+        self.latency.tick(time.time())
+        self._take_snapshot(totals)
+
+    def _take_snapshot(self, totals=None):
+        if totals is None:
+            totals = self.counters.totals()
+        now = time.time()
+        seq = self.snapshot.seq + 1 if self.snapshot else 0
+        self.snapshot = WatcherSnapshot(
+            seq=seq,
+            time=now,
+            uptime=now - self.time_start,
+            msgs_total=totals["msgs"],
+            msgs_stored=self.msgs_stored,
+            drop_count=self.drop_count,
+            bytes_total=totals["bytes"],
+            rates=dict((c, dict((w, cr.rate(w)) for w in self.RATE_WINDOWS))
+                       for c, cr in self.rates.items()),
+            peaks=dict((c, cr.peak) for c, cr in self.rates.items()),
+            topics=self.topics.items(),
+            topics_evicted=self.topics.evicted,
+            listen_topics=tuple(self.listen_topics),
+            sys_series=dict((name, ring.history())
+                            for name, ring in list(self.sys.series.items())),
+            sys_info=dict(self.sys.info),
+            timed_total=totals["timed"],
+            latency_all=self.latency.overall,
+            latency=self.latency.summary)
+
+    def _update_drops(self, value):
+        if self.drop_count_initial is None:
+            self.drop_count_initial = int(value)
+            self.log.debug("Initial drops: %d", self.drop_count_initial)
+            return
+        drops = int(value) - self.drop_count_initial
+        if drops != self.drop_count:
+            self.log.warn("Drop count has increased by %d",
+                          drops - self.drop_count)
+            self.drop_count = drops
+
+    def msg_handler(self, mosq, userdata, msg):
+        # WARNING: this _must_ release as quickly as possible!
+        # get the sequence id from the topic
+        #self.log.debug("heard a message on topic: %s", msg.topic)
+        if msg.topic.startswith(SYS_PREFIX):
+            name, value = self.sys.ingest(msg.topic, msg.payload, time.time())
+            if name == "messages_dropped":
+                self._update_drops(value)
+            elif name == "messages_stored":
+                self.msgs_stored = int(value)
+            return
+        size = len(msg.payload)
+        slot = self.counters.slot()
+        slot[_MSGS] += 1
+        slot[_BYTES] += size
+        self.topics.add(msg.topic, size)
+        if self.latency.observe(msg.topic, msg.payload, time.time()):
+            slot[_TIMED] += 1
+
+    def start(self):
+        """
+        Connect and start watching, safe to call more than once.
+        """
+        if self.mqttc:
+            return
+        self.mqttc = mqtt.Client(self.cid)
+        self.mqttc.on_message = self.msg_handler
+        # TODO - you _probably_ want to tweak this
+        self.mqttc.max_inflight_messages_set(200)
+        rc = self.mqttc.connect(self.options.host, self.options.port, 60)
+        if rc:
+            raise Exception("Couldn't even connect! ouch! rc=%d" % rc)
+            # umm, how?
+        self.mqttc.subscribe(SYS_PREFIX + "#", 0)
+        self.mqttc.loop_start()
+        [self.mqttc.subscribe(t, self.options.qos) for t in self.listen_topics]
+        self.ticker.start()
+
+    def stop(self):
+        if not self.mqttc:
+            return
+        self.ticker.stop()
+        self.mqttc.disconnect()
+        self.mqttc.loop_stop()
@@ -2,3 +2,12 @@ import beem.cmds.publish
 import beem.cmds.subscribe
 import beem.cmds.keygen
 import beem.cmds.watch
+import beem.cmds.analyze
+import beem.cmds.report
+import beem.cmds.bench
+import beem.cmds.coordinator
+import beem.cmds.agent
+import beem.cmds.scenario
+import beem.cmds.merge
+import beem.cmds.selftest
+import beem.cmds.compare
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, ReMake Electric ehf
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# This file implements the "malaria agent" command
+"""
+Join a "malaria coordinator", and publish whatever it asks, when it asks.
+"""
+
+import argparse
+import socket
+
+import beem.swarm
+from beem.cmds.watch import host_port
+
+
+def add_args(subparsers):
+    parser = subparsers.add_parser(
+        "agent",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=__doc__,
+        help="Publish for a malaria coordinator")
+
+    parser.add_argument(
+        "coordinator", type=host_port, metavar="HOST:PORT",
+        help="Address of the coordinator")
+    parser.add_argument(
+        "-N", "--name", default=socket.gethostname(),
+        help="Name to register with the coordinator as")
+
+    parser.set_defaults(handler=run)
+
+
+def run(options):
+    host, port = options.coordinator
+    beem.swarm.Agent((host or "localhost", port), options.name).run()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, ReMake Electric ehf
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# This file implements the "malaria analyze" command
+"""
+Analyse a capture file recorded by "malaria subscribe --capture"
+"""
+
+import argparse
+
+import beem
+import beem.capture
+
+
+def print_stats(stats):
+    """
+    pretty print a capture analysis
+    """
+    print("Capture file: %s" % stats["path"])
+    print("Total clients tracked: %d" % stats["client_count"])
+    print("Total messages: %d (%d bytes)"
+          % (stats["msg_count"], stats["bytes_total"]))
+    print("Total time: %0.2f secs" % stats["time_total"])
+    print("Messages per second: %d" % stats["msg_per_sec"])
+    print("Messages duplicated: %d" % stats["msg_duplicates"])
+    print("Messages lost: %d" % stats["msg_lost"])
+    for cid, cs in sorted(stats["per_client"].items()):
+        if cs["lost"] > 0:
+            print("Messages lost for client %s: %d/%d"
+                  % (cid, cs["lost"], cs["expected"]))
+    print("Flight time mean:   %0.2f ms" % stats["flight_time_mean"])
+    print("Flight time stddev: %0.2f ms" % stats["flight_time_stddev"])
+    print("Flight time min:    %0.2f ms" % stats["flight_time_min"])
+    print("Flight time max:    %0.2f ms" % stats["flight_time_max"])
+    pcts = stats["flight_time_percentiles"]
+    for p in sorted(pcts, key=float):
+        print("Flight time p%-6s %0.2f ms" % (p + ":", pcts[p]))
+    rates = stats["throughput"]
+    print("Throughput per %gs window: min %0.1f, mean %0.1f, max %0.1f msgs/sec"
+          % (stats["throughput_window"], min(rates),
+             sum(rates) / len(rates), max(rates)))
+
+
+def add_args(subparsers):
+    parser = subparsers.add_parser(
+        "analyze",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=__doc__,
+        help="Analyse a message capture file")
+
+    parser.add_argument(
+        "capture",
+        help="Capture file to analyse")
+    parser.add_argument(
+        "-p", "--percentile", type=float, default=[], action="append",
+        help="""Flight time percentile to report, can be given multiple
+        times. Defaults to %s""" % beem.capture.DEFAULT_PERCENTILES)
+    parser.add_argument(
+        "-w", "--window", type=float, default=1.0,
+        help="Window size in seconds for throughput calculations")
+    parser.add_argument(
+        "-n", "--msg_count", type=int, default=None,
+        help="""How many messages each client was expected to send.
+        Default is to assume the highest sequence number seen""")
+    parser.add_argument(
+        "--json", type=str, default=None,
+        help="""Dump the analysis into the given JSON file.""")
+
+    parser.set_defaults(handler=run)
+
+
+def run(options):
+    stats = beem.capture.analyze(
+        options.capture,
+        percentiles=options.percentile or beem.capture.DEFAULT_PERCENTILES,
+        window=options.window, msg_count=options.msg_count)
+    print_stats(stats)
+    if options.json is not None:
+        beem.json_dump_stats(stats, options.json)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, ReMake Electric ehf
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# This file implements the "malaria bench" command
+"""
+Benchmark malaria's own message handling, without a broker.
+Shows how many messages per second "malaria watch" can count, on its own and
+with threads reading its statistics filesystem at the same time.
+
+With --suite, runs microbenchmarks of all of malaria's hot paths instead,
+which can be saved as a baseline, and compared against later.
+"""
+
+import argparse
+import json
+
+import beem
+import beem.bench
+
+
+def add_args(subparsers):
+    parser = subparsers.add_parser(
+        "bench",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=__doc__,
+        help="Benchmark malaria's own message handling")
+
+    parser.add_argument(
+        "-n", "--msg_count", type=int, default=200000,
+        help="How many messages to feed through the watcher")
+    parser.add_argument(
+        "-r", "--readers", type=int, default=4,
+        help="""How many threads to read the statistics filesystem with,
+        for the run with readers.  (This needs fusepy, but not a mount,
+        and is skipped without it)""")
+    parser.add_argument(
+        "--suite", action="store_true",
+        help="""Run the microbenchmark suite, instead of the watcher
+        benchmark above""")
+    parser.add_argument(
+        "--only", action="append", choices=list(beem.bench.SUITE),
+        help="With --suite, only run this benchmark.  Can be repeated")
+    parser.add_argument(
+        "--repeat", type=int, default=5,
+        help="With --suite, how many times to repeat each benchmark")
+    parser.add_argument(
+        "--save", default=None, metavar="FILE",
+        help="With --suite, save the results to FILE, for use as a baseline")
+    parser.add_argument(
+        "--load", default=None, metavar="FILE",
+        help="""With --suite, don't run anything, use results saved to FILE.
+        Useful with --baseline to compare two saved runs""")
+    parser.add_argument(
+        "--baseline", default=None, metavar="FILE",
+        help="""With --suite, compare the results to a baseline saved with
+        --save, and exit with an error if anything regressed""")
+    parser.add_argument(
+        "--threshold", type=float, default=10,
+        help="With --baseline, how many percent slower counts as a regression")
+
+    parser.set_defaults(handler=run)
+
+
+def print_result(result):
+    print("%d readers: %d msgs in %.2f secs, %.0f msgs/sec"
+          % (result["readers"], result["msg_count"], result["time_total"],
+             result["msgs_per_sec"]))
+    if "fs_ops" in result:
+        print("    fs ops: %s" % ", ".join(
+            "%s %d" % (op, n) for op, n in sorted(result["fs_ops"].items())))
+
+
+def print_suite(results):
+    for name, r in results["results"].items():
+        print("%-32s %12.0f ops/sec  (%.3g secs/op, median %.3g)"
+              % (name, r["ops_per_sec"], r["best"], r["median"]))
+
+
+def print_comparison(comparison, threshold):
+    for name, base, cur, change, regressed in comparison:
+        print("%-32s %+7.1f%% time/op  %s"
+              % (name, change, "REGRESSED" if regressed else "ok"))
+    regressions = [c for c in comparison if c[4]]
+    if regressions:
+        raise SystemExit("%d of %d benchmarks are more than %g%% slower "
+                         "than the baseline"
+                         % (len(regressions), len(comparison), threshold))
+
+
+def run_suite(options):
+    if options.load:
+        with open(options.load) as f:
+            results = json.load(f)
+    else:
+        results = beem.bench.run_suite(options.only, options.repeat)
+    print_suite(results)
+    if options.save:
+        beem.json_dump_stats(results, options.save)
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        print("Compared to %s:" % options.baseline)
+        print_comparison(beem.bench.compare_suite(baseline, results,
+                                                  options.threshold),
+                         options.threshold)
+
+
+def run(options):
+    if options.suite:
+        return run_suite(options)
+    msgs = beem.bench.make_messages(options.msg_count)
+    print_result(beem.bench.bench_watcher(msgs))
+    if options.readers:
+        missing = beem.bench.statsfs_missing()
+        if missing:
+            print("Skipping the run with readers, it %s" % missing)
+            return
+        print_result(beem.bench.bench_watcher(msgs, options.readers))
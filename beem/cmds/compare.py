@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, ReMake Electric ehf
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#
+# This file implements the "malaria compare" command
+"""
+Compare two runs, (eg, the same warhead before and after a broker change)
+and report whether the differences in throughput and latency are
+significant, or just noise.  Each run is the --json output of "malaria
+publish", "malaria subscribe" or "malaria merge", or a capture file from
+"malaria subscribe --capture".
+"""
+
+import argparse
+
+import beem
+import beem.compare
+
+
+def add_args(subparsers):
+    parser = subparsers.add_parser(
+        "compare",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=__doc__,
+        help="Compare two runs, with confidence intervals")
+
+    parser.add_argument("baseline", help="The run to compare against")
+    parser.add_argument("current", help="The run to compare")
+    parser.add_argument(
+        "--percentiles", type=float, nargs="+",
+        default=beem.compare.DEFAULT_PERCENTILES,
+        help="Latency percentiles to compare")
+    parser.add_argument(
+        "--resamples", type=int, default=beem.compare.DEFAULT_RESAMPLES,
+        help="How many bootstrap resamples to make of each run")
+    parser.add_argument(
+        "--confidence", type=float, default=beem.compare.DEFAULT_CONFIDENCE,
+        help="Confidence level, in percent, of the intervals")
+    parser.add_argument(
+        "--min_change", type=float, default=beem.compare.DEFAULT_MIN_CHANGE,
+        help="""Smallest change, in percent, worth reporting.  Anything whose
+        interval reaches inside this either way is reported as noise""")
+    parser.add_argument(
+        "--seed", type=int, default=None,
+        help="Seed the resampling, for exactly repeatable intervals")
+    parser.add_argument(
+        "--json", type=str, default=None,
+        help="""Dump the comparison into the given JSON file.""")
+
+    parser.set_defaults(handler=run)
+
+
+def print_comparison(rows, confidence):
+    print("%-20s %12s %12s %9s   %-19s" % ("", "baseline", "current", "change",
+                                          "%g%% interval" % confidence))
+    for r in rows:
+        unit = "msgs/sec" if r["name"] == "throughput" else "ms"
+        change = "%+8.1f%%" % r["change"] if r["change"] is not None else "%9s" % "-"
+        if r["significant"] is None:
+            interval = "%-19s" % "(no samples)"
+            verdict = ""
+        else:
+            interval = "[%+6.1f%%, %+6.1f%%]" % (r["ci_low"], r["ci_high"])
+            if r["significant"]:
+                verdict = "significant, %s" % ("better" if r["better"] else "worse")
+            else:
+                verdict = "noise"
+        print("%-20s %12.3f %12.3f %s   %s  %s"
+              % ("%s (%s)" % (r["name"], unit), r["baseline"], r["current"],
+                 change, interval, verdict))
+
+
+def run(options):
+    try:
+        baseline = beem.compare.load_run(options.baseline)
+        current = beem.compare.load_run(options.current)
+        rows = beem.compare.compare(baseline, current, options.percentiles,
+                                    options.resamples, options.confidence,
+                                    options.seed, options.min_change)
+    except (IOError, ValueError, RuntimeError) as e:
+        raise SystemExit("Can't compare: %s" % (e,))
+    print("Baseline: %s" % baseline.describe())
+    print("Current:  %s" % current.describe())
+    if not rows:
+        raise SystemExit("Nothing in common to compare")
+    for r in (baseline, current):
+        if r.series is not None and len(r.series) < beem.compare.MIN_WINDOWS:
+            print("(Only %d seconds of throughput in %s, run for longer for "
+                  "a trustworthy interval)" % (len(r.series), r.path))
+    print_comparison(rows, options.confidence)
+    print("(Intervals only cover the noise within each run, not how much the "
+          "same test varies between runs.  Repeat runs before trusting a "
+          "change near %g%%)" % options.min_change)
+    if options.json is not None:
+        beem.json_dump_stats({"baseline": options.baseline,
+                              "current": options.current,
+                              "confidence": options.confidence,
+                              "min_change": options.min_change,
+                              "comparison": rows}, options.json)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, ReMake Electric ehf
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# This file implements the "malaria coordinator" command
+"""
+Coordinate a swarm of "malaria agent"s, all publishing to the same target,
+starting at the same moment, with live swarm wide statistics.
+"""
+
+import argparse
+
+import beem
+import beem.swarm
+from beem.cmds.watch import host_port
+
+
+def add_args(subparsers):
+    parser = subparsers.add_parser(
+        "coordinator",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=__doc__,
+        help="Run a publish test on a swarm of agents")
+
+    parser.add_argument(
+        "-l", "--listen", type=host_port, default=("", 7777),
+        metavar="[HOST:]PORT", help="Address to listen for agents on")
+    parser.add_argument(
+        "-a", "--agents", type=int, default=1,
+        help="How many agents to wait for before starting")
+    parser.add_argument(
+        "--join_timeout", type=float, default=None,
+        help="Give up if the agents haven't all joined in this many seconds")
+    parser.add_argument(
+        "--start_delay", type=float, default=5,
+        help="""Seconds between sending the scenario and starting, so every
+        agent has time to connect its clients""")
+    parser.add_argument(
+        "-i", "--interval", type=float, default=1,
+        help="Seconds between swarm statistics updates")
+    parser.add_argument(
+        "-H", "--host", default="localhost",
+        help="MQTT host for the agents to publish to")
+    parser.add_argument(
+        "-p", "--port", type=int, default=1883,
+        help="Port for remote MQTT host")
+    parser.add_argument(
+        "-q", "--qos", type=int, choices=[0, 1, 2], default=1,
+        help="set the mqtt qos for messages published")
+    parser.add_argument(
+        "-C", "--clients", type=int, default=10,
+        help="How many clients each agent should run")
+    parser.add_argument(
+        "-n", "--msg_count", type=int, default=10,
+        help="How many messages each client should send")
+    parser.add_argument(
+        "-s", "--msg_size", type=int, default=100,
+        help="Size of messages to send. This will be gaussian at (x, x/20)")
+    parser.add_argument(
+        "-t", "--timing", action="store_true",
+        help="Message bodies will contain timing information")
+    parser.add_argument(
+        "-T", "--msgs_per_second", type=float, default=0,
+        help="Each client should target sending this many msgs per second")
+    parser.add_argument(
+        "--jitter", type=float, default=0.1,
+        help="Percentage jitter to use when rate limiting via --msgs_per_sec")
+    parser.add_argument(
+        "--json", type=str, default=None,
+        help="Dump the swarm stats into the given JSON file.")
+
+    parser.set_defaults(handler=run)
+
+
+def run(options):
+    scenario = dict((k, getattr(options, k))
+                    for k in beem.swarm.SCENARIO_DEFAULTS)
+    coordinator = beem.swarm.Coordinator(
+        options.listen, options.agents, scenario, options.start_delay,
+        options.interval, options.join_timeout)
+    stats = coordinator.run()
+    beem.print_publish_stats(stats)
+    if options.json is not None:
+        beem.json_dump_stats(stats, options.json)
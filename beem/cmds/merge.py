@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, ReMake Electric ehf
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# This file implements the "malaria merge" command
+"""
+Merge the --json stats from many "malaria publish" runs, (eg, one per node
+of a swarm) into exact swarm wide totals, rates and latencies.
+"""
+
+import argparse
+
+import beem
+import beem.merge
+
+
+def add_args(subparsers):
+    parser = subparsers.add_parser(
+        "merge",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=__doc__,
+        help="Merge publish stats from many nodes")
+
+    parser.add_argument(
+        "inputs", nargs="+", metavar="FILE",
+        help="""JSON stats files from "malaria publish --json", or
+        directories of them""")
+    parser.add_argument(
+        "--json", type=str, default=None,
+        help="""Dump the merged stats into the given JSON file.""")
+
+    parser.set_defaults(handler=run)
+
+
+def run(options):
+    merger = beem.merge.StatsMerger()
+    for path in beem.merge.input_files(options.inputs):
+        try:
+            merger.add_file(path)
+        except ValueError as e:
+            raise SystemExit("Can't merge %s: %s" % (path, e))
+    stats = merger.result()
+    beem.print_publish_stats(stats)
+    if not stats["time_exact"]:
+        print("(Latencies are count weighted averages, some inputs had no histogram)")
+    if options.json is not None:
+        beem.json_dump_stats(stats, options.json)
@@ -39,6 +39,7 @@ import time
 import beem.load
 import beem.bridge
 import beem.msgs
+import beem.profiling
 
 
 def my_custom_msg_generator(sequence_length):
@@ -59,17 +60,28 @@ def _worker(options, proc_num, auth=None):
     Wrapper to run a test and push the results back onto a queue.
     Modify this to provide custom message generation routines.
     """
+    return beem.profiling.run_profiled(options, "publish-%d" % proc_num,
+                                       _run_worker, options, proc_num, auth)
+
+
+def _run_worker(options, proc_num, auth=None):
     # Make a new clientid with our worker process number
     cid = "%s-%d" % (options.clientid, proc_num)
     if options.bridge:
-        ts = beem.bridge.BridgingSender(options.host, options.port, cid, auth)
+        ports = beem.bridge.PortAllocator(*options.bridge_ports)
+        ts = beem.bridge.BridgingSender(options.host, options.port, cid, auth,
+                                        ports, options.bridge_rtt)
         # This is _probably_ what you want if you are specifying a key file
         # This would correspond with using ids as clientids, and acls
         if auth:
             cid = auth.split(":")[0]
     else:
-        # FIXME - add auth support here too dummy!
-        ts = beem.load.TrackingSender(options.host, options.port, cid)
+        ts_cid = cid
+        if auth:
+            cid = auth.split(":")[0]
+        ts = beem.load.TrackingSender(options.host, options.port, ts_cid, auth,
+                                      beem.load.round_trip_topic(options, cid),
+                                      options.round_trip_separate)
 
     # Provide a custom generator
     #msg_gen = my_custom_msg_generator(options.msg_count)
@@ -81,11 +93,52 @@ def _worker(options, proc_num, auth=None):
 
 
 def _worker_threaded(options, proc_num, auth=None):
-    ts = beem.bridge.ThreadedBridgingSender(options, proc_num, auth)
+    return beem.profiling.run_profiled(options, "publish-%d" % proc_num,
+                                       _run_worker_threaded,
+                                       options, proc_num, auth)
+
+
+def _run_worker_threaded(options, proc_num, auth=None):
+    if options.bridge:
+        ts = beem.bridge.ThreadedBridgingSender(options, proc_num, auth)
+    else:
+        ts = beem.load.ThreadedTrackingSender(options, proc_num, auth)
     ts.run()
     return ts.stats
 
 
+def port_range(value):
+    """
+    argparse type for LOW-HIGH, returning a (low, high) tuple
+    """
+    try:
+        low, high = [int(x) for x in value.split("-")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected LOW-HIGH, not %s" % value)
+    if not 0 < low <= high < 65536:
+        raise argparse.ArgumentTypeError("invalid port range %s" % value)
+    return (low, high)
+
+
+def add_profile_args(parser):
+    parser.add_argument(
+        "--profile", default=None, metavar="DIRECTORY",
+        help="""Profile each worker with a sampling profiler, writing a
+        cProfile compatible WORKER.prof for each into DIRECTORY, and a
+        merged combined.prof and combined.txt report at the end""")
+    parser.add_argument(
+        "--profile_start", type=float, default=0,
+        help="With --profile, seconds to wait before starting to sample")
+    parser.add_argument(
+        "--profile_duration", type=float, default=None,
+        help="""With --profile, seconds to sample for.  Default is until the
+        worker finishes""")
+    parser.add_argument(
+        "--profile_interval", type=float,
+        default=beem.profiling.DEFAULT_INTERVAL,
+        help="With --profile, seconds between samples")
+
+
 def add_args(subparsers):
     parser = subparsers.add_parser(
         "publish",
@@ -133,31 +186,68 @@ def add_args(subparsers):
         help="How many separate processes to spin up (multiprocessing)")
     parser.add_argument(
         "--thread_ratio", type=int, default=1,
-        help="Threads per process (bridged multiprocessing) WARNING! VERY ALPHA!")
+        help="""Threads per process, each its own client.  With -b, they
+        share a bridge per process.  WARNING! VERY ALPHA!""")
 
     parser.add_argument(
         "-b", "--bridge", action="store_true",
         help="""Instead of connecting directly to the target, fire up a
         separate mosquitto instance configured to bridge to the target""")
-    # See http://stackoverflow.com/questions/4114996/python-argparse-nargs-or-depending-on-prior-argument
-    # we shouldn't allow psk-file without bridging, as python doesn't let us use psk
+    parser.add_argument(
+        "--bridge_per_client", action="store_true",
+        help="""With --thread_ratio, give every thread its own mosquitto
+        bridge instance, instead of one instance per process with a bridge
+        connection per thread.  Much heavier, but fully isolates clients""")
+    parser.add_argument(
+        "--bridge_ports", type=port_range, metavar="LOW-HIGH",
+        default="%d-%d" % beem.bridge.BRIDGE_PORTS,
+        help="""Local ports for bridges to listen on.  Ports are reserved
+        with lock files, so every malaria on a node can share this range""")
+    parser.add_argument(
+        "--bridge_rtt", action="store_true",
+        help="""Once a second, send a ping through each bridge to the target
+        and back, to measure the round trip to the real target.  The target
+        must let the bridge subscribe to its own mqtt-malaria/<id>/rtt/ping""")
+    parser.add_argument(
+        "--round_trip", action="store_true",
+        help="""Also subscribe to our own messages, and measure how long
+        they take to be delivered, as well as to be acked.  Both are timed
+        on the publisher's own clock.  Not available with -b""")
+    parser.add_argument(
+        "--round_trip_topic", default="mqtt-malaria/{cid}/data/#",
+        help="""With --round_trip, the topic filter to subscribe to, {cid} is
+        replaced with the publisher's client id.  Change this to measure a
+        paired topic, if something republishes our messages.  The second
+        last topic level must still be the sequence number""")
+    parser.add_argument(
+        "--round_trip_separate", action="store_true",
+        help="""With --round_trip, subscribe on a second connection, instead
+        of the publishing one""")
     parser.add_argument(
         "--psk_file", type=argparse.FileType("r"),
         help="""A file of psk 'identity:key' pairs, as you would pass to
 mosquitto's psk_file configuration option.  Each process will use a single
-line from the file.  Only as many processes will be made as there are keys""")
+line from the file.  Only as many processes will be made as there are keys.
+Without -b, this needs python 3.13 or later for TLS-PSK support""")
     parser.add_argument(
         "--json", type=str, default=None,
         help="""Dump the collected stats into the given JSON file.""")
+    add_profile_args(parser)
 
     parser.set_defaults(handler=run)
 
 
 def run(options):
+    if options.round_trip and options.bridge:
+        raise SystemExit("--round_trip needs a direct connection, not -b")
+    if options.profile and not os.path.isdir(options.profile):
+        os.makedirs(options.profile)
     time_start = time.time()
     # This should be pretty easy to use for passwords as well as PSK....
     if options.psk_file:
-        assert options.bridge, "PSK is only supported with bridging due to python limitations, sorry about that"
+        if not options.bridge and not beem.load.psk_supported():
+            raise SystemExit("This python can't do TLS-PSK (it needs 3.13 or "
+                             "later) so PSK needs bridging (-b), sorry about that")
         auth_pairs = options.psk_file.readlines()
         # Can only fire up as many processes as we have keys!
         # FIXME - not true with threading!!
@@ -199,6 +289,10 @@ def run(options):
             time.sleep(1)
 
     time_end = time.time()
+    if options.profile:
+        report = beem.profiling.merge_profiles(
+            options, ["publish-%d" % x for x in range(options.processes)])
+        print("Merged profile report: %s" % report)
     stats_set = []
     for result in completed_set:
         s = result.get()
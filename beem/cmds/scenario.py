@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, ReMake Electric ehf
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# This file implements the "malaria scenario" command
+"""
+Run a multi phase scenario file, with one set of clients staying connected
+through ramps, steady load, spikes and idle time, and stats for each phase.
+"""
+
+import argparse
+import os
+import socket
+
+import beem
+import beem.scenario
+
+
+def add_args(subparsers):
+    parser = subparsers.add_parser(
+        "scenario",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=__doc__,
+        help="Publish through the phases of a scenario file")
+
+    parser.add_argument(
+        "file",
+        help="""Scenario file, JSON, or YAML if PyYAML is installed.  See
+        the scenarios directory for examples""")
+    parser.add_argument(
+        "-c", "--clientid",
+        default="beem.scenario-%s-%d" % (socket.gethostname(), os.getpid()),
+        help="""Base client id for the publishers, each gets a number
+        appended.  The clientid is also used in the default topics.""")
+    parser.add_argument(
+        "-H", "--host", default="localhost",
+        help="MQTT host to connect to")
+    parser.add_argument(
+        "-p", "--port", type=int, default=1883,
+        help="Port for remote MQTT host")
+    parser.add_argument(
+        "--json", type=str, default=None,
+        help="""Dump the stats for each phase into the given JSON file.""")
+
+    parser.set_defaults(handler=run)
+
+
+def run(options):
+    try:
+        scenario = beem.scenario.load(options.file)
+    except ValueError as e:
+        raise SystemExit("Bad scenario %s: %s" % (options.file, e))
+    runner = beem.scenario.ScenarioRunner(scenario, options.host, options.port,
+                                          options.clientid)
+    runner.run()
+    stats_set = runner.stats()
+    for s in stats_set:
+        beem.print_publish_stats(s)
+    overall = runner.overall_stats()
+    beem.print_publish_stats(overall)
+    if options.json is not None:
+        beem.json_dump_stats(stats_set + [overall], options.json)
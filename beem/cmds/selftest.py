@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, ReMake Electric ehf
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# This file implements the "malaria selftest" command
+"""
+Measure how fast malaria itself can publish, subscribe and connect on this
+machine, against a minimal built in broker, so you know whether a test is
+limited by malaria or by the broker under test.
+"""
+
+import argparse
+import multiprocessing
+
+import beem
+import beem.selftest
+
+
+def add_args(subparsers):
+    parser = subparsers.add_parser(
+        "selftest",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=__doc__,
+        help="Measure malaria's own limits on this machine")
+
+    parser.add_argument(
+        "-P", "--processes", type=int, default=multiprocessing.cpu_count(),
+        help="How many publisher processes to run")
+    parser.add_argument(
+        "-n", "--msg_count", type=int, default=20000,
+        help="How many messages each publisher sends")
+    parser.add_argument(
+        "-s", "--msg_size", type=int, default=100,
+        help="Size of messages to send")
+    parser.add_argument(
+        "-q", "--qos", type=int, choices=[0, 1, 2], default=1,
+        help="set the mqtt qos for messages published")
+    parser.add_argument(
+        "-C", "--connections", type=int, default=1000,
+        help="""How many connections to try and hold at once.  You will
+        probably hit ulimit -n before long""")
+    parser.add_argument(
+        "--timeout", type=float, default=60,
+        help="Seconds to wait for a subscriber or connections to catch up")
+    parser.add_argument(
+        "--serve", type=int, default=None, metavar="PORT",
+        help="""Don't test anything, just run the built in stub broker on
+        PORT, for trying things out by hand""")
+    parser.add_argument(
+        "--json", type=str, default=None,
+        help="""Dump the results into the given JSON file.""")
+
+    parser.set_defaults(handler=run)
+
+
+def run(options):
+    if options.serve is not None:
+        from beem.stubbroker import StubBroker
+        try:
+            StubBroker(port=options.serve).serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return
+    results = beem.selftest.run(options)
+    beem.selftest.print_results(results)
+    if options.json is not None:
+        beem.json_dump_stats(results, options.json)
@@ -32,6 +32,8 @@ Listen to a stream of messages and capture statistics on their timing
 import argparse
 import os
 import beem.listen
+import beem.profiling
+from beem.cmds.publish import add_profile_args
 
 
 def print_stats(stats):
@@ -55,6 +57,9 @@ def print_stats(stats):
     print("Flight time stddev: %0.2f ms" % (stats["flight_time_stddev"] * 1000))
     print("Flight time min:    %0.2f ms" % (stats["flight_time_min"] * 1000))
     print("Flight time max:    %0.2f ms" % (stats["flight_time_max"] * 1000))
+    pcts = stats.get("flight_time_percentiles", {})
+    for p in sorted(pcts, key=float):
+        print("Flight time p%-6s %0.2f ms" % (p + ":", pcts[p] * 1000))
 
 
 def add_args(subparsers):
@@ -92,13 +97,23 @@ def add_args(subparsers):
     parser.add_argument(
         "--json", type=str, default=None,
         help="""Dump the collected stats into the given JSON file.""")
+    parser.add_argument(
+        "--capture", type=str, default=None,
+        help="""Append a binary record of every message received to this
+        file, for later use with 'malaria analyze'""")
+    add_profile_args(parser)
 
     parser.set_defaults(handler=run)
 
 
 def run(options):
+    if options.profile and not os.path.isdir(options.profile):
+        os.makedirs(options.profile)
     ts = beem.listen.TrackingListener(options.host, options.port, options)
-    ts.run(options.qos)
+    beem.profiling.run_profiled(options, "subscribe", ts.run, options.qos)
+    if options.profile:
+        report = beem.profiling.merge_profiles(options, ["subscribe"])
+        print("Profile report: %s" % report)
     print_stats(ts.stats())
     if options.json is not None:
         beem.json_dump_stats(ts.stats(), options.json)
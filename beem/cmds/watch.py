@@ -34,6 +34,17 @@ import os
 import beem.listen
 
 
+def host_port(value):
+    """
+    argparse type for [HOST:]PORT, returning a (host, port) tuple
+    """
+    host, _, port = value.rpartition(":")
+    try:
+        return (host, int(port))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected [HOST:]PORT, not %s" % value)
+
+
 def add_args(subparsers):
     parser = subparsers.add_parser(
         "watch",
@@ -61,7 +72,39 @@ def add_args(subparsers):
          '+' symbol if available. Will actually default to "#" if no custom
          topics are provided""")
     parser.add_argument(
-        "-d", "--directory", help="Directory to publish statistics FS to")
+        "-d", "--directory", help="""Directory to publish statistics FS to.
+        The statistics FS (which requires fusepy) is used by default, unless
+        only --http is given""")
+    parser.add_argument(
+        "--http", type=host_port, default=None, metavar="[HOST:]PORT",
+        help="""Serve statistics in OpenMetrics text format over HTTP at
+        http://HOST:PORT/metrics""")
+    parser.add_argument(
+        "--prefix_depth", type=int, default=3,
+        help="How many topic levels to keep per prefix statistics for")
+    parser.add_argument(
+        "--prefix_max", type=int, default=10000,
+        help="""Maximum number of topic prefixes to track.  When this is
+        reached, the least active prefixes are evicted""")
+    parser.add_argument(
+        "--sys_history", type=int, default=360,
+        help="""How many samples of history to keep for each broker $SYS
+        metric.  (Brokers normally publish $SYS every 10 seconds)""")
+    parser.add_argument(
+        "--latency_depth", type=int, default=1,
+        help="""How many topic levels to keep per prefix flight times for,
+        for messages from publishers using --timing""")
+    parser.add_argument(
+        "--latency_prefixes", type=int, default=100,
+        help="""Maximum number of topic prefixes to keep flight times for.
+        Messages on any others are only in the overall flight times""")
+    parser.add_argument(
+        "--record", default=None, metavar="DIRECTORY",
+        help="""Record all statistics to this directory, for use with
+        'malaria report'.  An existing recording will be continued""")
+    parser.add_argument(
+        "--record_interval", type=float, default=5,
+        help="How often to sample statistics when recording, in seconds")
 
     parser.set_defaults(handler=run)
 
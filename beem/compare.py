@@ -0,0 +1,267 @@
+# Copyright (c) 2013, ReMake Electric ehf
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""
+Statistical comparison of two runs, eg, before and after a broker upgrade.
+
+Either run can be "--json" stats from "malaria publish", "malaria subscribe"
+or "malaria merge", or a capture file from "malaria subscribe --capture".
+Throughput and latency of the second run are compared to the first, with a
+bootstrap confidence interval on each relative change.  A change is only
+significant if its whole interval is further from zero than min_change
+percent, anything less is reported as noise.
+
+Latencies are resampled from each run's log bucketed histogram, so this
+takes the same time for any size of run, and every percentile is within half
+a bucket (0.5%) of the exact value.  That treats every message as
+independent, which they aren't quite, so latency intervals are on the
+narrow side, and min_change is what keeps small shifts from being called
+significant.  Throughput is resampled in blocks of consecutive seconds from
+the per second rate series, (without the first and last, partial, seconds)
+as each second's rate depends on the ones before it.  Inputs without a
+series, (from older versions) only get a point estimate.
+
+Either way, the intervals only cover the noise within each run.  How much
+the same test varies from one run to the next isn't in a single pair of
+runs at all, so repeat runs before trusting a small change.
+"""
+
+from __future__ import division
+
+import json
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import beem.capture
+import beem.merge
+import beem.stats
+
+DEFAULT_PERCENTILES = [50, 90, 99, 99.9]
+DEFAULT_RESAMPLES = 2000
+DEFAULT_CONFIDENCE = 95
+# changes (in percent) that could be this big are reported as noise
+DEFAULT_MIN_CHANGE = 5
+# resamples of a histogram are made this many at a time, to bound memory use
+CHUNK = 200
+# fewer seconds of throughput than this make for unreliable intervals
+MIN_WINDOWS = 10
+
+
+class Run():
+    """
+    The comparable parts of a single run: what kind of latency it measured,
+    the histogram of those latencies, (as arrays of bucket values in
+    milliseconds and their counts) and the per second throughput.
+    """
+    def __init__(self, path, kind, hist=None, scale=1, series=None, rate=None):
+        self.path = path
+        self.kind = kind
+        self.values = None
+        self.counts = None
+        if hist is not None and hist.count:
+            items = hist.items()
+            self.values = numpy.array([v for v, _ in items]) * scale
+            self.counts = numpy.array([n for _, n in items], dtype=numpy.int64)
+        self.series = None
+        if series is not None and len(series):
+            series = numpy.asarray(series, dtype=numpy.float64)
+            self.series = series[1:-1] if len(series) > 3 else series
+        self.rate = rate
+
+    @property
+    def count(self):
+        return int(self.counts.sum()) if self.counts is not None else 0
+
+    def describe(self):
+        windows = len(self.series) if self.series is not None else 0
+        return "%s (%s, %d latencies, %d seconds of throughput)" % (
+            self.path, self.kind, self.count, windows)
+
+
+def _is_capture(path):
+    with open(path, "rb") as f:
+        return f.read(len(beem.capture.MAGIC)) == beem.capture.MAGIC
+
+
+def _load_capture(path):
+    clients, records = beem.capture.load(path)
+    if not len(records):
+        raise ValueError("Capture file contains no records", path)
+    received = records["received_ns"]
+    flight = (received - records["sent_ns"]) / 1e6
+    series = numpy.bincount((received - received.min()) // 1000000000)
+    time_total = (received.max() - received.min()) / 1e9
+    return Run(path, "subscribe", beem.stats.Histogram.of(flight),
+               series=series, rate=len(records) / time_total if time_total else None)
+
+
+def load_run(path):
+    """
+    Load a run from a capture file, or any malaria --json stats,
+    lists of publish stats, (from --thread_ratio) are merged first.
+    Raises ValueError for anything else.
+    """
+    if numpy is None:
+        raise RuntimeError("numpy is required to compare runs")
+    if _is_capture(path):
+        return _load_capture(path)
+    with open(path, "r") as f:
+        stats = json.load(f)
+    if isinstance(stats, list):
+        merger = beem.merge.StatsMerger()
+        merger.add(stats)
+        stats = merger.result()
+    if "count_ok" in stats:
+        hist = None
+        if "time_histogram" in stats:
+            hist = beem.stats.Histogram.from_dict(stats["time_histogram"])
+        return Run(path, "publish", hist, series=stats.get("msgs_per_sec_series"),
+                   rate=stats["msgs_per_sec"])
+    if "msg_per_sec" in stats:
+        hist = None
+        if "flight_time_histogram" in stats:
+            hist = beem.stats.Histogram.from_dict(stats["flight_time_histogram"])
+        # listeners keep their flight times in seconds
+        return Run(path, "subscribe", hist, scale=1000,
+                   series=stats.get("msg_per_sec_series"),
+                   rate=stats["msg_per_sec"])
+    raise ValueError("Not malaria publish or subscribe stats", path)
+
+
+def _histogram_stats(values, counts, percentiles):
+    """
+    mean and percentiles of one or more histograms, counts can be 2d,
+    with a histogram per row.  Percentiles are picked the same way as
+    Histogram.percentiles()
+    """
+    counts = numpy.atleast_2d(counts)
+    n = counts.sum(axis=1)
+    cum = counts.cumsum(axis=1)
+    rval = numpy.empty((len(counts), len(percentiles) + 1))
+    rval[:, 0] = counts.dot(values) / n
+    for j, p in enumerate(percentiles):
+        idx = (cum < (p / 100 * n)[:, None]).sum(axis=1)
+        rval[:, j + 1] = values[numpy.minimum(idx, len(values) - 1)]
+    return rval
+
+
+def bootstrap_latency(run, percentiles, resamples, rng):
+    """
+    The mean and percentiles of resamples of run's latency histogram.
+    Returns (point estimates, array of (resamples, 1 + len(percentiles)))
+    """
+    point = _histogram_stats(run.values, run.counts, percentiles)[0]
+    n = run.count
+    chunks = []
+    for i in range(0, resamples, CHUNK):
+        size = min(CHUNK, resamples - i)
+        counts = rng.multinomial(n, run.counts / n, size=size)
+        chunks.append(_histogram_stats(run.values, counts, percentiles))
+    return point, numpy.concatenate(chunks)
+
+
+def block_length(n):
+    """Block length for a block bootstrap of n seconds, the usual n^(1/3)"""
+    return max(int(round(n ** (1 / 3))), 1)
+
+
+def bootstrap_throughput(run, resamples, rng):
+    """
+    Mean msgs per second of circular block bootstrap resamples of run's per
+    second series, which keep the correlation between nearby seconds.
+    Returns (point estimate, array of resamples)
+    """
+    series = run.series
+    n = len(series)
+    block = block_length(n)
+    blocks = -(-n // block)
+    starts = rng.integers(0, n, size=(resamples, blocks, 1))
+    idx = ((starts + numpy.arange(block)) % n).reshape(resamples, -1)[:, :n]
+    return series.mean(), series[idx].mean(axis=1)
+
+
+def _row(name, base, cur, base_boot, cur_boot, confidence, min_change,
+         higher_is_better):
+    row = {
+        "name": name,
+        "baseline": float(base),
+        "current": float(cur),
+        "change": float((cur / base - 1) * 100) if base else None,
+        "ci_low": None,
+        "ci_high": None,
+        "significant": None,
+        "better": None
+    }
+    if base_boot is not None and base:
+        # the two runs are independent, so resample them independently
+        changes = (cur_boot / numpy.where(base_boot == 0, numpy.nan, base_boot)
+                   - 1) * 100
+        changes = changes[~numpy.isnan(changes)]
+        tail = (100 - confidence) / 2
+        low, high = numpy.percentile(changes, [tail, 100 - tail])
+        row["ci_low"] = float(low)
+        row["ci_high"] = float(high)
+        row["significant"] = bool(low > min_change or high < -min_change)
+        if row["significant"]:
+            row["better"] = bool(low > 0) == higher_is_better
+    return row
+
+
+def compare(baseline, current, percentiles=DEFAULT_PERCENTILES,
+            resamples=DEFAULT_RESAMPLES, confidence=DEFAULT_CONFIDENCE,
+            seed=None, min_change=DEFAULT_MIN_CHANGE):
+    """
+    Compare two Runs.  Returns a list of rows, one each for throughput,
+    mean latency and each latency percentile, as dicts of
+    name, baseline, current, change (percent), ci_low, ci_high (percent,
+    None if there was nothing to resample) significant, and better.
+    Only changes whose interval is entirely beyond min_change percent
+    either way are significant.
+    """
+    if baseline.kind != current.kind:
+        raise ValueError("Can't compare %s stats to %s stats"
+                         % (baseline.kind, current.kind))
+    rng = numpy.random.default_rng(seed)
+    rows = []
+    if baseline.series is not None and current.series is not None:
+        base, base_boot = bootstrap_throughput(baseline, resamples, rng)
+        cur, cur_boot = bootstrap_throughput(current, resamples, rng)
+        rows.append(_row("throughput", base, cur, base_boot, cur_boot,
+                         confidence, min_change, True))
+    elif baseline.rate is not None and current.rate is not None:
+        rows.append(_row("throughput", baseline.rate, current.rate,
+                         None, None, confidence, min_change, True))
+
+    if baseline.counts is not None and current.counts is not None:
+        base, base_boot = bootstrap_latency(baseline, percentiles, resamples, rng)
+        cur, cur_boot = bootstrap_latency(current, percentiles, resamples, rng)
+        names = ["mean"] + ["p%s" % beem.stats.percentile_key(p)
+                            for p in percentiles]
+        for j, name in enumerate(names):
+            rows.append(_row("latency " + name, base[j], cur[j],
+                             base_boot[:, j], cur_boot[:, j],
+                             confidence, min_change, False))
+    return rows
@@ -0,0 +1,83 @@
+# Copyright (c) 2013, ReMake Electric ehf
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""
+Counters that can be incremented from any number of threads without locks.
+
+Every thread that writes gets its own slot, (a plain list with one entry
+per counter) which only that thread ever modifies, so increments can never
+be lost.  Readers add up all the slots, which is only done at snapshot time,
+so the cost is on the reading side, not in message handlers.
+"""
+
+import threading
+
+
+class Counters():
+    """
+    A fixed set of named counters, with a slot per writing thread.
+
+        counters = Counters(("msgs", "bytes"))
+        MSGS, BYTES = counters.indices("msgs", "bytes")
+        # in the hot path, any thread
+        slot = counters.slot()
+        slot[MSGS] += 1
+        slot[BYTES] += len(payload)
+        # anywhere else
+        counters.totals()    # {"msgs": 1, "bytes": 123}
+    """
+    def __init__(self, names):
+        self.names = tuple(names)
+        self._slots = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def indices(self, *names):
+        return [self.names.index(n) for n in names]
+
+    def slot(self):
+        """The calling thread's slot, created on first use"""
+        try:
+            return self._local.slot
+        except AttributeError:
+            slot = [0] * len(self.names)
+            with self._lock:
+                self._slots.append(slot)
+            self._local.slot = slot
+            return slot
+
+    def add(self, name, n=1):
+        """Convenience for paths where an index lookup doesn't matter"""
+        self.slot()[self.names.index(name)] += n
+
+    def total(self, name):
+        idx = self.names.index(name)
+        return sum(s[idx] for s in list(self._slots))
+
+    def totals(self):
+        """{name: value} summed over every thread's slot"""
+        sums = [0] * len(self.names)
+        for s in list(self._slots):
+            for i, v in enumerate(s):
+                sums[i] += v
+        return dict(zip(self.names, sums))
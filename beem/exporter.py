@@ -0,0 +1,187 @@
+# Copyright (c) 2013, ReMake Electric ehf
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""
+A small HTTP server exposing WatcherStats in the OpenMetrics text format,
+for when a FUSE statistics filesystem is unavailable or inconvenient.
+
+Requests are served one at a time from a single thread, straight from the
+watcher's latest snapshot.
+"""
+
+import logging
+import re
+import threading
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+# "stat" label values for the flight time gauges.  Not "quantile", which
+# OpenMetrics reserves for summaries, and we don't have their _sum
+LATENCY_STATS = ("p50", "p99", "max")
+
+
+def _labels(**kwargs):
+    if not kwargs:
+        return ""
+    pairs = []
+    for k in sorted(kwargs):
+        v = str(kwargs[k]).replace("\\", "\\\\").replace('"', '\\"') \
+            .replace("\n", "\\n")
+        pairs.append('%s="%s"' % (k, v))
+    return "{" + ",".join(pairs) + "}"
+
+
+def _family(lines, name, mtype, desc, samples):
+    """
+    Append a metric family to lines, samples is a list of
+    (labels dict, value).  Counters get the required _total suffix
+    """
+    lines.append("# TYPE %s %s" % (name, mtype))
+    lines.append("# HELP %s %s" % (name, desc))
+    suffix = {"counter": "_total", "info": "_info"}.get(mtype, "")
+    for labels, value in samples:
+        lines.append("%s%s%s %s" % (name, suffix, _labels(**labels), value))
+
+
+def render(snap):
+    """
+    Render a WatcherSnapshot's counters and rates as OpenMetrics text
+    """
+    lines = []
+    _family(lines, "malaria_watch_messages", "counter",
+            "Total number of messages seen since we started",
+            [({}, snap.msgs_total)])
+    _family(lines, "malaria_watch_bytes", "counter",
+            "Total payload bytes seen since we started",
+            [({}, snap.bytes_total)])
+    _family(lines, "malaria_watch_drops", "counter",
+            "Total drops since this watcher has been running",
+            [({}, snap.drop_count)])
+    _family(lines, "malaria_watch_messages_stored", "gauge",
+            "Total number of stored ($sys/broker/messages/stored)",
+            [({}, snap.msgs_stored)])
+    _family(lines, "malaria_watch_uptime_seconds", "gauge",
+            "Time in seconds this watcher has been running",
+            [({}, "%.3f" % snap.uptime)])
+
+    rates = []
+    peaks = []
+    for counter in sorted(snap.rates):
+        for window in sorted(snap.rates[counter]):
+            rates.append(({"counter": counter, "window": "%ds" % window},
+                          "%.3f" % snap.rates[counter][window]))
+        peaks.append(({"counter": counter}, "%.3f" % snap.peaks[counter]))
+    _family(lines, "malaria_watch_rate", "gauge",
+            "Per second rates, exponentially decayed over each window", rates)
+    _family(lines, "malaria_watch_rate_peak", "gauge",
+            "Peak rate over the shortest window since we started", peaks)
+
+    _family(lines, "malaria_watch_topic_messages", "counter",
+            "Messages seen per topic prefix",
+            [({"prefix": p}, m) for p, m, b in snap.topics])
+    _family(lines, "malaria_watch_topic_bytes", "counter",
+            "Payload bytes seen per topic prefix",
+            [({"prefix": p}, b) for p, m, b in snap.topics])
+    _family(lines, "malaria_watch_topics_evicted", "counter",
+            "Number of cold topic prefixes evicted to keep memory bounded",
+            [({}, snap.topics_evicted)])
+    _family(lines, "malaria_watch_broker", "gauge",
+            "Latest value of each broker $SYS metric",
+            [({"metric": name}, repr(history[-1][1]))
+             for name, history in sorted(snap.sys_series.items())])
+    _family(lines, "malaria_watch_timed_messages", "counter",
+            "Messages seen with a send time in their payload",
+            [({}, snap.timed_total)])
+    latency = []
+    for window, row in sorted(snap.latency_all.items()):
+        for stat, value in zip(LATENCY_STATS, row[1:]):
+            latency.append(({"window": "%ds" % window,
+                             "stat": stat}, "%.3f" % value))
+    _family(lines, "malaria_watch_flight_time_ms", "gauge",
+            "Flight time of timed messages over each window", latency)
+    latency = []
+    for window in sorted(snap.latency):
+        for prefix, row in sorted(snap.latency[window].items()):
+            for stat, value in zip(LATENCY_STATS, row[1:]):
+                latency.append(({"window": "%ds" % window, "prefix": prefix,
+                                 "stat": stat}, "%.3f" % value))
+    _family(lines, "malaria_watch_topic_flight_time_ms", "gauge",
+            "Flight time of timed messages over each window, per topic "
+            "prefix", latency)
+    if snap.sys_info:
+        info = dict((re.sub("[^a-zA-Z0-9_]", "_", k), v)
+                    for k, v in snap.sys_info.items())
+        _family(lines, "malaria_watch_broker_sys", "info",
+                "Non numeric broker $SYS topics", [(info, 1)])
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        snap = self.server.watcher.snapshot
+        if self.server.cached[0] != snap.seq:
+            self.server.cached = (snap.seq, render(snap).encode("utf-8"))
+        body = self.server.cached[1]
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        self.server.log.debug(format, *args)
+
+
+class MetricsExporter():
+    """
+    Serves a WatcherStats at http://address/metrics
+
+        exporter = MetricsExporter(watcher, ("", 9100))
+        exporter.start()
+    """
+    def __init__(self, watcher, address):
+        self.log = logging.getLogger(__name__)
+        self.httpd = HTTPServer(address, _MetricsHandler)
+        self.httpd.watcher = watcher
+        # (snapshot seq, rendered body) so we only render once per snapshot
+        self.httpd.cached = (None, None)
+        self.httpd.log = self.log
+        self.address = self.httpd.server_address
+        self._thread = threading.Thread(target=self.httpd.serve_forever)
+        self._thread.daemon = True
+
+    def start(self):
+        self.log.info("Serving metrics on http://%s:%d/metrics",
+                      self.address[0], self.address[1])
+        self._thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
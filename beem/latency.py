@@ -0,0 +1,194 @@
+# Copyright (c) 2013, ReMake Electric ehf
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""
+Passive flight time tracking for "timed" payloads.
+
+Publishers running with --timing start every payload with the time it was
+sent, as "%f," (see beem.msgs.TimeTracking).  Any watcher that sees those
+messages can work out their flight time without knowing anything else about
+the test, as long as the publisher and watcher clocks agree.
+"""
+
+from __future__ import division
+
+import collections
+import threading
+
+from beem.stats import Histogram
+
+# Only look this far into a payload for the timestamp separator
+_MAX_STAMP = 24
+# Ignore anything that "decodes" to a time further than this from now
+_MAX_SKEW = 86400
+
+
+def payload_time(payload, now):
+    """
+    The send time embedded in a timed payload, or None if the payload
+    doesn't look like one.  Cheap enough to try on every message.
+    """
+    comma = payload.find(b"," if isinstance(payload, bytes) else ",",
+                         0, _MAX_STAMP)
+    if comma < 1:
+        return None
+    try:
+        sent = float(payload[:comma])
+    except ValueError:
+        return None
+    if abs(now - sent) > _MAX_SKEW:
+        return None
+    return sent
+
+
+class _Writer():
+    """
+    One observing thread's histograms for the current slot, as
+    (overall histogram, {prefix: histogram}), and the lock that keeps
+    tick() from taking them in the middle of an add.
+    """
+    __slots__ = ("current", "lock")
+
+    def __init__(self):
+        self.current = (Histogram(), {})
+        self.lock = threading.Lock()
+
+
+class PassiveLatency():
+    """
+    Rolling window flight time histograms, overall and per topic prefix.
+
+    Messages are counted in the current "slot" of slot seconds.  Each window
+    is the merge of enough recent slots to cover it.  observe() runs in the
+    paho thread and only adds to a histogram, tick() must be called
+    regularly from elsewhere to rotate slots and summarize the windows.
+    Like beem.counters, every observing thread adds to histograms of its
+    own, which tick() merges.  Each thread's lock is only ever taken by it
+    and by tick(), once a slot, to swap its histograms for fresh ones.
+
+    At most max_prefixes prefixes (of prefix_depth topic levels) are
+    tracked, later ones are only counted in the overall histograms.
+    The overall stats are kept apart from the prefixes, as "" is a prefix
+    too, of topics starting with "/".
+    """
+    def __init__(self, windows=(10, 60), slot=1.0, prefix_depth=1,
+                 max_prefixes=100):
+        self.windows = windows
+        self.slot = slot
+        self.prefix_depth = prefix_depth
+        self.max_prefixes = max_prefixes
+        self._prefixes = set()
+        self._writers = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._slots = collections.deque(maxlen=int(max(windows) / slot))
+        self._slot_start = None
+        self.overall = {}
+        self.summary = {}
+
+    def observe(self, topic, payload, now):
+        """
+        Record the flight time of a message, if it is timed.
+        Returns True if it was.
+        """
+        sent = payload_time(payload, now)
+        if sent is None:
+            return False
+        flight = (now - sent) * 1000
+        prefix = "/".join(topic.split("/", self.prefix_depth)[:self.prefix_depth])
+        writer = self._writer()
+        with writer.lock:
+            overall, current = writer.current
+            overall.add(flight)
+            if prefix not in self._prefixes:
+                if len(self._prefixes) >= self.max_prefixes:
+                    return True
+                self._prefixes.add(prefix)
+            h = current.get(prefix, None)
+            if h is None:
+                h = current[prefix] = Histogram()
+            h.add(flight)
+        return True
+
+    def _writer(self):
+        """The calling thread's _Writer, created on first use"""
+        try:
+            return self._local.writer
+        except AttributeError:
+            writer = _Writer()
+            with self._lock:
+                self._writers.append(writer)
+            self._local.writer = writer
+            return writer
+
+    def tick(self, now):
+        """
+        Rotate the current slot if it has finished, and recalculate the
+        window summaries if so.
+        """
+        if self._slot_start is None:
+            self._slot_start = now
+        if now - self._slot_start < self.slot:
+            return
+        self._slot_start = now
+        finished_all = Histogram()
+        finished = {}
+        for writer in list(self._writers):
+            with writer.lock:
+                overall, current = writer.current
+                writer.current = (Histogram(), {})
+            finished_all.merge(overall)
+            for prefix, h in current.items():
+                if prefix not in finished:
+                    finished[prefix] = Histogram()
+                finished[prefix].merge(h)
+        self._slots.append((finished_all, finished))
+        self._summarize()
+
+    def _summarize(self):
+        """
+        Set .overall to {window: (count, p50, p99, max)} and .summary to
+        {window: {prefix: (count, p50, p99, max)}}, in milliseconds
+        """
+        overall = {}
+        summary = {}
+        slots = list(self._slots)
+        for window in self.windows:
+            merged_all = Histogram()
+            merged = {}
+            for slot_all, slot in slots[-int(window / self.slot):]:
+                merged_all.merge(slot_all)
+                for prefix, h in slot.items():
+                    if prefix not in merged:
+                        merged[prefix] = Histogram()
+                    merged[prefix].merge(h)
+            if merged_all.count:
+                overall[window] = _row(merged_all)
+            summary[window] = dict((prefix, _row(h))
+                                   for prefix, h in merged.items())
+        self.overall = overall
+        self.summary = summary
+
+
+def _row(h):
+    return (h.count,) + tuple(h.percentiles([50, 99])) + (h.max,)
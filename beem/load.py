@@ -29,14 +29,97 @@ statistics on the results of publishing that stream.
 
 from __future__ import division
 
+import collections
 import logging
-import math
+import ssl
+import threading
 import time
 
 import paho.mqtt.client as mqtt
 
+import beem
+import beem.msgs
+import beem.stats
+from beem.overhead import SelfOverhead
+from beem.rates import Ticker
 from beem.trackers import SentMessage as MsgStatus
 
+# How long to wait for our subscription, and for deliveries to catch up
+DELIVERY_TIMEOUT = 10
+
+
+def psk_supported():
+    """Can we do TLS-PSK ourselves? (python 3.13 and up, with OpenSSL PSK)"""
+    return (getattr(ssl, "HAS_PSK", False) and
+            hasattr(ssl.SSLContext, "set_psk_client_callback"))
+
+
+def psk_context(auth):
+    """
+    An SSLContext for TLS-PSK, from an "identity:hexkey" string, as found
+    in mosquitto psk_files.  PSK means no certificates, so nothing to verify.
+    """
+    if not psk_supported():
+        raise Exception("TLS-PSK needs python 3.13 or later, built with "
+                        "PSK support.  Use a bridge (-b) instead")
+    identity, key = auth.strip().split(":")
+    key = bytes.fromhex(key)
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    # mosquitto only offers PSK ciphersuites up to TLS 1.2
+    ctx.maximum_version = ssl.TLSVersion.TLSv1_2
+    ctx.set_ciphers("PSK")
+    ctx.set_psk_client_callback(lambda hint: (identity, key))
+    return ctx
+
+
+def round_trip_topic(options, cid):
+    """The round trip subscription for cid, if options ask for one"""
+    if not getattr(options, "round_trip", False):
+        return None
+    return options.round_trip_topic.format(cid=cid)
+
+
+class _WriteTimedQueue(collections.deque):
+    """paho's out packet queue, remembering which packet is being written"""
+    current = None
+
+    def popleft(self):
+        self.current = collections.deque.popleft(self)
+        return self.current
+
+
+class WriteTimedClient(mqtt.Client):
+    """
+    A paho client that also calls on_write(mid) as soon as each PUBLISH has
+    been completely written to the socket.  This leans on paho internals,
+    (the _out_packet queue and _sock_send) so check WRITE_TIMING before
+    relying on it.
+    """
+    on_write = None
+
+    # paho replaces the queue on (re)connect, so wrap whatever it sets
+    @property
+    def _out_packet(self):
+        return self._timed_out_packet
+
+    @_out_packet.setter
+    def _out_packet(self, queue):
+        self._timed_out_packet = _WriteTimedQueue(queue)
+
+    def _sock_send(self, buf):
+        written = mqtt.Client._sock_send(self, buf)
+        packet = self._timed_out_packet.current
+        if (self.on_write and packet is not None
+                and written == packet["to_process"]
+                and packet["command"] & 0xF0 == mqtt.PUBLISH):
+            self.on_write(packet["mid"])
+        return written
+
+
+WRITE_TIMING = hasattr(mqtt.Client, "_sock_send")
+
 
 class TrackingSender():
     """
@@ -49,6 +132,21 @@ class TrackingSender():
 
     This is a _single_ publisher, it's not a huge load testing thing by itself.
 
+    auth, if given, is a "identity:hexkey" pair to connect with TLS-PSK.
+
+    Each message is timed from just before publish() is called, and also
+    when it finished being written to the socket, (if WRITE_TIMING) so ack
+    times can be split into time queued in our own client, and time on
+    the network and in the broker.  paho's out queue depth is sampled every
+    second too, along with our own cpu and memory use, see SelfOverhead.
+
+    round_trip_topic, if given, is a topic filter matching where our own
+    messages are delivered, (our own topic, or a paired one, if something
+    republishes them) which we subscribe to, on this connection, or on a
+    second one with round_trip_separate.  Deliveries are matched to sends
+    by the sequence number in the second last topic level, and delivery
+    latency is recorded alongside ack latency, all on our own clock.
+
     Example:
       cid = "Test-clientid-%d" % os.getpid()
       ts = TrackingSender("mqtt.example.org", 1883, cid)
@@ -58,30 +156,121 @@ class TrackingSender():
       print(stats["rate_ok"])
       print(stats["time_stddev"])
     """
-    msg_statuses = {}
-
-    def __init__(self, host, port, cid):
+    def __init__(self, host, port, cid, auth=None,
+                 round_trip_topic=None, round_trip_separate=False):
         self.cid = cid
         self.log = logging.getLogger(__name__ + ":" + cid)
-        self.mqttc = mqtt.Client(cid)
+        # only messages still waiting for an ack, by mid, as paho reuses
+        # mids once they wrap at 65535, so count publishes separately
+        self.msg_statuses = {}
+        self.publish_count = 0
+        # flight times (ms) and ack timestamps, recorded as acks arrive
+        self.flight_times = beem.stats.Samples()
+        self.ack_times = beem.stats.Samples()
+        # socket write times by mid, and the times they split acks into
+        self.write_times = {}
+        self._ack_lock = threading.Lock()
+        self._early_acks = {}
+        self.queue_times = beem.stats.Samples()
+        self.wire_times = beem.stats.Samples()
+        self.out_queue_series = []
+        self.overhead = SelfOverhead()
+        self.mqttc = self._connect(host, port, cid, auth,
+                                   WriteTimedClient if WRITE_TIMING else mqtt.Client)
         self.mqttc.on_publish = self.publish_handler
+        self.mqttc.on_write = self.write_handler
+        self.round_trip_topic = round_trip_topic
+        self.rt_client = None
+        if round_trip_topic:
+            # sequence number -> MsgStatus, and delivery times (ms)
+            self.sent_seqs = {}
+            self.delivered = set()
+            self._delivery_lock = threading.Lock()
+            self._early_deliveries = {}
+            self.delivery_times = beem.stats.Samples()
+            self.delivery_duplicates = 0
+            self.subscribed = threading.Event()
+            if round_trip_separate:
+                self.rt_client = self._connect(host, port, cid + "-rt", auth)
+            rtc = self.rt_client or self.mqttc
+            rtc.on_message = self.delivery_handler
+            rtc.on_subscribe = lambda *args: self.subscribed.set()
+        self.mqttc.loop_start()
+        if self.rt_client:
+            self.rt_client.loop_start()
+
+    def _connect(self, host, port, cid, auth, client_class=mqtt.Client):
+        mqttc = client_class(cid)
         # TODO - you _probably_ want to tweak this
-        if hasattr(self.mqttc, "max_inflight_messages_set"):
-            self.mqttc.max_inflight_messages_set(200)
-        rc = self.mqttc.connect(host, port, 60)
+        if hasattr(mqttc, "max_inflight_messages_set"):
+            mqttc.max_inflight_messages_set(200)
+        if auth:
+            mqttc.tls_set_context(psk_context(auth))
+        rc = mqttc.connect(host, port, 60)
         if rc:
             raise Exception("Couldn't even connect! ouch! rc=%d" % rc)
             # umm, how?
-        self.mqttc.loop_start()
+        return mqttc
+
+    def write_handler(self, mid):
+        self.write_times.setdefault(mid, time.time())
+
+    def _sample(self):
+        self.overhead.sample()
+        self.out_queue_series.append(
+            (time.time() - self.time_start,
+             len(getattr(self.mqttc, "_out_packet", ())),
+             len(getattr(self.mqttc, "_out_messages", ()))))
+
+    def delivery_handler(self, mosq, userdata, msg):
+        now = time.time()
+        try:
+            seq = int(msg.topic.split("/")[-2])
+        except (IndexError, ValueError):
+            self.log.warn("Can't find a sequence number in %s", msg.topic)
+            return
+        with self._delivery_lock:
+            handle = self.sent_seqs.get(seq)
+            if handle is None:
+                # delivered before run() saved it, run() will pick this up
+                if seq in self._early_deliveries:
+                    self.delivery_duplicates += 1
+                else:
+                    self._early_deliveries[seq] = now
+                return
+            self._delivered(seq, handle, now)
+
+    def _delivered(self, seq, handle, time_delivered):
+        if seq in self.delivered:
+            self.delivery_duplicates += 1
+            return
+        self.delivered.add(seq)
+        self.delivery_times.append((time_delivered - handle.time_created) * 1000)
 
     def publish_handler(self, mosq, userdata, mid):
+        time_received = time.time()
+        self._publish_handler(mid, time_received)
+        self.overhead.callback_time += time.time() - time_received
+        self.overhead.callback_count += 1
+
+    def _publish_handler(self, mid, time_received):
         self.log.debug("Received confirmation of mid %d", mid)
-        handle = self.msg_statuses.get(mid, None)
-        while not handle:
-            self.log.warn("Received a publish for mid: %d before we saved its creation", mid)
-            time.sleep(0.5)
-            handle = self.msg_statuses.get(mid, None)
-        handle.receive()
+        with self._ack_lock:
+            handle = self.msg_statuses.pop(mid, None)
+            if handle is None:
+                # acked before run() saved it, run() will pick this up
+                self._early_acks[mid] = time_received
+                return
+        self._acked(mid, handle, time_received)
+
+    def _acked(self, mid, handle, time_received):
+        handle.receive(time_received)
+        self.flight_times.append(handle.time_flight() * 1000)
+        self.ack_times.append(handle.time_received)
+        written = self.write_times.pop(mid, None)
+        if written is not None:
+            self.queue_times.append((written - handle.time_created) * 1000)
+            self.wire_times.append((handle.time_received - written) * 1000)
 
     def run(self, msg_generator, qos=1):
         """
@@ -91,53 +280,179 @@ class TrackingSender():
         This process blocks until _all_ published messages have been acked by
         the publishing library.
         """
-        publish_count = 0
+        if self.round_trip_topic:
+            (self.rt_client or self.mqttc).subscribe(self.round_trip_topic, qos)
+            if not self.subscribed.wait(DELIVERY_TIMEOUT):
+                self.log.warn("No suback for %s, deliveries may be missed",
+                              self.round_trip_topic)
         self.time_start = time.time()
-        for _, topic, payload in msg_generator:
+        self.overhead.start()
+        sampler = Ticker(1, self._sample)
+        sampler.start()
+        msg_generator = iter(msg_generator)
+        while True:
+            time_next = time.time()
+            try:
+                seq, topic, payload = next(msg_generator)
+            except StopIteration:
+                self.overhead.generator_time += time.time() - time_next
+                break
+            time_enqueued = time.time()
             result, mid = self.mqttc.publish(topic, payload, qos)
             assert(result == 0)
-            self.msg_statuses[mid] = MsgStatus(mid, len(payload))
-            publish_count += 1
-        self.log.info("Finished publish %d msgs at qos %d", publish_count, qos)
-
-        finished = False
-        while not finished:
-            missing = [x for x in self.msg_statuses.values() if not x.received]
-            finished = len(missing) == 0
-            if finished:
-                break
-            mc = len(missing)
-            self.log.info("Still waiting for %d messages to be confirmed.", mc)
-            time.sleep(2)  # This is too long for short tests.
-            for x in missing:
-                self.log.debug(x)
+            handle = MsgStatus(mid, len(payload), time_enqueued)
+            # never held while calling paho, which has locks of its own
+            with self._ack_lock:
+                time_acked = self._early_acks.pop(mid, None)
+                if time_acked is None:
+                    self.msg_statuses[mid] = handle
+            if time_acked is not None:
+                self._acked(mid, handle, time_acked)
+            if self.round_trip_topic:
+                with self._delivery_lock:
+                    self.sent_seqs[seq] = handle
+                    time_delivered = self._early_deliveries.pop(seq, None)
+                    if time_delivered is not None:
+                        self._delivered(seq, handle, time_delivered)
+            self.publish_count += 1
+            self.overhead.generator_time += time_enqueued - time_next
+            self.overhead.publish_time += time.time() - time_enqueued
+        self.overhead.stop()
+        self.log.info("Finished publish %d msgs at qos %d",
+                      self.publish_count, qos)
+        if self.overhead.saturated():
+            self.log.warn("Publishing used %d%% cpu, this publisher is probably "
+                          "the bottleneck, don't trust these results!",
+                          100 * max(self.overhead.process_cpu,
+                                    self.overhead.cpu or 0))
+
+        # every publish gets exactly one ack, so just compare counts
+        last_log = time.time()
+        while len(self.flight_times) < self.publish_count:
+            time.sleep(0.05)
+            if time.time() - last_log >= 2:
+                last_log = time.time()
+                with self._ack_lock:
+                    missing = list(self.msg_statuses.values())
+                self.log.info("Still waiting for %d messages to be confirmed.",
+                              self.publish_count - len(self.flight_times))
+                for x in missing:
+                    self.log.debug(x)
             # FIXME - needs an escape clause here for giving up on messages?
+        if self.round_trip_topic:
+            self._wait_delivered()
         self.time_end = time.time()
+        sampler.stop()
         self.mqttc.loop_stop()
         time.sleep(1)
         self.mqttc.disconnect()
+        if self.rt_client:
+            self.rt_client.loop_stop()
+            self.rt_client.disconnect()
+
+    def _wait_delivered(self):
+        give_up = time.time() + DELIVERY_TIMEOUT
+        while len(self.delivered) < len(self.sent_seqs):
+            if time.time() > give_up:
+                self.log.warn("Gave up waiting for %d deliveries",
+                              len(self.sent_seqs) - len(self.delivered))
+                break
+            time.sleep(0.1)
+        if self._early_deliveries:
+            self.log.warn("Deliveries of %d seqs that we never sent",
+                          len(self._early_deliveries))
 
     def stats(self):
         """
         Generate a set of statistics for the set of message responses.
-        count, success rate, min/max/mean/stddev are all generated.
+        count, success rate, min/max/mean/stddev and percentiles are all
+        generated, along with the acked message rate for each second.
         """
-        successful = [x for x in self.msg_statuses.values() if x.received]
-        rate = len(successful) / len(self.msg_statuses)
+        count_ok = len(self.flight_times)
+        count_total = self.publish_count
         # Let's work in milliseconds now
-        times = [x.time_flight() * 1000 for x in successful]
-        mean = sum(times) / len(times)
-        squares = [x * x for x in [q - mean for q in times]]
-        stddev = math.sqrt(sum(squares) / len(times))
-        return {
+        summary = beem.stats.summarize(self.flight_times)
+        rval = {
             "clientid": self.cid,
-            "count_ok": len(successful),
-            "count_total": len(self.msg_statuses),
-            "rate_ok": rate,
-            "time_mean": mean,
-            "time_min": min(times),
-            "time_max": max(times),
-            "time_stddev": stddev,
-            "msgs_per_sec": len(successful) / (self.time_end - self.time_start),
+            "count_ok": count_ok,
+            "count_total": count_total,
+            "rate_ok": count_ok / count_total,
+            "time_mean": summary["mean"],
+            "time_min": summary["min"],
+            "time_max": summary["max"],
+            "time_stddev": summary["stddev"],
+            "time_percentiles": summary["percentiles"],
+            "msgs_per_sec": count_ok / (self.time_end - self.time_start),
+            "msgs_per_sec_series": beem.stats.per_second(self.ack_times,
+                                                         self.time_start),
+            "time_histogram": beem.stats.Histogram.of(self.flight_times).to_dict(),
+            "time_start": self.time_start,
+            "time_end": self.time_end,
             "time_total": self.time_end - self.time_start
         }
+        for prefix, samples in (("queue_time", self.queue_times),
+                                ("wire_time", self.wire_times)):
+            rval.update(beem.histogram_stats(
+                prefix, beem.stats.Histogram.of(samples)))
+        rval.update(self.overhead.stats())
+        if self.out_queue_series:
+            rval["out_queue_series"] = self.out_queue_series
+            rval["out_packets_max"] = max(x[1] for x in self.out_queue_series)
+            rval["out_messages_max"] = max(x[2] for x in self.out_queue_series)
+        if self.round_trip_topic:
+            rval["delivery_count"] = len(self.delivery_times)
+            rval.update(beem.histogram_stats(
+                "delivery", beem.stats.Histogram.of(self.delivery_times)))
+            rval["delivery_missing"] = len(self.sent_seqs) - len(self.delivered)
+            rval["delivery_duplicates"] = self.delivery_duplicates
+        return rval
+
+
+class _ThreadedWorker(threading.Thread):
+    def __init__(self, options, label, auth=None):
+        threading.Thread.__init__(self)
+        self.options = options
+        self.label = label
+        self.auth = auth
+
+    def run(self):
+        # This is probably what you want for psk setups with ACLs
+        if self.auth:
+            cid = self.auth.split(":")[0]
+        else:
+            cid = self.label
+        ts = TrackingSender(self.options.host, self.options.port,
+                            "ts_" + self.label, self.auth,
+                            round_trip_topic(self.options, cid),
+                            getattr(self.options, "round_trip_separate", False))
+        ts.run(beem.msgs.createGenerator(cid, self.options), self.options.qos)
+        self.stats = ts.stats()
+
+
+class ThreadedTrackingSender():
+    """
+    Like beem.bridge.ThreadedBridgingSender, runs options.thread_ratio
+    TrackingSenders in threads, but connecting directly to the target,
+    optionally with TLS-PSK.  auth should be a list of "identity:key"
+    strings, one per thread.
+    """
+    def __init__(self, options, proc_num, auth=None):
+        self.options = options
+        self.cid_base = options.clientid
+        self.ratio = options.thread_ratio
+        self.log = logging.getLogger(__name__ + ":" + self.cid_base)
+        if auth:
+            assert len(auth) == self.ratio
+        self.workers = [
+            _ThreadedWorker(options, "%s_%d_%d" % (self.cid_base, proc_num, x),
+                            auth[x].strip() if auth else None)
+            for x in range(self.ratio)]
+
+    def run(self):
+        for t in self.workers:
+            t.start()
+        self.stats = []
+        for t in self.workers:
+            t.join()
+            self.stats.append(t.stats)
+            self.log.debug("stats were %s", t.stats)
@@ -48,6 +48,15 @@ def main():
     beem.cmds.subscribe.add_args(subparsers)
     beem.cmds.keygen.add_args(subparsers)
     beem.cmds.watch.add_args(subparsers)
+    beem.cmds.analyze.add_args(subparsers)
+    beem.cmds.report.add_args(subparsers)
+    beem.cmds.bench.add_args(subparsers)
+    beem.cmds.coordinator.add_args(subparsers)
+    beem.cmds.agent.add_args(subparsers)
+    beem.cmds.scenario.add_args(subparsers)
+    beem.cmds.merge.add_args(subparsers)
+    beem.cmds.selftest.add_args(subparsers)
+    beem.cmds.compare.add_args(subparsers)
 
     options = parser.parse_args()
     options.handler(options)
@@ -0,0 +1,257 @@
+# Copyright (c) 2013, ReMake Electric ehf
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""
+Combine "malaria publish --json" outputs from many nodes into swarm wide
+stats.  Files are read one at a time, and folded into running totals, so
+any number of them can be merged in constant memory.
+
+Inputs with a time_histogram (all publishers since they started writing
+one) give exact swarm wide latency distributions.  Older inputs without
+one can still be merged, but their latencies are only weighted averages,
+and the result is marked with "time_exact": False.
+"""
+
+from __future__ import division
+
+import json
+import logging
+import os
+
+import beem
+import beem.stats
+
+# Self overhead keys that are simply summed
+OVERHEAD_TOTALS = ("self_generator_time", "self_publish_time",
+                   "self_callback_time", "self_callback_count",
+                   "self_sleep_time")
+# and those that are averaged over the publishers that have them
+OVERHEAD_MEANS = ("self_cpu", "self_process_cpu")
+
+
+def input_files(paths):
+    """Yield every file in paths, and every .json file in any directories"""
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith(".json"):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+
+class StatsMerger():
+    """
+    Running totals over any number of publish stats dicts.
+
+        m = StatsMerger()
+        for path in paths:
+            m.add_file(path)
+        beem.print_publish_stats(m.result())
+    """
+    def __init__(self):
+        self.log = logging.getLogger(__name__)
+        self.files = 0
+        self.count = 0
+        self.count_ok = 0
+        self.count_total = 0
+        self.msgs_per_sec = 0
+        self.time_start = None
+        self.time_end = None
+        self.time_total = 0
+        self.hist = beem.stats.Histogram()
+        self.exact = True
+        # count_ok weighted sums, for inputs without histograms
+        self._weighted = {"time_mean": 0, "time_sq": 0}
+        self._weighted_pcts = {}
+        self._min = None
+        self._max = None
+        self.bridge = {}
+        self.delivery = {}
+        self.hists = dict((prefix, beem.stats.Histogram()) for prefix in
+                          ("delivery", "self_lateness") + beem.SEGMENTS)
+        self.overhead = {}
+        self.overhead_count = 0
+        # key -> [sum, count]
+        self._overhead_means = dict((k, [0, 0]) for k in OVERHEAD_MEANS)
+        # every input's msgs_per_sec_series, summed as they come, and
+        # starting at series_start, the earliest time_start so far
+        self.series = []
+        self.series_start = None
+        self.series_complete = True
+
+    def add_file(self, path):
+        with open(path, "r") as f:
+            stats = json.load(f)
+        self.files += 1
+        self.add(stats)
+
+    def add(self, stats):
+        """Add a stats dict, or a list of them, as from --thread_ratio"""
+        if isinstance(stats, list):
+            for s in stats:
+                self.add(s)
+            return
+        if "count_ok" not in stats:
+            raise ValueError("Not publish stats: %s" % stats.get("clientid"))
+        self.count += 1
+        n = stats["count_ok"]
+        self.count_ok += n
+        self.count_total += stats["count_total"]
+        self.msgs_per_sec += stats["msgs_per_sec"]
+        self.time_total = max(self.time_total, stats.get("time_total", 0))
+        if "time_start" in stats:
+            if self.time_start is None or stats["time_start"] < self.time_start:
+                self.time_start = stats["time_start"]
+            if self.time_end is None or stats["time_end"] > self.time_end:
+                self.time_end = stats["time_end"]
+        if "msgs_per_sec_series" in stats and "time_start" in stats:
+            self._add_series(stats["time_start"], stats["msgs_per_sec_series"])
+        else:
+            self.series_complete = False
+            self.series = []
+
+        if "time_histogram" in stats:
+            self.hist.merge(beem.stats.Histogram.from_dict(stats["time_histogram"]))
+        elif n:
+            self.exact = False
+        if n:
+            mean = stats["time_mean"]
+            self._weighted["time_mean"] += mean * n
+            self._weighted["time_sq"] += (stats["time_stddev"] ** 2 + mean ** 2) * n
+            for k, v in stats.get("time_percentiles", {}).items():
+                self._weighted_pcts[k] = self._weighted_pcts.get(k, 0) + v * n
+            if self._min is None or stats["time_min"] < self._min:
+                self._min = stats["time_min"]
+            if self._max is None or stats["time_max"] > self._max:
+                self._max = stats["time_max"]
+        self._add_bridge(stats)
+        self._add_delivery(stats)
+
+    def _add_series(self, time_start, series):
+        """Sum series into the running one, as beem.merge_series() does"""
+        if not self.series_complete:
+            return
+        if self.series_start is None:
+            self.series_start = time_start
+        if time_start < self.series_start:
+            shift = int(round(self.series_start - time_start))
+            self.series[:0] = [0.0] * shift
+            self.series_start -= shift
+        offset = int(round(time_start - self.series_start))
+        if offset + len(series) > len(self.series):
+            self.series.extend([0.0] * (offset + len(series) - len(self.series)))
+        for i, v in enumerate(series):
+            self.series[offset + i] += v
+
+    def _add_bridge(self, stats):
+        for k in ("bridge_queue_max", "bridge_rtt_max"):
+            if stats.get(k) is not None:
+                self.bridge[k] = max(self.bridge.get(k, 0), stats[k])
+        if "bridge_disconnects" in stats:
+            self.bridge["bridge_disconnects"] = (
+                self.bridge.get("bridge_disconnects", 0)
+                + stats["bridge_disconnects"])
+
+    def _add_delivery(self, stats):
+        for k in ("delivery_count", "delivery_missing", "delivery_duplicates"):
+            if k in stats:
+                self.delivery[k] = self.delivery.get(k, 0) + stats[k]
+        for k in ("out_packets_max", "out_messages_max"):
+            if k in stats:
+                self.delivery[k] = max(self.delivery.get(k, 0), stats[k])
+        if "self_generator_time" in stats:
+            self.overhead_count += 1
+            for k in OVERHEAD_TOTALS:
+                self.overhead[k] = self.overhead.get(k, 0) + stats[k]
+            for k, acc in self._overhead_means.items():
+                if stats.get(k) is not None:
+                    acc[0] += stats[k]
+                    acc[1] += 1
+            if stats.get("self_rss_max"):
+                self.overhead["self_rss_max"] = max(
+                    self.overhead.get("self_rss_max", 0), stats["self_rss_max"])
+            self.overhead["self_saturated"] = (
+                self.overhead.get("self_saturated") or stats["self_saturated"])
+        for prefix, hist in self.hists.items():
+            if prefix + "_histogram" in stats:
+                hist.merge(beem.stats.Histogram.from_dict(
+                    stats[prefix + "_histogram"]))
+
+    def result(self):
+        """Swarm wide stats, in the same form as the inputs"""
+        if not self.count:
+            raise ValueError("Nothing to merge")
+        rval = {
+            "clientid": "Merged stats for %d results from %d files"
+                        % (self.count, self.files),
+            "count_ok": self.count_ok,
+            "count_total": self.count_total,
+            "rate_ok": self.count_ok / self.count_total if self.count_total else 1,
+            "time_exact": self.exact,
+        }
+        if self.time_start is not None:
+            # everyone ran at once, so the rate is over the whole window
+            rval["time_start"] = self.time_start
+            rval["time_end"] = self.time_end
+            rval["time_total"] = self.time_end - self.time_start
+            rval["msgs_per_sec"] = self.count_ok / rval["time_total"]
+        else:
+            rval["time_total"] = self.time_total
+            rval["msgs_per_sec"] = self.msgs_per_sec
+
+        if self.exact and self.hist.count:
+            summary = self.hist.summary()
+            rval["time_mean"] = summary["mean"]
+            rval["time_stddev"] = summary["stddev"]
+            rval["time_min"] = summary["min"]
+            rval["time_max"] = summary["max"]
+            rval["time_percentiles"] = summary["percentiles"]
+            rval["time_histogram"] = self.hist.to_dict()
+        elif self.count_ok:
+            self.log.warn("Some inputs have no histogram, latencies are "
+                          "weighted averages, not exact")
+            mean = self._weighted["time_mean"] / self.count_ok
+            var = self._weighted["time_sq"] / self.count_ok - mean ** 2
+            rval["time_mean"] = mean
+            rval["time_stddev"] = max(var, 0) ** 0.5
+            rval["time_min"] = self._min
+            rval["time_max"] = self._max
+            rval["time_percentiles"] = dict(
+                (k, v / self.count_ok) for k, v in self._weighted_pcts.items())
+        else:
+            rval.update(time_mean=0, time_stddev=0, time_min=0, time_max=0,
+                        time_percentiles={})
+        rval.update(self.bridge)
+        # these only ever came with histograms, so are always exact
+        rval.update(self.delivery)
+        for prefix, hist in self.hists.items():
+            rval.update(beem.histogram_stats(prefix, hist))
+        if self.overhead_count:
+            rval.update(self.overhead)
+            # mean per publisher, like aggregate_publish_stats
+            for k, (total, n) in self._overhead_means.items():
+                rval[k] = total / n if n else None
+        if self.series and self.series_complete:
+            rval["msgs_per_sec_series"] = self.series
+        return rval
@@ -28,6 +28,8 @@ import string
 import random
 import time
 
+import beem.overhead
+
 
 def GaussianSize(cid, sequence_size, target_size):
     """
@@ -61,7 +63,7 @@ def RateLimited(generator, msgs_per_sec):
     """
     for x in generator:
         yield x
-        time.sleep(1 / msgs_per_sec)
+        beem.overhead.pace(1 / msgs_per_sec)
 
 
 def JitteryRateLimited(generator, msgs_per_sec, jitter=0.1):
@@ -74,7 +76,7 @@ def JitteryRateLimited(generator, msgs_per_sec, jitter=0.1):
         yield x
         desired = 1 / msgs_per_sec
         extra = random.uniform(-1 * jitter * desired, 1 * jitter * desired)
-        time.sleep(desired + extra)
+        beem.overhead.pace(desired + extra)
 
 
 def createGenerator(label, options, index=None):
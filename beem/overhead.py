@@ -0,0 +1,154 @@
+# Copyright (c) 2013, ReMake Electric ehf
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""
+Accounting for where a publisher's own time goes, so an overloaded attack
+node can be told apart from an overloaded broker.
+
+Rate limited generators sleep with pace(), which tells the SelfOverhead
+active on the current thread (if any) how long it slept, and how late it
+woke up.  Everything else is recorded by the publisher itself.
+"""
+
+from __future__ import division
+
+import os
+import threading
+import time
+
+import beem
+import beem.stats
+
+# Publishing faster than this share of a cpu means the publisher, not the
+# broker, is probably what's being measured.  (One core, thanks to the GIL)
+SATURATED = 0.9
+
+_active = threading.local()
+
+
+def pace(delay):
+    """Sleep for delay seconds, on behalf of any active SelfOverhead"""
+    start = time.time()
+    time.sleep(max(delay, 0))
+    overhead = getattr(_active, "overhead", None)
+    if overhead is not None:
+        overhead.slept(start, delay, time.time())
+
+
+def _rss():
+    """Current resident set size in bytes, or None if we can't tell"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _cpu():
+    t = os.times()
+    return t[0] + t[1]
+
+
+if hasattr(time, "thread_time"):
+    _thread_cpu = time.thread_time
+else:
+    _thread_cpu = None
+
+
+class SelfOverhead():
+    """
+    Where a single publisher's time went.  Call start() on the publishing
+    thread, count each generator step and publish() call, and each ack
+    callback, sample() every so often, and stop() when done publishing.
+    Everything is plain sums, apart from a histogram of scheduler lateness.
+
+    cpu is the publishing thread's own share of a cpu, (None before python
+    3.7, which can't tell) and process_cpu the whole process's, which with
+    several publisher threads is shared between them, as is the series.
+    """
+    def __init__(self):
+        self.generator_time = 0
+        self.publish_time = 0
+        self.callback_time = 0
+        self.callback_count = 0
+        self.sleep_time = 0
+        self.lateness = beem.stats.Histogram()
+        self.series = []
+        self.rss_max = None
+        self.time_start = None
+        self.time_end = None
+
+    def start(self):
+        _active.overhead = self
+        self.time_start = time.time()
+        self._cpu_start = self._cpu_last = _cpu()
+        self._last = self.time_start
+        if _thread_cpu:
+            self._thread_cpu_start = _thread_cpu()
+
+    def stop(self):
+        _active.overhead = None
+        self.time_end = time.time()
+        elapsed = self.time_end - self.time_start
+        self.process_cpu = (_cpu() - self._cpu_start) / elapsed
+        self.cpu = None
+        if _thread_cpu:
+            self.cpu = (_thread_cpu() - self._thread_cpu_start) / elapsed
+
+    def slept(self, start, delay, end):
+        self.sleep_time += end - start
+        self.lateness.add((end - start - delay) * 1000)
+
+    def sample(self):
+        """cpu share since the last sample, and rss, into the series"""
+        now = time.time()
+        cpu = _cpu()
+        rss = _rss()
+        if rss is not None:
+            self.rss_max = max(rss, self.rss_max or 0)
+        share = (cpu - self._cpu_last) / max(now - self._last, 1e-6)
+        self.series.append((now - self.time_start, share, rss))
+        self._cpu_last = cpu
+        self._last = now
+
+    def saturated(self):
+        # the GIL makes the whole process share one cpu
+        return max(self.process_cpu, self.cpu or 0) >= SATURATED
+
+    def stats(self):
+        """self_* keys for a publisher's stats"""
+        rval = {
+            # time in next(), less the time the rate limiter slept
+            "self_generator_time": self.generator_time - self.sleep_time,
+            "self_publish_time": self.publish_time,
+            "self_callback_time": self.callback_time,
+            "self_callback_count": self.callback_count,
+            "self_sleep_time": self.sleep_time,
+            "self_cpu": self.cpu,
+            "self_process_cpu": self.process_cpu,
+            "self_rss_max": self.rss_max,
+            "self_series": self.series,
+            "self_saturated": self.saturated()
+        }
+        rval.update(beem.histogram_stats("self_lateness", self.lateness))
+        return rval
@@ -0,0 +1,173 @@
+# Copyright (c) 2013, ReMake Electric ehf
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""
+A low overhead sampling profiler for publish and subscribe workers.
+
+cProfile only sees the thread that started it, but most of a worker's
+time is spent in paho's network thread and our callbacks in it.  Instead,
+every interval seconds, the stack of every other thread is sampled, and
+at the end, the counts are saved in the same format as cProfile, so the
+files work with pstats, snakeviz, gprof2dot and friends, and profiles from
+many workers can be merged with pstats.Stats.add()
+
+Times are wall clock, so waiting (select, sleep, locks) shows up too.
+Call counts are sample counts, not real calls.
+"""
+
+from __future__ import division
+
+import collections
+import io
+import logging
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+
+# 200 samples a second is plenty, and costs a few percent at most
+DEFAULT_INTERVAL = 0.005
+
+
+def _key(code):
+    return (code.co_filename, code.co_firstlineno, code.co_name)
+
+
+class SamplingProfiler(threading.Thread):
+    """
+    Samples every thread in this process, from start seconds after
+    start() is called, for duration seconds, (or until stop() if None)
+
+        prof = SamplingProfiler()
+        prof.start()
+        do_the_work()
+        prof.stop()
+        prof.dump("worker-1.prof")
+    """
+    def __init__(self, interval=DEFAULT_INTERVAL, start=0, duration=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.delay = start
+        self.duration = duration
+        self.samples = 0
+        # self counts, cumulative counts, and caller -> callee counts
+        self.own = collections.Counter()
+        self.cumulative = collections.Counter()
+        self.callers = collections.defaultdict(collections.Counter)
+        self._stop_event = threading.Event()
+
+    def run(self):
+        if self._stop_event.wait(self.delay):
+            return
+        end = None
+        if self.duration:
+            end = time.time() + self.duration
+        me = threading.current_thread().ident
+        while not self._stop_event.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident != me:
+                    self._sample(frame)
+            self.samples += 1
+            if end and time.time() > end:
+                break
+
+    def _sample(self, frame):
+        keys = []
+        while frame is not None:
+            keys.append(_key(frame.f_code))
+            frame = frame.f_back
+        self.own[keys[0]] += 1
+        # recursion shouldn't count a function more than once per sample
+        for key in set(keys):
+            self.cumulative[key] += 1
+        for callee, caller in zip(keys, keys[1:]):
+            self.callers[callee][caller] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def create_stats(self):
+        """Fill in self.stats the way cProfile does, for pstats"""
+        t = self.interval
+        self.stats = {}
+        for key, n in self.cumulative.items():
+            own = self.own.get(key, 0)
+            callers = dict((caller, (c, c, 0, c * t))
+                           for caller, c in self.callers[key].items())
+            self.stats[key] = (n, n, own * t, n * t, callers)
+
+    def dump(self, path):
+        self.create_stats()
+        with open(path, "wb") as f:
+            marshal.dump(self.stats, f)
+
+
+def profile_path(options, name):
+    return os.path.join(options.profile, "%s.prof" % name)
+
+
+def run_profiled(options, name, func, *args):
+    """
+    Run func(*args), under a SamplingProfiler if options.profile is set,
+    saving its profile to profile_path(options, name)
+    """
+    if not getattr(options, "profile", None):
+        return func(*args)
+    prof = SamplingProfiler(options.profile_interval, options.profile_start,
+                            options.profile_duration)
+    prof.start()
+    try:
+        return func(*args)
+    finally:
+        prof.stop()
+        prof.dump(profile_path(options, name))
+
+
+def merge_profiles(options, names, limit=40):
+    """
+    Merge the profiles of the named workers into combined.prof, and a
+    combined.txt report, sorted by cumulative time and by own time, in the
+    options.profile directory.  Returns the path of the report
+    """
+    log = logging.getLogger(__name__)
+    paths = [profile_path(options, n) for n in names]
+    paths = [p for p in paths if os.path.exists(p)]
+    if not paths:
+        log.warn("No worker profiles found in %s to merge", options.profile)
+        return None
+    report = io.StringIO()
+    combined = pstats.Stats(paths[0], stream=report)
+    for p in paths[1:]:
+        combined.add(p)
+    combined.dump_stats(os.path.join(options.profile, "combined.prof"))
+    report.write(u"Merged sampled profiles from %d workers\n" % len(paths))
+    combined.sort_stats("cumulative").print_stats(limit)
+    combined.sort_stats("tottime").print_stats(limit)
+    path = os.path.join(options.profile, "combined.txt")
+    with open(path, "w") as f:
+        f.write(report.getvalue())
+    return path
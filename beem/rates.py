@@ -0,0 +1,130 @@
+# Copyright (c) 2013, ReMake Electric ehf
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""
+Exponentially decayed rates for monotonically increasing counters,
+and a simple ticker thread to drive them.
+"""
+
+from __future__ import division
+
+import logging
+import math
+import threading
+import time
+
+
+class EWMARate():
+    """
+    An exponentially weighted moving average of an event rate, in the same
+    way as the linux load average.  update() should be called every
+    "interval" seconds with the number of events in that interval, or be
+    told how long it has really been, if that was longer.
+    """
+    def __init__(self, window, interval):
+        self.window = window
+        self.interval = interval
+        self.alpha = 1 - math.exp(-interval / window)
+        self.rate = 0.0
+
+    def update(self, count, elapsed=None):
+        if elapsed is None or elapsed <= 0:
+            elapsed = self.interval
+        alpha = self.alpha
+        if elapsed != self.interval:
+            alpha = 1 - math.exp(-elapsed / self.window)
+        self.rate += alpha * (count / elapsed - self.rate)
+
+
+class CounterRates():
+    """
+    Tracks the rate of change of a counter over several windows,
+    and the peak rate (over the shortest window) seen since starting.
+
+        cr = CounterRates((1, 10, 60), 0.25)
+        # every 0.25 seconds...
+        cr.update(current_counter_value)
+        cr.rate(10)
+
+    Counts are spread over the time since the previous update, so a late
+    update, (eg, after the ticker stalled) doesn't show up as a spike.
+    """
+    def __init__(self, windows, interval):
+        self.rates = dict((w, EWMARate(w, interval)) for w in windows)
+        self._fastest = self.rates[min(windows)]
+        self.peak = 0.0
+        self.last = None
+        self._last_time = None
+
+    def update(self, value, now=None):
+        if now is None:
+            now = time.time()
+        if self.last is None:
+            self.last = value
+            self._last_time = now
+        count = value - self.last
+        elapsed = now - self._last_time
+        self.last = value
+        self._last_time = now
+        for r in self.rates.values():
+            r.update(count, elapsed)
+        if self._fastest.rate > self.peak:
+            self.peak = self._fastest.rate
+
+    def rate(self, window):
+        return self.rates[window].rate
+
+
+class Ticker(threading.Thread):
+    """
+    Calls func() every interval seconds, from a daemon thread.
+    Ticks are scheduled against the start time, so they don't drift.
+    An exception from func() is logged, and doesn't stop the ticks.
+    """
+    def __init__(self, interval, func):
+        threading.Thread.__init__(self)
+        self.log = logging.getLogger(__name__)
+        self.daemon = True
+        self.interval = interval
+        self.func = func
+        self._stop_event = threading.Event()
+
+    def run(self):
+        next_tick = time.time()
+        while not self._stop_event.is_set():
+            next_tick += self.interval
+            delay = next_tick - time.time()
+            if delay > 0:
+                self._stop_event.wait(delay)
+            else:
+                # we fell behind, skip missed ticks rather than bursting
+                next_tick = time.time()
+            if self._stop_event.is_set():
+                break
+            try:
+                self.func()
+            except Exception:
+                self.log.exception("Tick of %s failed", self.func)
+
+    def stop(self):
+        self._stop_event.set()
@@ -0,0 +1,200 @@
+# Copyright (c) 2013, ReMake Electric ehf
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""
+A compact, append only, columnar recording of watcher statistics.
+
+A recording is a directory, with one file per metric holding a single
+fixed width column of samples, a time column, and a small columns.json
+describing them.  Counters, (including the broker's cumulative $SYS
+counters) are stored as the (32 bit) increase since the previous sample,
+gauges as 32 bit floats, so a 24 hour recording of a few dozen metrics at
+the default 5 second interval is only a few MB.
+
+Metrics that first appear part way through a recording, (new $SYS topics for
+instance) get a column starting at that row.
+"""
+
+from __future__ import division
+
+import array
+import json
+import os
+import sys
+import time
+
+from beem.sysseries import CUMULATIVE
+
+META_FILE = "columns.json"
+TIME_COLUMN = "time"
+# array typecodes for each kind of column
+COLUMN_TYPES = {
+    "time": "d",     # seconds since the recording started
+    "counter": "I",  # increase since the previous sample
+    "gauge": "f"
+}
+
+
+def snapshot_columns(snap):
+    """
+    The values to record for a WatcherSnapshot, as a list of
+    (column name, kind, value)
+    """
+    cols = [
+        ("msgs", "counter", snap.msgs_total),
+        ("bytes", "counter", snap.bytes_total),
+        ("drops", "counter", snap.drop_count),
+        ("msgs_stored", "gauge", snap.msgs_stored),
+    ]
+    for name, history in snap.sys_series.items():
+        kind = "counter" if name in CUMULATIVE else "gauge"
+        cols.append(("sys_" + name, kind, history[-1][1]))
+    if snap.latency_all:
+        overall = snap.latency_all[min(snap.latency_all)]
+        if overall:
+            count, p50, p99, pmax = overall
+            cols.extend([
+                ("latency_p50_ms", "gauge", p50),
+                ("latency_p99_ms", "gauge", p99),
+                ("latency_max_ms", "gauge", pmax)])
+    return cols
+
+
+class Recorder():
+    """
+    Appends samples to a recording directory, creating it if needed,
+    or continuing it if it already exists.
+
+        rec = Recorder("/tmp/soak1", 5)
+        # every 5 seconds
+        rec.sample(watcher.snapshot)
+    """
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self._files = {}
+        self._last = {}
+        meta_path = os.path.join(path, META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path, "r") as f:
+                self.meta = json.load(f)
+            if self.meta["byteorder"] != sys.byteorder:
+                raise ValueError("Can't continue a recording made on a "
+                                 "machine with different byte order", path)
+            time_type = self.meta["columns"][TIME_COLUMN]["type"]
+            self.rows = (os.path.getsize(self._column_path(TIME_COLUMN))
+                         // array.array(time_type).itemsize)
+        else:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self.meta = {
+                "version": 2,
+                "byteorder": sys.byteorder,
+                "start": time.time(),
+                "interval": interval,
+                "columns": {}
+            }
+            self.rows = 0
+            self._add_column(TIME_COLUMN, "time")
+
+    def _column_path(self, name):
+        return os.path.join(self.path, name + ".col")
+
+    def _write_meta(self):
+        tmp = os.path.join(self.path, META_FILE + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.meta, f, sort_keys=True, indent=1)
+        os.rename(tmp, os.path.join(self.path, META_FILE))
+
+    def _add_column(self, name, kind):
+        self.meta["columns"][name] = {
+            "kind": kind,
+            "type": COLUMN_TYPES[kind],
+            "first_row": self.rows
+        }
+        self._write_meta()
+
+    def _append(self, name, typecode, value):
+        f = self._files.get(name, None)
+        if f is None:
+            f = self._files[name] = open(self._column_path(name), "ab")
+        array.array(typecode, [value]).tofile(f)
+
+    def sample(self, snap):
+        """Append one row of samples from a WatcherSnapshot"""
+        elapsed = max(snap.time - self.meta["start"], 0)
+        time_type = self.meta["columns"][TIME_COLUMN]["type"]
+        if time_type == "I":
+            # version 1 recordings kept milliseconds
+            elapsed = int(elapsed * 1000)
+        self._append(TIME_COLUMN, time_type, elapsed)
+        seen = set([TIME_COLUMN])
+        for name, kind, value in snapshot_columns(snap):
+            seen.add(name)
+            if name not in self.meta["columns"]:
+                self._add_column(name, kind)
+            # a continued recording keeps whatever kind it started with
+            col = self.meta["columns"][name]
+            if col["kind"] == "counter":
+                last = self._last.get(name, value)
+                self._last[name] = value
+                value = int(min(max(value - last, 0), 0xffffffff))
+            self._append(name, col["type"], value)
+        # keep every column the same length, even if a value went missing
+        for name, col in self.meta["columns"].items():
+            if name not in seen:
+                self._append(name, col["type"],
+                             0 if col["kind"] == "counter" else float("nan"))
+        self.rows += 1
+        for f in self._files.values():
+            f.flush()
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+
+def load(path):
+    """
+    Load a recording, returning (meta, times, columns), where times is a
+    list of seconds since the start and columns is {name: list of values}
+    Columns that started late are padded with None at the start.
+    """
+    with open(os.path.join(path, META_FILE), "r") as f:
+        meta = json.load(f)
+    columns = {}
+    for name, col in meta["columns"].items():
+        data = array.array(col["type"])
+        col_path = os.path.join(path, name + ".col")
+        with open(col_path, "rb") as f:
+            data.fromfile(f, os.path.getsize(col_path) // data.itemsize)
+        if meta["byteorder"] != sys.byteorder:
+            data.byteswap()
+        columns[name] = [None] * col["first_row"] + data.tolist()
+    times = columns.pop(TIME_COLUMN)
+    if meta["columns"][TIME_COLUMN]["type"] == "I":
+        times = [ms / 1000 for ms in times]
+    for name in columns:
+        del columns[name][len(times):]
+    return meta, times, columns
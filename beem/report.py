@@ -0,0 +1,172 @@
+# Copyright (c) 2013, ReMake Electric ehf
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""
+Render a watcher recording (see beem.recorder) as a static HTML page of
+SVG charts.  No javascript, no external resources, just a file you can
+open, mail around, or attach to a ticket.
+"""
+
+from __future__ import division
+
+import time
+try:
+    from html import escape
+except ImportError:
+    from cgi import escape
+
+import beem.recorder
+
+CHART_WIDTH = 900
+CHART_HEIGHT = 180
+MARGIN = 50
+# charts are downsampled to about one point per pixel
+MAX_POINTS = CHART_WIDTH
+
+PAGE_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>%(title)s</title>
+<style>
+body { font-family: sans-serif; margin: 2em; }
+h2 { font-size: 1em; margin-bottom: 0.2em; }
+svg { background: #fafafa; border: 1px solid #ddd; }
+polyline { fill: none; stroke: #1f77b4; stroke-width: 1; }
+.band { fill: #1f77b4; fill-opacity: 0.15; stroke: none; }
+text { font-size: 10px; fill: #555; }
+</style>
+</head>
+<body>
+<h1>%(title)s</h1>
+<p>%(summary)s</p>
+%(charts)s
+</body>
+</html>
+"""
+
+
+def _downsample(times, values, max_points):
+    """
+    Reduce a series to at most max_points buckets of (time, mean, min, max)
+    skipping missing values.
+    """
+    points = [(t, v) for t, v in zip(times, values)
+              if v is not None and v == v]
+    if not points:
+        return []
+    per_bucket = max(1, -(-len(points) // max_points))
+    rval = []
+    for i in range(0, len(points), per_bucket):
+        chunk = points[i:i + per_bucket]
+        vals = [v for _, v in chunk]
+        rval.append((chunk[0][0], sum(vals) / len(vals), min(vals), max(vals)))
+    return rval
+
+
+def _fmt(value):
+    if abs(value) >= 1e6:
+        return "%.3g" % value
+    if value == int(value):
+        return "%d" % value
+    return "%.2f" % value
+
+
+def _fmt_duration(secs):
+    if secs >= 7200:
+        return "%.1fh" % (secs / 3600)
+    if secs >= 120:
+        return "%dm" % (secs // 60)
+    return "%ds" % secs
+
+
+def svg_chart(times, values, duration):
+    """A simple line chart, with a min/max band where it was downsampled"""
+    points = _downsample(times, values, MAX_POINTS)
+    w = CHART_WIDTH + 2 * MARGIN
+    h = CHART_HEIGHT + MARGIN
+    if not points:
+        return '<svg width="%d" height="%d"><text x="%d" y="%d">no data</text></svg>' \
+            % (w, h, MARGIN, h // 2)
+    lo = min(min(p[2] for p in points), 0)
+    hi = max(p[3] for p in points)
+    span = (hi - lo) or 1
+    duration = duration or 1
+
+    def x(t):
+        return MARGIN + t / duration * CHART_WIDTH
+
+    def y(v):
+        return 10 + CHART_HEIGHT - (v - lo) / span * CHART_HEIGHT
+
+    line = " ".join("%.1f,%.1f" % (x(t), y(v)) for t, v, _, _ in points)
+    band = " ".join(["%.1f,%.1f" % (x(t), y(vmax)) for t, _, _, vmax in points] +
+                    ["%.1f,%.1f" % (x(t), y(vmin)) for t, _, vmin, _ in reversed(points)])
+    parts = ['<svg width="%d" height="%d">' % (w, h)]
+    if any(p[2] != p[3] for p in points):
+        parts.append('<polygon class="band" points="%s"/>' % band)
+    parts.append('<polyline points="%s"/>' % line)
+    parts.append('<text x="2" y="%.1f">%s</text>' % (y(hi) + 4, _fmt(hi)))
+    parts.append('<text x="2" y="%.1f">%s</text>' % (y(lo), _fmt(lo)))
+    for i in range(5):
+        t = duration * i / 4
+        parts.append('<text x="%.1f" y="%d" text-anchor="middle">%s</text>'
+                     % (x(t), h - 15, _fmt_duration(t)))
+    parts.append("</svg>")
+    return "\n".join(parts)
+
+
+def render(path):
+    """
+    Render the recording in directory path as an HTML page
+    Counters are charted as rates per second, gauges as they are.
+    """
+    meta, times, columns = beem.recorder.load(path)
+    duration = times[-1] if times else 0
+    charts = []
+    for name in sorted(columns, key=lambda n: (n.startswith("sys_"), n)):
+        kind = meta["columns"][name]["kind"]
+        values = columns[name]
+        title = name
+        if kind == "counter":
+            rates = []
+            prev = None
+            for t, v in zip(times, values):
+                if v is None or prev is None or t <= prev:
+                    rates.append(None)
+                else:
+                    rates.append(v / (t - prev))
+                prev = t
+            values = rates
+            title = "%s per second" % name
+        charts.append("<h2>%s</h2>\n%s" % (escape(title),
+                                           svg_chart(times, values, duration)))
+    started = time.strftime("%Y-%m-%d %H:%M:%S",
+                            time.localtime(meta["start"]))
+    summary = ("Started %s, %d samples over %.0f seconds, every %gs"
+               % (started, len(times), duration, meta["interval"]))
+    return PAGE_TEMPLATE % {
+        "title": escape("malaria watch report: %s" % path),
+        "summary": summary,
+        "charts": "\n".join(charts)
+    }
@@ -0,0 +1,348 @@
+# Copyright (c) 2013, ReMake Electric ehf
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""
+Declarative, multi phase publishing scenarios.
+
+A scenario file (JSON, or YAML if PyYAML is installed) describes a client
+population, and a list of phases they all run through, without
+reconnecting in between:
+
+    {
+        "clients": 10,
+        "msg_size": 100,
+        "timing": true,
+        "phases": [
+            {"name": "warm up", "type": "ramp", "duration": 30,
+             "from_rate": 0.1, "to_rate": 1},
+            {"type": "steady", "duration": 60, "rate": 1},
+            {"type": "spike", "duration": 5, "rate": 20, "qos": 0},
+            {"type": "idle", "duration": 10},
+            {"type": "steady", "duration": 60, "rate": 1}
+        ]
+    }
+
+Rates are messages per second, per client.  ramp goes linearly from
+from_rate to to_rate, steady and spike hold rate, (spike is just a name
+for a short, fast steady) and idle sends nothing, but keeps every client
+connected.  Any phase can override msg_size, qos, timing and topic, which
+is a format string with {cid}, {seq} and {phase} available.
+"""
+
+from __future__ import division
+
+import heapq
+import itertools
+import json
+import logging
+import math
+import random
+import string
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+import beem.stats
+from beem.trackers import SentMessage
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+PHASE_TYPES = ("ramp", "steady", "spike", "idle")
+
+# Settings that can be given for the whole scenario, or per phase
+DEFAULTS = {
+    "qos": 1,
+    "msg_size": 100,
+    "timing": False,
+    "topic": "mqtt-malaria/{cid}/data/{seq}/{phase}",
+}
+
+# How long to wait for outstanding acks after the last phase
+DRAIN_TIMEOUT = 30
+
+
+def load(path):
+    """Load and check a scenario file, returning it as a dict"""
+    with open(path, "r") as f:
+        if path.endswith((".yaml", ".yml")):
+            if yaml is None:
+                raise Exception("YAML scenarios need PyYAML, "
+                                "(pip install pyyaml) or use JSON instead")
+            scenario = yaml.safe_load(f)
+        else:
+            scenario = json.load(f)
+    validate(scenario)
+    return scenario
+
+
+def validate(scenario):
+    """Raise ValueError if a scenario doesn't make sense"""
+    if not scenario.get("phases"):
+        raise ValueError("A scenario needs at least one phase")
+    if scenario.get("clients", 1) < 1:
+        raise ValueError("A scenario needs at least one client")
+    for i, phase in enumerate(scenario["phases"]):
+        ptype = phase.get("type")
+        if ptype not in PHASE_TYPES:
+            raise ValueError("Phase %d: type must be one of %s, not %s"
+                             % (i, ", ".join(PHASE_TYPES), ptype))
+        if phase.get("duration", 0) <= 0:
+            raise ValueError("Phase %d: needs a positive duration" % i)
+        if ptype == "ramp" and "to_rate" not in phase:
+            raise ValueError("Phase %d: a ramp needs a to_rate" % i)
+        if ptype in ("steady", "spike") and phase.get("rate", 0) <= 0:
+            raise ValueError("Phase %d: needs a positive rate" % i)
+
+
+class Phase():
+    def __init__(self, index, spec, defaults):
+        self.index = index
+        self.type = spec["type"]
+        self.name = spec.get("name", "%s %d" % (self.type, index))
+        self.duration = spec["duration"]
+        self.from_rate = spec.get("from_rate", 0)
+        self.to_rate = spec.get("to_rate", spec.get("rate", 0))
+        settings = dict(defaults)
+        settings.update((k, spec[k]) for k in DEFAULTS if k in spec)
+        self.qos = settings["qos"]
+        self.msg_size = settings["msg_size"]
+        self.timing = settings["timing"]
+        self.topic = settings["topic"]
+        self.time_start = None
+        self.time_end = None
+        self.sent = 0
+        self.flight_times = beem.stats.Samples()
+
+    def rate(self, elapsed):
+        """Per client message rate, elapsed seconds into the phase"""
+        if self.type == "idle":
+            return 0
+        if self.type == "ramp":
+            frac = min(elapsed / self.duration, 1)
+            return self.from_rate + (self.to_rate - self.from_rate) * frac
+        return self.to_rate
+
+    def elapsed_at(self, count):
+        """
+        Seconds into the phase at which a client should have sent count
+        messages, (the area under rate() reaches count) or None if it
+        never gets that far.
+        """
+        if self.type == "idle":
+            return None
+        start = self.from_rate if self.type == "ramp" else self.to_rate
+        slope = 0
+        if self.type == "ramp":
+            slope = (self.to_rate - self.from_rate) / self.duration
+        # solve start * t + slope * t^2 / 2 = count for t, in a form that
+        # holds for a flat rate, and for a ramp starting at 0
+        disc = start * start + 2 * slope * count
+        if disc < 0:
+            return None
+        divisor = start + math.sqrt(disc)
+        if divisor <= 0:
+            return None
+        return 2 * count / divisor
+
+    def stats(self):
+        """Stats for this phase, in the same form as TrackingSender.stats()"""
+        elapsed = (self.time_end or time.time()) - self.time_start
+        label = "Phase %d: %s (%s)" % (self.index, self.name, self.type)
+        rval = publish_stats(label, self.flight_times, self.sent, elapsed)
+        rval["phase"] = self.name
+        rval["phase_type"] = self.type
+        return rval
+
+
+def publish_stats(label, flight_times, sent, elapsed):
+    """
+    Stats for a set of flight times (in ms) in the same form as
+    TrackingSender.stats(), so they can be printed with print_publish_stats
+    """
+    count_ok = len(flight_times)
+    if count_ok:
+        summary = beem.stats.summarize(flight_times)
+    else:
+        summary = {"mean": 0, "min": 0, "max": 0, "stddev": 0, "percentiles": {}}
+    return {
+        "clientid": label,
+        "count_ok": count_ok,
+        "count_total": sent,
+        "rate_ok": count_ok / sent if sent else 1,
+        "time_mean": summary["mean"],
+        "time_min": summary["min"],
+        "time_max": summary["max"],
+        "time_stddev": summary["stddev"],
+        "time_percentiles": summary["percentiles"],
+        "msgs_per_sec": count_ok / elapsed,
+        "time_total": elapsed
+    }
+
+
+class _Client():
+    """
+    One long lived connection, publishing whenever the scheduler says.
+    Acks are credited to the phase the message was published in.
+    """
+    def __init__(self, host, port, cid):
+        self.cid = cid
+        self.seq = 0
+        self.pending = {}
+        self._lock = threading.Lock()
+        self._early_acks = {}
+        self.mqttc = mqtt.Client(cid)
+        self.mqttc.on_publish = self._publish_handler
+        if hasattr(self.mqttc, "max_inflight_messages_set"):
+            self.mqttc.max_inflight_messages_set(200)
+        rc = self.mqttc.connect(host, port, 60)
+        if rc:
+            raise Exception("Couldn't even connect! ouch! rc=%d" % rc)
+        self.mqttc.loop_start()
+
+    def _publish_handler(self, mosq, userdata, mid):
+        time_received = time.time()
+        with self._lock:
+            entry = self.pending.pop(mid, None)
+            if entry is None:
+                # acked before publish() saved it, publish() will pick this up
+                self._early_acks[mid] = time_received
+                return
+        self._acked(entry, time_received)
+
+    def _acked(self, entry, time_received):
+        phase, msg = entry
+        msg.receive(time_received)
+        phase.flight_times.append(msg.time_flight() * 1000)
+
+    def publish(self, phase, payload):
+        self.seq += 1
+        topic = phase.topic.format(cid=self.cid, seq=self.seq, phase=phase.index)
+        time_enqueued = time.time()
+        result, mid = self.mqttc.publish(topic, payload, phase.qos)
+        assert(result == 0)
+        entry = (phase, SentMessage(mid, len(payload), time_enqueued))
+        # never held while calling paho, which has locks of its own.
+        # qos 0 "completes" when it's written to the socket
+        with self._lock:
+            time_acked = self._early_acks.pop(mid, None)
+            if time_acked is None:
+                self.pending[mid] = entry
+        if time_acked is not None:
+            self._acked(entry, time_acked)
+        phase.sent += 1
+
+    def stop(self):
+        self.mqttc.disconnect()
+        self.mqttc.loop_stop()
+
+
+class ScenarioRunner():
+    """
+    Runs a scenario dict against host/port, with one scheduler thread
+    publishing for every client, from a heap of their next send times.
+
+        runner = ScenarioRunner(beem.scenario.load("bursty.json"), host, port)
+        runner.run()
+        for phase in runner.stats():
+            beem.print_publish_stats(phase)
+    """
+    def __init__(self, scenario, host, port, cid_base="malaria-scenario"):
+        self.log = logging.getLogger(__name__)
+        validate(scenario)
+        defaults = dict(DEFAULTS)
+        defaults.update((k, scenario[k]) for k in DEFAULTS if k in scenario)
+        self.phases = [Phase(i, p, defaults)
+                       for i, p in enumerate(scenario["phases"])]
+        self.clients = [_Client(host, port, "%s-%d" % (cid_base, x))
+                        for x in range(scenario.get("clients", 1))]
+        # random hex to cut payloads from, without generating every one
+        longest = max(p.msg_size for p in self.phases)
+        self._filler = "".join(random.choice(string.hexdigits)
+                               for _ in range(2 * longest + 1))
+
+    def _payload(self, phase):
+        size = max(int(random.gauss(phase.msg_size, phase.msg_size / 20)), 0)
+        payload = self._filler[:size]
+        if phase.timing:
+            payload = "{:f},{:s}".format(time.time(), payload)
+        return payload
+
+    def _run_phase(self, phase):
+        phase.time_start = time.time()
+        end = phase.time_start + phase.duration
+        self.log.info("Starting %s for %ds", phase.name, phase.duration)
+        # each client sends whenever the area under the rate curve passes
+        # another whole message, offset by a random fraction so they don't
+        # all publish in step
+        queue = []
+        for c in self.clients:
+            target = random.random()
+            elapsed = phase.elapsed_at(target)
+            if elapsed is not None:
+                queue.append((phase.time_start + elapsed, id(c), c, target))
+        heapq.heapify(queue)
+        while queue:
+            when, key, client, target = queue[0]
+            if when >= end:
+                break
+            now = time.time()
+            if when > now:
+                time.sleep(when - now)
+            client.publish(phase, self._payload(phase))
+            elapsed = phase.elapsed_at(target + 1)
+            if elapsed is not None:
+                heapq.heapreplace(queue, (phase.time_start + elapsed, key,
+                                          client, target + 1))
+            else:
+                heapq.heappop(queue)
+        time.sleep(max(end - time.time(), 0))
+        phase.time_end = end
+
+    def run(self):
+        for phase in self.phases:
+            self._run_phase(phase)
+        give_up = time.time() + DRAIN_TIMEOUT
+        while any(c.pending for c in self.clients) and time.time() < give_up:
+            time.sleep(0.1)
+        missing = sum(len(c.pending) for c in self.clients)
+        if missing:
+            self.log.warn("Gave up waiting for %d acks", missing)
+        for c in self.clients:
+            c.stop()
+
+    def stats(self):
+        """A list of stats for each phase, idle phases excepted"""
+        return [p.stats() for p in self.phases if p.type != "idle"]
+
+    def overall_stats(self):
+        """Stats for the whole run, all phases together"""
+        flight_times = beem.stats.Samples(
+            itertools.chain(*[p.flight_times for p in self.phases]))
+        elapsed = self.phases[-1].time_end - self.phases[0].time_start
+        return publish_stats("Whole scenario, %d clients" % len(self.clients),
+                             flight_times, sum(p.sent for p in self.phases),
+                             elapsed)
@@ -0,0 +1,230 @@
+# Copyright (c) 2013, ReMake Electric ehf
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""
+Measure malaria's own ceiling on this machine, against the StubBroker,
+so that tool limits can be told apart from broker limits.
+
+The stub runs in its own process, and three things are measured against
+it: how fast a set of publisher processes can publish, how fast a
+subscriber can keep up with them, and how many connections can be made
+and held.
+"""
+
+from __future__ import division
+
+import argparse
+import logging
+import multiprocessing
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+import beem
+import beem.msgs
+from beem.listen import TrackingListener
+from beem.load import TrackingSender
+
+# The stub is single threaded python, so it can be the limit too
+BROKER_SATURATED = 0.9
+
+
+def _serve(conn, fanout):
+    """Run a StubBroker until told to stop, in its own process"""
+    # the stub needs asyncio, (python 3) so only import it when it's run
+    from beem.stubbroker import StubBroker
+    broker = StubBroker(fanout=fanout)
+    broker.start()
+    conn.send(broker.port)
+    conn.recv()
+    conn.send(broker.stats())
+    broker.stop()
+
+
+class BrokerProcess():
+    """A StubBroker in a child process, so it doesn't share our GIL"""
+    def __init__(self, fanout=True):
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_serve,
+                                               args=(child, fanout))
+        self.process.daemon = True
+
+    def __enter__(self):
+        self.process.start()
+        self.port = self.conn.recv()
+        return self
+
+    def __exit__(self, *args):
+        self.conn.send("stop")
+        self.stats = self.conn.recv()
+        self.process.join()
+
+
+def _publish_worker(port, cid, msg_count, msg_size, qos, timing):
+    ts = TrackingSender("127.0.0.1", port, cid)
+    msg_gen = beem.msgs.GaussianSize(cid, msg_count, msg_size)
+    if timing:
+        msg_gen = beem.msgs.TimeTracking(msg_gen)
+    ts.run(msg_gen, qos)
+    stats = ts.stats()
+    # nobody will look at these, and they're big
+    for k in ["msgs_per_sec_series", "out_queue_series", "self_series"]:
+        stats.pop(k, None)
+    return stats
+
+
+def _publish(port, options, timing=False):
+    """Run options.processes publishers flat out, returning aggregate stats"""
+    pool = multiprocessing.Pool(processes=options.processes)
+    results = [pool.apply_async(_publish_worker,
+                                (port, "selftest-%d" % x, options.msg_count,
+                                 options.msg_size, options.qos, timing))
+               for x in range(options.processes)]
+    stats_set = [r.get() for r in results]
+    pool.close()
+    pool.join()
+    agg = beem.aggregate_publish_stats(stats_set)
+    # they all ran at once, so the rate is over the whole window
+    agg["time_total"] = agg["time_end"] - agg["time_start"]
+    agg["msgs_per_sec"] = agg["count_ok"] / agg["time_total"]
+    return agg
+
+
+def measure_publish(options):
+    with BrokerProcess(fanout=False) as broker:
+        stats = _publish(broker.port, options)
+    return {
+        "publish_msgs_per_sec": stats["msgs_per_sec"],
+        "publish_count": stats["count_ok"],
+        "publish_saturated": stats.get("self_saturated", False),
+        "publish_time_percentiles": stats["time_percentiles"],
+        "publish_broker_cpu": broker.stats["cpu"],
+    }
+
+
+def measure_subscribe(options):
+    log = logging.getLogger(__name__)
+    with BrokerProcess(fanout=True) as broker:
+        listen_opts = argparse.Namespace(
+            clientid="selftest-listener", topic="mqtt-malaria/+/data/#",
+            msg_count=options.msg_count, client_count=options.processes,
+            capture=None)
+        listener = TrackingListener("127.0.0.1", broker.port, listen_opts)
+        # only the first message starts the listener's clock
+        t = threading.Thread(target=listener.run, args=(0,))
+        t.daemon = True
+        t.start()
+        time.sleep(1)
+        _publish(broker.port, options, timing=True)
+        t.join(options.timeout)
+        if t.is_alive():
+            log.warn("Subscriber still hadn't got everything after %d secs",
+                     options.timeout)
+            return {"subscribe_msgs_per_sec": None,
+                    "subscribe_count": len(listener.msg_statuses),
+                    "subscribe_broker_cpu": None}
+    stats = listener.stats()
+    # not stats["msg_per_sec"], the listener only notices it's finished
+    # when it next polls, up to a second after the last message
+    arrivals = listener.arrival_times.values
+    elapsed = arrivals[-1] - arrivals[0]
+    return {
+        "subscribe_msgs_per_sec": (len(arrivals) - 1) / elapsed if elapsed else None,
+        "subscribe_count": stats["msg_count"],
+        "subscribe_broker_cpu": broker.stats["cpu"],
+    }
+
+
+def measure_connections(options):
+    """Connect up to options.connections clients, and hold them all"""
+    log = logging.getLogger(__name__)
+    connected = threading.Semaphore(0)
+    clients = []
+    error = None
+    with BrokerProcess(fanout=False) as broker:
+        time_start = time.time()
+        for x in range(options.connections):
+            c = mqtt.Client("selftest-conn-%d" % x)
+            c.on_connect = lambda *args: connected.release()
+            try:
+                c.connect("127.0.0.1", broker.port, 60)
+                c.loop_start()
+            except Exception as e:
+                error = str(e)
+                log.warn("Stopped after %d connections: %s", x, e)
+                break
+            clients.append(c)
+        acked = 0
+        for c in clients:
+            if not connected.acquire(timeout=options.timeout):
+                break
+            acked += 1
+        time_total = time.time() - time_start
+        for c in clients:
+            c.disconnect()
+            c.loop_stop()
+    return {
+        "connections": acked,
+        "connections_per_sec": acked / time_total,
+        "connections_broker_max": broker.stats["connections_max"],
+        "connections_error": error,
+    }
+
+
+def run(options):
+    """Run every measurement, returning one dict of results"""
+    log = logging.getLogger(__name__)
+    results = {"processes": options.processes, "qos": options.qos,
+               "msg_size": options.msg_size}
+    log.info("Measuring publish rate")
+    results.update(measure_publish(options))
+    log.info("Measuring subscribe rate")
+    results.update(measure_subscribe(options))
+    log.info("Measuring connections")
+    results.update(measure_connections(options))
+    results["broker_saturated"] = any(
+        (results.get(k) or 0) >= BROKER_SATURATED
+        for k in ["publish_broker_cpu", "subscribe_broker_cpu"])
+    return results
+
+
+def print_results(results):
+    print("Publish:     %.0f msgs/sec from %d processes (qos %d, %d bytes)"
+          % (results["publish_msgs_per_sec"], results["processes"],
+             results["qos"], results["msg_size"]))
+    if results["publish_saturated"]:
+        print("             publishers were cpu bound, this is malaria's ceiling")
+    if results["subscribe_msgs_per_sec"] is not None:
+        print("Subscribe:   %.0f msgs/sec into one subscriber"
+              % results["subscribe_msgs_per_sec"])
+    else:
+        print("Subscribe:   only got %d messages, gave up"
+              % results["subscribe_count"])
+    print("Connections: %d held, at %.0f connections/sec"
+          % (results["connections"], results["connections_per_sec"]))
+    if results["connections_error"]:
+        print("             stopped by: %s" % results["connections_error"])
+    if results["broker_saturated"]:
+        print("NOTE: the stub broker itself was cpu bound, so malaria can go "
+              "at least this fast, maybe faster")
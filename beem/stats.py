@@ -0,0 +1,296 @@
+# Copyright (c) 2013, ReMake Electric ehf
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""
+Shared statistics helpers for the publishing and listening tools.
+
+Samples are kept in compact arrays of doubles rather than lists of python
+floats.  When numpy is available, summaries are calculated directly on those
+arrays without copying, otherwise a single streaming pass is used instead,
+with percentiles estimated from a log bucketed Histogram.
+"""
+
+from __future__ import division
+
+import array
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DEFAULT_PERCENTILES = [50, 90, 99, 99.9]
+
+
+def percentile_key(p):
+    """The dictionary key used for a given percentile, eg "99.9" """
+    return "%g" % p
+
+
+class Samples():
+    """
+    An append only collection of float samples, backed by array('d')
+    Appending is cheap enough to be done from message callbacks.
+    """
+    def __init__(self, values=()):
+        self.values = array.array("d", values)
+        self.append = self.values.append
+        self.extend = self.values.extend
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def as_numpy(self):
+        """A (zero copy) numpy view of the samples"""
+        return numpy.frombuffer(self.values, dtype=numpy.float64)
+
+
+class Histogram():
+    """
+    A sparse histogram with logarithmically sized buckets.
+
+    Each bucket is "growth" wider than the one before it, so any percentile
+    reported is within growth/2 of a real sample.  Count, sum, sum of squares
+    and min/max are kept exactly, so mean and stddev are exact.
+    Histograms with the same parameters can be merged, and round trip
+    through to_dict()/from_dict() for JSON output.
+    """
+    def __init__(self, growth=0.01, lowest=1e-6):
+        self.growth = growth
+        self.lowest = lowest
+        self._log_growth = math.log1p(growth)
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        if value <= self.lowest:
+            return 0
+        return int(math.log(value / self.lowest) / self._log_growth) + 1
+
+    def _value(self, index):
+        if index == 0:
+            return self.lowest
+        # geometric midpoint of the bucket
+        return self.lowest * math.exp((index - 0.5) * self._log_growth)
+
+    def add(self, value, n=1):
+        idx = self._index(value)
+        self.buckets[idx] = self.buckets.get(idx, 0) + n
+        self.count += n
+        self.total += value * n
+        self.total_sq += value * value * n
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        if (other.growth, other.lowest) != (self.growth, self.lowest):
+            raise ValueError("Can't merge histograms with different buckets")
+        for idx, n in other.buckets.items():
+            self.buckets[idx] = self.buckets.get(idx, 0) + n
+        self.count += other.count
+        self.total += other.total
+        self.total_sq += other.total_sq
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+        return self
+
+    def mean(self):
+        return self.total / self.count
+
+    def stddev(self):
+        var = self.total_sq / self.count - self.mean() ** 2
+        return math.sqrt(max(var, 0))
+
+    def percentiles(self, ps):
+        """
+        Estimate several percentiles in a single walk of the buckets
+        returns a list of values, in the same order as ps
+        """
+        wanted = sorted((p, i) for i, p in enumerate(ps))
+        rval = [None] * len(ps)
+        seen = 0
+        w = 0
+        for idx in sorted(self.buckets):
+            seen += self.buckets[idx]
+            while w < len(wanted) and seen >= wanted[w][0] / 100 * self.count:
+                v = self._value(idx)
+                rval[wanted[w][1]] = min(max(v, self.min), self.max)
+                w += 1
+        for p, i in wanted[w:]:
+            rval[i] = self.max
+        return rval
+
+    def percentile(self, p):
+        return self.percentiles([p])[0]
+
+    def summary(self, percentiles=DEFAULT_PERCENTILES):
+        """The same dict as summarize() returns, from the histogram"""
+        return {
+            "count": self.count,
+            "mean": self.mean(),
+            "stddev": self.stddev(),
+            "min": self.min,
+            "max": self.max,
+            "percentiles": dict((percentile_key(p), v) for p, v in
+                                zip(percentiles, self.percentiles(percentiles)))
+        }
+
+    def items(self):
+        """(bucket value, count) for every non empty bucket, smallest first"""
+        return [(self._value(idx), self.buckets[idx])
+                for idx in sorted(self.buckets)]
+
+    @classmethod
+    def of(cls, samples):
+        """A histogram of every value in samples"""
+        h = cls()
+        if numpy is None or not len(samples):
+            for v in samples:
+                h.add(v)
+            return h
+        if isinstance(samples, Samples):
+            arr = samples.as_numpy()
+        else:
+            arr = numpy.asarray(samples, dtype=numpy.float64)
+        # the same buckets as _index(), for the whole array at once
+        idx = numpy.floor(numpy.log(numpy.maximum(arr, h.lowest) / h.lowest)
+                          / h._log_growth).astype(numpy.int64) + 1
+        idx[arr <= h.lowest] = 0
+        counts = numpy.bincount(idx)
+        h.buckets = dict((int(i), int(counts[i]))
+                         for i in numpy.nonzero(counts)[0])
+        h.count = len(arr)
+        h.total = float(arr.sum())
+        h.total_sq = float(numpy.dot(arr, arr))
+        h.min = float(arr.min())
+        h.max = float(arr.max())
+        return h
+
+    def to_dict(self):
+        return {
+            "growth": self.growth,
+            "lowest": self.lowest,
+            "count": self.count,
+            "total": self.total,
+            "total_sq": self.total_sq,
+            "min": self.min,
+            "max": self.max,
+            "buckets": dict((str(k), v) for k, v in self.buckets.items())
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        h = cls(d["growth"], d["lowest"])
+        h.buckets = dict((int(k), v) for k, v in d["buckets"].items())
+        h.count = d["count"]
+        h.total = d["total"]
+        h.total_sq = d["total_sq"]
+        h.min = d["min"]
+        h.max = d["max"]
+        return h
+
+
+def summarize(samples, percentiles=DEFAULT_PERCENTILES):
+    """
+    Summarize a Samples object (or any iterable of floats)
+    Returns a dict of count, mean, stddev, min, max and percentiles, where
+    percentiles is itself a dict keyed by percentile_key()
+    """
+    if numpy is not None:
+        if isinstance(samples, Samples):
+            arr = samples.as_numpy()
+        else:
+            arr = numpy.asarray(samples, dtype=numpy.float64)
+        if len(arr) == 0:
+            raise ValueError("Can't summarize an empty set of samples")
+        pvals = numpy.percentile(arr, percentiles)
+        return {
+            "count": len(arr),
+            "mean": float(arr.mean()),
+            "stddev": float(arr.std()),
+            "min": float(arr.min()),
+            "max": float(arr.max()),
+            "percentiles": dict((percentile_key(p), float(v))
+                                for p, v in zip(percentiles, pvals))
+        }
+
+    # Streaming fallback, Welford's algorithm for the moments
+    count = 0
+    mean = 0.0
+    m2 = 0.0
+    hist = Histogram()
+    for x in samples:
+        count += 1
+        delta = x - mean
+        mean += delta / count
+        m2 += delta * (x - mean)
+        hist.add(x)
+    if count == 0:
+        raise ValueError("Can't summarize an empty set of samples")
+    pvals = hist.percentiles(percentiles)
+    return {
+        "count": count,
+        "mean": mean,
+        "stddev": math.sqrt(m2 / count),
+        "min": hist.min,
+        "max": hist.max,
+        "percentiles": dict((percentile_key(p), v)
+                            for p, v in zip(percentiles, pvals))
+    }
+
+
+def per_second(timestamps, start, width=1.0):
+    """
+    Histogram of event timestamps (seconds) into "width" second buckets,
+    starting at "start".  Returns a list of event rates per second
+    """
+    if numpy is not None:
+        if isinstance(timestamps, Samples):
+            arr = timestamps.as_numpy()
+        else:
+            arr = numpy.asarray(timestamps, dtype=numpy.float64)
+        if len(arr) == 0:
+            return []
+        idx = ((arr - start) // width).astype(numpy.int64)
+        counts = numpy.bincount(numpy.clip(idx, 0, None))
+        return [float(x) for x in counts / width]
+
+    counts = []
+    for t in timestamps:
+        idx = max(int((t - start) // width), 0)
+        if idx >= len(counts):
+            counts.extend([0] * (idx + 1 - len(counts)))
+        counts[idx] += 1
+    return [x / width for x in counts]
@@ -0,0 +1,360 @@
+# Copyright (c) 2013, ReMake Electric ehf
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""
+A FUSE filesystem view of the statistics collected by "malaria watch"
+This requires fusepy, and is only imported when it is actually used.
+"""
+
+import errno
+import os
+import stat
+import threading
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
+
+import fuse
+
+from beem.census import WatcherStats
+from beem.counters import Counters
+
+# filesystem operations we count, with a slot per fuse thread
+FS_OPS = ("getattr", "open", "read", "readdir", "render")
+_GETATTR, _OPEN, _READ, _READDIR, _RENDER = range(len(FS_OPS))
+# file name of the "" topic prefix, which quoting leaves empty, and can't
+# clash with a quoted prefix, as those have "(" and ")" quoted too
+EMPTY_PREFIX = "(empty)"
+
+
+def _rate_files(counters, windows, attrs):
+    """
+    Make stats fs handlers for the rates and peak rate of each counter
+    """
+    def rate_handler(counter, window):
+        def handler(self, snap):
+            return round(snap.rates[counter][window], 3)
+        handler.__doc__ = ("%s per second, decayed over %ds"
+                           % (counters[counter], window))
+        return handler
+
+    def peak_handler(counter):
+        def handler(self, snap):
+            return round(snap.peaks[counter], 3)
+        handler.__doc__ = ("Peak %ds rate of %s since we started"
+                           % (min(windows), counters[counter].lower()))
+        return handler
+
+    rval = {}
+    for counter in counters:
+        for window in windows:
+            rval["/rates/%s_%ds" % (counter, window)] = {
+                "file": attrs, "handler": rate_handler(counter, window)}
+        rval["/rates/%s_peak" % counter] = {
+            "file": attrs, "handler": peak_handler(counter)}
+    return rval
+
+
+def _latency_files(windows, attrs):
+    """
+    Make stats fs handlers for the overall flight time stats of each window
+    """
+    stats = [("p50", 1, "Median"), ("p99", 2, "99th percentile"),
+             ("max", 3, "Maximum")]
+
+    def latency_handler(window, idx, desc):
+        def handler(self, snap):
+            row = snap.latency_all.get(window, None)
+            return round(row[idx], 3) if row else "nan"
+        handler.__doc__ = ("%s flight time (ms) of timed messages over %ds"
+                           % (desc, window))
+        return handler
+
+    rval = {}
+    for window in windows:
+        for name, idx, desc in stats:
+            rval["/latency/%s_%ds" % (name, window)] = {
+                "file": attrs, "handler": latency_handler(window, idx, desc)}
+    return rval
+
+
+def _bytes(text):
+    if isinstance(text, bytes):
+        return text
+    return text.encode("utf-8")
+
+
+class MalariaWatcherStatsFS(fuse.LoggingMixIn, fuse.Operations):
+    """
+    Presents a WatcherStats as a set of files, a lot like /proc
+
+    Every file is rendered from the watcher's latest snapshot, all at once,
+    the first time anything is looked at after a new snapshot is taken.
+    So no matter how many readers there are, each snapshot is only rendered
+    once, and all files read from the same snapshot agree with each other.
+    An open file keeps the contents it had when it was opened, so reading
+    it in chunks never mixes two snapshots.
+    """
+
+    file_attrs = dict(st_mode=(stat.S_IFREG | 0o444), st_nlink=1)
+
+    dir_attrs = dict(st_mode=(stat.S_IFDIR | 0o755),  st_nlink=2)
+    README_STATFS = """
+This is a FUSE filesystem that contains a set of files representing various
+statistics we have gathered about the MQTT broker we are watching and the
+topics we are subscribed to.
+
+The topics/msgs and topics/bytes directories contain a file for every topic
+prefix being tracked, named by the (url quoted) prefix.  The empty prefix,
+of topics starting with "/", is named "(empty)".
+
+The sys directory contains the latest value of every numeric $SYS metric the
+broker publishes, and a matching .history file with "time value" lines.
+
+The latency directory has flight times for messages from publishers using
+--timing, which are only meaningful if their clocks agree with ours.
+"""
+
+    def handle_msgs_total(self, snap):
+        """Total number of messages seen since we started"""
+        return snap.msgs_total
+
+    def handle_msgs_stored(self, snap):
+        """Total number of stored ($sys/broker/messages/stored)"""
+        return snap.msgs_stored
+
+    def handle_uptime(self, snap):
+        """Time in seconds this watcher has been running"""
+        return snap.uptime
+
+    def handle_drop_count(self, snap):
+        """Total drops since this watcher has been running"""
+        return snap.drop_count
+
+    def handle_topic(self, snap):
+        """The topics this watcher is subscribing too"""
+        return '\n'.join(snap.listen_topics)
+
+    def handle_bytes_total(self, snap):
+        """Total payload bytes seen since we started"""
+        return snap.bytes_total
+
+    def handle_topics_summary(self, snap):
+        """msgs, bytes and prefix for each tracked topic prefix, busiest first"""
+        rows = sorted(snap.topics, key=lambda x: x[1], reverse=True)
+        return '\n'.join("%d\t%d\t%s" % (m, b, p) for p, m, b in rows)
+
+    def handle_topics_evicted(self, snap):
+        """Number of cold topic prefixes evicted to keep memory bounded"""
+        return snap.topics_evicted
+
+    def handle_latency_timed(self, snap):
+        """Total messages seen with a send time in their payload"""
+        return snap.timed_total
+
+    def handle_latency_summary(self, snap):
+        """window, msgs, p50, p99, max (ms) and prefix for each topic prefix"""
+        rows = []
+        for window in sorted(snap.latency):
+            for prefix, row in sorted(snap.latency[window].items()):
+                rows.append("%ds\t%d\t%.3f\t%.3f\t%.3f\t%s"
+                            % ((window,) + row + (prefix,)))
+        return '\n'.join(rows)
+
+    def handle_fs_ops(self, snap):
+        """Operations served by this filesystem so far, by type"""
+        totals = self.counters.totals()
+        return '\n'.join("%s\t%d" % (op, totals[op]) for op in FS_OPS)
+
+    def handle_sys_info(self, snap):
+        """Non numeric $SYS topics, such as the broker version"""
+        return '\n'.join("%s\t%s" % (k, v) for k, v in sorted(snap.sys_info.items()))
+
+    def handle_readme(self, snap):
+        """Returns 'this' readme ;)"""
+        rval = self.README_STATFS
+        useful = [x for x in self.handlers if x != '/']
+        file_field = "File                   "
+        rval += "\n" + file_field + "Description\n\n"
+        for h in useful:
+            func = self.handlers[h].get("handler", None)
+            desc = self.handlers[h].get("desc", None)
+            if not func and not desc:
+                desc = "Raw file, no further description"
+            if func:
+                desc = func.__doc__
+            if not desc:
+                desc = "No description in handler method! (Fix pydoc!)"
+            # pad file line to line up with the description
+            line = "%s%s\n" % (str.ljust(h[1:], len(file_field)), desc)
+            rval += line
+        return rval
+
+    handlers = {
+            "/": {"file": dir_attrs, "handler": None},
+            "/msgs_total": {"file": file_attrs, "handler": handle_msgs_total},
+            "/msgs_stored": {"file": file_attrs, "handler": handle_msgs_stored},
+            "/uptime": {"file": file_attrs, "handler": handle_uptime},
+            "/topic": {"file": file_attrs, "handler": handle_topic},
+            "/drop_count": {"file": file_attrs, "handler": handle_drop_count},
+            "/README": {"file": file_attrs, "content": README_STATFS},
+            "/README.detailed": {"file": file_attrs, "handler": handle_readme},
+            "/bytes_total": {"file": file_attrs, "handler": handle_bytes_total},
+            "/topics": {"file": dir_attrs, "handler": None,
+                        "desc": "Statistics per topic prefix"},
+            "/topics/msgs": {"file": dir_attrs, "handler": None,
+                             "desc": "Total messages seen per topic prefix"},
+            "/topics/bytes": {"file": dir_attrs, "handler": None,
+                              "desc": "Total payload bytes seen per topic prefix"},
+            "/topics/summary": {"file": file_attrs, "handler": handle_topics_summary},
+            "/topics/evicted": {"file": file_attrs, "handler": handle_topics_evicted},
+            "/rates": {"file": dir_attrs, "handler": None,
+                       "desc": "Decaying average and peak rates per second"},
+            "/sys": {"file": dir_attrs, "handler": None,
+                     "desc": "Latest value and history of each broker $SYS metric"},
+            "/sys_info": {"file": file_attrs, "handler": handle_sys_info},
+            "/fs_ops": {"file": file_attrs, "handler": handle_fs_ops},
+            "/latency": {"file": dir_attrs, "handler": None,
+                         "desc": "Flight times of messages sent with --timing"},
+            "/latency/timed": {"file": file_attrs, "handler": handle_latency_timed},
+            "/latency/summary": {"file": file_attrs, "handler": handle_latency_summary}
+        }
+    handlers.update(_rate_files(WatcherStats.RATE_COUNTERS,
+                                 WatcherStats.RATE_WINDOWS, file_attrs))
+    handlers.update(_latency_files(WatcherStats.LATENCY_WINDOWS, file_attrs))
+
+    # directories holding one file per topic prefix, and the index into
+    # the snapshot's (prefix, msgs, bytes) tuples for their values
+    prefix_dirs = {
+            "/topics/msgs": 1,
+            "/topics/bytes": 2
+        }
+
+    def __init__(self, watcher):
+        print("listener operations __init__")
+        self.watcher = watcher
+        self._lock = threading.Lock()
+        self._snap = None
+        self._files = {}
+        self._dirs = {}
+        self._open_files = {}
+        self._next_fh = 1
+        self.counters = Counters(FS_OPS)
+
+    def init(self, path):
+        """
+        Fuse calls this when it's ready, so we can start our actual mqtt
+        processes here.
+        """
+        print("listener post init init(), path=", path)
+        self.watcher.start()
+
+    def destroy(self, path):
+        self.watcher.stop()
+
+    def _render(self):
+        """
+        Make sure every file has been rendered from the latest snapshot.
+        Returns the snapshot, the files, and the directory listings, which
+        are never modified once rendered.
+        """
+        snap = self.watcher.snapshot
+        if self._snap is snap:
+            return snap, self._files, self._dirs
+        with self._lock:
+            if self._snap is snap:
+                return snap, self._files, self._dirs
+            self.counters.slot()[_RENDER] += 1
+            files = {}
+            dirs = {}
+            for path, h in self.handlers.items():
+                if path != '/':
+                    dirs.setdefault(os.path.dirname(path), []).append(
+                        os.path.basename(path))
+                if "content" in h:
+                    files[path] = _bytes(h["content"])
+                elif h["handler"]:
+                    files[path] = _bytes(str(h["handler"](self, snap)) + "\n")
+            for pdir, idx in self.prefix_dirs.items():
+                names = []
+                for row in snap.topics:
+                    name = quote(row[0], safe="") or EMPTY_PREFIX
+                    names.append(name)
+                    files[pdir + "/" + name] = _bytes("%d\n" % row[idx])
+                dirs[pdir] = names
+            names = []
+            for name, history in snap.sys_series.items():
+                names.extend([name, name + ".history"])
+                # repr, as %g would round big counters to 6 digits
+                files["/sys/" + name] = _bytes("%r\n" % history[-1][1])
+                files["/sys/" + name + ".history"] = _bytes(
+                    "".join("%.3f %r\n" % tv for tv in history))
+            dirs["/sys"] = names
+            self._files = files
+            self._dirs = dirs
+            self._snap = snap
+        return snap, files, dirs
+
+    def getattr(self, path, fh=None):
+        self.counters.slot()[_GETATTR] += 1
+        snap, files, dirs = self._render()
+        if path in dirs or path == '/':
+            attrs = dict(self.dir_attrs)
+        elif path in files:
+            attrs = dict(self.file_attrs, st_size=len(files[path]))
+        else:
+            raise fuse.FuseOSError(errno.ENOENT)
+        attrs.update(st_ctime=self.watcher.time_start,
+                     st_mtime=snap.time, st_atime=snap.time)
+        return attrs
+
+    def open(self, path, flags):
+        self.counters.slot()[_OPEN] += 1
+        snap, files, dirs = self._render()
+        if path not in files:
+            raise fuse.FuseOSError(errno.ENOENT)
+        with self._lock:
+            fh = self._next_fh
+            self._next_fh += 1
+            self._open_files[fh] = files[path]
+        return fh
+
+    def read(self, path, size, offset, fh):
+        self.counters.slot()[_READ] += 1
+        data = self._open_files.get(fh, None)
+        if data is None:
+            snap, files, dirs = self._render()
+            if path not in files:
+                raise fuse.FuseOSError(errno.ENOENT)
+            data = files[path]
+        return data[offset:offset + size]
+
+    def release(self, path, fh):
+        self._open_files.pop(fh, None)
+        return 0
+
+    def readdir(self, path, fh):
+        self.counters.slot()[_READDIR] += 1
+        snap, files, dirs = self._render()
+        return ['.', '..'] + dirs.get(path, [])
@@ -0,0 +1,285 @@
+# Copyright (c) 2013, ReMake Electric ehf
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""
+A minimal, in package, MQTT 3.1.1 broker, for measuring malaria itself.
+
+It accepts any connection, acks QoS 1 and 2 publishes straight away, and
+optionally fans messages out to subscribers, (always at QoS 0, which is
+what it grants) and nothing else.  No retained messages, no wills, no
+sessions, no authentication.  It is only here so that malaria's own limits
+can be measured without a real broker, see "malaria selftest".
+"""
+
+from __future__ import division
+
+import asyncio
+import logging
+import os
+import struct
+import threading
+import time
+
+# Control packet types, (the high nibble of the first byte)
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+
+def topic_matches(topic_filter, topic):
+    """Does topic match topic_filter, with + and # wildcards?"""
+    fparts = topic_filter.split("/")
+    tparts = topic.split("/")
+    for i, f in enumerate(fparts):
+        if f == "#":
+            # $ topics are never matched by a leading wildcard
+            return not (i == 0 and topic.startswith("$"))
+        if i >= len(tparts):
+            return False
+        if f == "+":
+            if i == 0 and topic.startswith("$"):
+                return False
+        elif f != tparts[i]:
+            return False
+    return len(fparts) == len(tparts)
+
+
+def _remaining_length(n):
+    out = bytearray()
+    while True:
+        byte = n % 128
+        n //= 128
+        out.append(byte | 0x80 if n else byte)
+        if not n:
+            return bytes(out)
+
+
+class _Session(asyncio.Protocol):
+    """One client connection"""
+    def __init__(self, broker):
+        self.broker = broker
+        self.buf = bytearray()
+        self.transport = None
+        self.subscriptions = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.broker.connected(self)
+
+    def connection_lost(self, exc):
+        self.broker.disconnected(self)
+
+    def data_received(self, data):
+        self.buf.extend(data)
+        while True:
+            # fixed header, then up to 4 bytes of remaining length
+            length = 0
+            mult = 1
+            pos = 1
+            while True:
+                if pos >= len(self.buf):
+                    return
+                byte = self.buf[pos]
+                length += (byte & 0x7F) * mult
+                mult *= 128
+                pos += 1
+                if not byte & 0x80:
+                    break
+            if len(self.buf) < pos + length:
+                return
+            header = self.buf[0]
+            body = bytes(self.buf[pos:pos + length])
+            del self.buf[:pos + length]
+            self.handle(header >> 4, header & 0x0F, body)
+
+    def handle(self, ptype, flags, body):
+        if ptype == PUBLISH:
+            qos = (flags >> 1) & 3
+            tlen = struct.unpack_from("!H", body)[0]
+            topic = body[2:2 + tlen]
+            pos = 2 + tlen
+            if qos:
+                mid = body[pos:pos + 2]
+                pos += 2
+                self.transport.write(
+                    struct.pack("!BB", (PUBACK if qos == 1 else PUBREC) << 4, 2)
+                    + mid)
+            self.broker.publish(topic, body[pos:])
+        elif ptype == PUBREL:
+            self.transport.write(struct.pack("!BB", PUBCOMP << 4, 2) + body[:2])
+        elif ptype == CONNECT:
+            self.transport.write(struct.pack("!BBBB", CONNACK << 4, 2, 0, 0))
+        elif ptype == SUBSCRIBE:
+            pos = 2
+            granted = bytearray()
+            while pos < len(body):
+                flen = struct.unpack_from("!H", body, pos)[0]
+                self.subscriptions.append(
+                    body[pos + 2:pos + 2 + flen].decode("utf-8"))
+                pos += 2 + flen + 1
+                granted.append(0)
+            self.broker.subscribed()
+            self.transport.write(bytes([SUBACK << 4 | 0])
+                                 + _remaining_length(2 + len(granted))
+                                 + body[:2] + bytes(granted))
+        elif ptype == UNSUBSCRIBE:
+            pos = 2
+            while pos < len(body):
+                flen = struct.unpack_from("!H", body, pos)[0]
+                f = body[pos + 2:pos + 2 + flen].decode("utf-8")
+                if f in self.subscriptions:
+                    self.subscriptions.remove(f)
+                pos += 2 + flen
+            self.broker.subscribed()
+            self.transport.write(struct.pack("!BB", UNSUBACK << 4, 2) + body[:2])
+        elif ptype == PINGREQ:
+            self.transport.write(struct.pack("!BB", PINGRESP << 4, 0))
+        elif ptype == DISCONNECT:
+            self.transport.close()
+        # PUBACK, PUBREC, PUBCOMP: we only ever send at QoS 0, so ignore
+
+    def deliver(self, packet):
+        self.transport.write(packet)
+
+
+class StubBroker():
+    """
+    Serve on host:port (port 0 picks a free one) from a background thread,
+    with fanout to subscribers if fanout.  Counts are kept as plain ints.
+
+        broker = StubBroker()
+        broker.start()
+        run_something_against(broker.port)
+        broker.stop()
+        print(broker.stats())
+    """
+    def __init__(self, host="127.0.0.1", port=0, fanout=True):
+        self.log = logging.getLogger(__name__)
+        self.host = host
+        self.port = port
+        self.fanout = fanout
+        self.sessions = set()
+        self._subscribers = []
+        self.connections_max = 0
+        self.connections_total = 0
+        self.msgs_in = 0
+        self.msgs_out = 0
+        self.time_start = None
+        self._loop = None
+        self._thread = None
+        self._ready = threading.Event()
+        self._error = None
+
+    def connected(self, session):
+        self.sessions.add(session)
+        self.connections_total += 1
+        self.connections_max = max(self.connections_max, len(self.sessions))
+
+    def disconnected(self, session):
+        self.sessions.discard(session)
+        self.subscribed()
+
+    def subscribed(self):
+        self._subscribers = [s for s in self.sessions if s.subscriptions]
+
+    def publish(self, topic, payload):
+        self.msgs_in += 1
+        if not self.fanout or not self._subscribers:
+            return
+        packet = None
+        decoded = topic.decode("utf-8")
+        for s in self._subscribers:
+            if any(topic_matches(f, decoded) for f in s.subscriptions):
+                if packet is None:
+                    rest = struct.pack("!H", len(topic)) + topic + payload
+                    packet = (bytes([PUBLISH << 4]) + _remaining_length(len(rest))
+                              + rest)
+                s.deliver(packet)
+                self.msgs_out += 1
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        try:
+            server = self._loop.run_until_complete(self._loop.create_server(
+                lambda: _Session(self), self.host, self.port, backlog=1024))
+        except Exception as e:
+            # eg, the port is in use, start() raises it again
+            self._error = e
+            self._loop.close()
+            self._ready.set()
+            return
+        self.port = server.sockets[0].getsockname()[1]
+        self.time_start = time.time()
+        self._cpu_start = os.times()
+        self._ready.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            server.close()
+            for s in list(self.sessions):
+                s.transport.abort()
+            self._loop.run_until_complete(server.wait_closed())
+            self._loop.close()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+        self.log.info("Stub broker listening on %s:%d", self.host, self.port)
+
+    def serve_forever(self):
+        self.start()
+        while self._thread.is_alive():
+            self._thread.join(1)
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def stats(self):
+        elapsed = time.time() - self.time_start
+        cpu = os.times()
+        return {
+            "connections_max": self.connections_max,
+            "connections_total": self.connections_total,
+            "msgs_in": self.msgs_in,
+            "msgs_out": self.msgs_out,
+            # the whole process, so only meaningful when that's just us
+            "cpu": (cpu[0] + cpu[1] - self._cpu_start[0] - self._cpu_start[1])
+                   / elapsed,
+            "time_total": elapsed
+        }
@@ -0,0 +1,370 @@
+# Copyright (c) 2013, ReMake Electric ehf
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""
+Run one load test from many machines at once.
+
+A coordinator listens for agents, (one per attack node) hands them all the
+same scenario, and a start time a few seconds in the future.  Agents
+connect all their clients first, start publishing at that shared time,
+and stream a small binary snapshot back every interval, which the
+coordinator merges into swarm wide throughput and latency as it goes.
+
+The protocol is plain TCP.  Every frame is a FRAME header of (type, length)
+followed by the body.  Control frames are JSON, snapshots are binary, see
+pack_snapshot().
+
+    agent                           coordinator
+    HELLO {name, host, pid}   -->
+                              <--   WELCOME {agent_id, time}
+                              <--   SCENARIO {scenario, start_at, interval}
+    SNAPSHOT (binary)         -->   (every interval)
+    DONE {stats}              -->
+
+Start times are in the coordinator's clock.  Agents estimate their offset
+from it from the WELCOME frame, so their own clocks needn't be in sync.
+"""
+
+from __future__ import division
+
+import argparse
+import json
+import logging
+import math
+import os
+import select
+import socket
+import struct
+import threading
+import time
+
+import beem
+import beem.load
+import beem.msgs
+import beem.stats
+from beem.stats import Histogram
+
+FRAME = struct.Struct("!BI")
+HELLO, WELCOME, SCENARIO, SNAPSHOT, DONE = range(1, 6)
+FRAME_NAMES = {HELLO: "HELLO", WELCOME: "WELCOME", SCENARIO: "SCENARIO",
+               SNAPSHOT: "SNAPSHOT", DONE: "DONE"}
+
+# time, msgs published, msgs acked, then the ack time (ms) histogram of
+# just this interval: count, total, total_sq, min, max, bucket count
+SNAPSHOT_HEADER = struct.Struct("!dQQQddddI")
+# bucket index, count
+SNAPSHOT_BUCKET = struct.Struct("!iQ")
+
+# The options a scenario can set, and their defaults, as for malaria publish
+SCENARIO_DEFAULTS = {
+    "host": "localhost",
+    "port": 1883,
+    "qos": 1,
+    "clients": 10,
+    "msg_count": 10,
+    "msg_size": 100,
+    "timing": False,
+    "msgs_per_second": 0,
+    "jitter": 0.1,
+}
+
+
+def _recv_exact(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def send_frame(sock, ftype, body):
+    if not isinstance(body, bytes):
+        body = json.dumps(body).encode("utf-8")
+    sock.sendall(FRAME.pack(ftype, len(body)) + body)
+
+
+def recv_frame(sock):
+    """The next (type, body) from sock, or (None, None) at EOF"""
+    header = _recv_exact(sock, FRAME.size)
+    if header is None:
+        return None, None
+    ftype, size = FRAME.unpack(header)
+    body = _recv_exact(sock, size)
+    if body is None:
+        return None, None
+    return ftype, body
+
+
+def recv_json(sock, expected):
+    ftype, body = recv_frame(sock)
+    if ftype != expected:
+        raise Exception("Expected %s, got %s" % (FRAME_NAMES[expected],
+                                                 FRAME_NAMES.get(ftype, ftype)))
+    return json.loads(body.decode("utf-8"))
+
+
+def pack_snapshot(when, sent, acked, hist):
+    nan = float("nan")
+    parts = [SNAPSHOT_HEADER.pack(
+        when, sent, acked, hist.count, hist.total, hist.total_sq,
+        nan if hist.min is None else hist.min,
+        nan if hist.max is None else hist.max,
+        len(hist.buckets))]
+    parts.extend(SNAPSHOT_BUCKET.pack(idx, n) for idx, n in hist.buckets.items())
+    return b"".join(parts)
+
+
+def unpack_snapshot(data):
+    """(time, sent, acked, Histogram) from a SNAPSHOT body"""
+    (when, sent, acked, count, total, total_sq,
+     hmin, hmax, nbuckets) = SNAPSHOT_HEADER.unpack_from(data)
+    hist = Histogram()
+    hist.count = count
+    hist.total = total
+    hist.total_sq = total_sq
+    hist.min = None if math.isnan(hmin) else hmin
+    hist.max = None if math.isnan(hmax) else hmax
+    offset = SNAPSHOT_HEADER.size
+    for _ in range(nbuckets):
+        idx, n = SNAPSHOT_BUCKET.unpack_from(data, offset)
+        hist.buckets[idx] = n
+        offset += SNAPSHOT_BUCKET.size
+    return when, sent, acked, hist
+
+
+class _AgentClient(threading.Thread):
+    """One publishing client of an agent, connected before the start"""
+    def __init__(self, options, cid):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.options = options
+        self.cid = cid
+        self.ts = beem.load.TrackingSender(options.host, options.port, cid)
+        self.stats = None
+        # how many of ts.flight_times have been reported already
+        self.reported = 0
+
+    def run(self):
+        self.ts.run(beem.msgs.createGenerator(self.cid, self.options),
+                    self.options.qos)
+        self.stats = self.ts.stats()
+
+
+class Agent():
+    """
+    Connects to a coordinator at address, (host, port) and runs whatever
+    scenario it is given, reporting back as it goes.
+    """
+    def __init__(self, address, name=None):
+        self.address = address
+        self.name = name or socket.gethostname()
+        self.log = logging.getLogger(__name__ + ":agent")
+        self.offset = 0
+
+    def _snapshot(self, clients):
+        """Everything new since the last snapshot, packed for sending"""
+        hist = Histogram()
+        sent = acked = 0
+        for c in clients:
+            values = c.ts.flight_times.values
+            end = len(values)
+            for v in values[c.reported:end]:
+                hist.add(v)
+            c.reported = end
+            sent += c.ts.publish_count
+            acked += end
+        return pack_snapshot(time.time() + self.offset, sent, acked, hist)
+
+    def run(self):
+        sock = socket.create_connection(self.address)
+        try:
+            return self._run(sock)
+        finally:
+            sock.close()
+
+    def _run(self, sock):
+        time_hello = time.time()
+        send_frame(sock, HELLO, {"name": self.name,
+                                 "host": socket.gethostname(),
+                                 "pid": os.getpid()})
+        welcome = recv_json(sock, WELCOME)
+        now = time.time()
+        # assume the coordinator's clock was read half way through
+        self.offset = welcome["time"] - (time_hello + now) / 2
+        self.log.info("Registered as agent %d, clock offset %.3f secs",
+                      welcome["agent_id"], self.offset)
+
+        msg = recv_json(sock, SCENARIO)
+        scenario = dict(SCENARIO_DEFAULTS, **msg["scenario"])
+        options = argparse.Namespace(**scenario)
+        clients = [_AgentClient(options, "malaria-%d-%d" % (welcome["agent_id"], x))
+                   for x in range(options.clients)]
+        start = msg["start_at"] - self.offset
+        self.log.info("Connected %d clients, starting in %.2f secs",
+                      len(clients), start - time.time())
+        time.sleep(max(start - time.time(), 0))
+        [c.start() for c in clients]
+
+        next_snap = start + msg["interval"]
+        while any(c.is_alive() for c in clients):
+            time.sleep(max(min(next_snap - time.time(), 0.1), 0))
+            if time.time() >= next_snap:
+                send_frame(sock, SNAPSHOT, self._snapshot(clients))
+                next_snap += msg["interval"]
+        send_frame(sock, SNAPSHOT, self._snapshot(clients))
+        stats = [c.stats for c in clients if c.stats]
+        send_frame(sock, DONE, {"stats": stats})
+        self.log.info("Finished, sent stats for %d clients", len(stats))
+        return stats
+
+
+class _AgentConnection():
+    def __init__(self, agent_id, sock, hello):
+        self.agent_id = agent_id
+        self.sock = sock
+        self.hello = hello
+        self.sent = 0
+        self.acked = 0
+        self.stats = None
+
+
+class Coordinator():
+    """
+    Waits for agent_count agents to connect to address, then runs scenario
+    (a dict of SCENARIO_DEFAULTS keys) on all of them, starting start_delay
+    seconds later.  Prints swarm wide progress every interval seconds.
+
+        c = Coordinator(("", 7777), 3, {"host": "target", "clients": 50})
+        stats = c.run()
+    """
+    def __init__(self, address, agent_count, scenario, start_delay=5,
+                 interval=1, join_timeout=None):
+        self.log = logging.getLogger(__name__ + ":coordinator")
+        self.agent_count = agent_count
+        self.scenario = scenario
+        self.start_delay = start_delay
+        self.interval = interval
+        self.join_timeout = join_timeout
+        self.listener = socket.socket()
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(address)
+        self.listener.listen(agent_count)
+        self.address = self.listener.getsockname()
+        self.agents = []
+        # ack times (ms) of the whole swarm, over the whole run
+        self.hist = Histogram()
+
+    def _accept_agents(self):
+        self.log.info("Waiting for %d agents on %s:%d", self.agent_count,
+                      self.address[0], self.address[1])
+        give_up = self.join_timeout and time.time() + self.join_timeout
+        while len(self.agents) < self.agent_count:
+            if give_up:
+                self.listener.settimeout(max(give_up - time.time(), 0.01))
+            try:
+                sock, addr = self.listener.accept()
+            except socket.timeout:
+                raise Exception("Only %d of %d agents joined"
+                                % (len(self.agents), self.agent_count))
+            sock.settimeout(None)
+            hello = recv_json(sock, HELLO)
+            agent = _AgentConnection(len(self.agents), sock, hello)
+            send_frame(sock, WELCOME, {"agent_id": agent.agent_id,
+                                       "time": time.time()})
+            self.agents.append(agent)
+            self.log.info("Agent %d joined: %s from %s", agent.agent_id,
+                          hello["name"], addr[0])
+
+    def _progress(self, elapsed, hist, acked_delta):
+        pcts = hist.percentiles([50, 99]) if hist.count else [0, 0]
+        print("%6.1fs  agents %d/%d  sent %d  acked %d  %.0f msgs/sec  "
+              "p50 %.2f ms  p99 %.2f ms"
+              % (elapsed, sum(1 for a in self.agents if a.stats is None),
+                 len(self.agents), sum(a.sent for a in self.agents),
+                 sum(a.acked for a in self.agents),
+                 acked_delta / self.interval, pcts[0], pcts[1]))
+
+    def run(self):
+        """
+        Run the scenario, returning aggregate stats for every client
+        in the swarm, with exact swarm wide percentiles.
+        """
+        self._accept_agents()
+        start_at = time.time() + self.start_delay
+        for a in self.agents:
+            send_frame(a.sock, SCENARIO, {"scenario": self.scenario,
+                                          "start_at": start_at,
+                                          "interval": self.interval})
+        socks = dict((a.sock, a) for a in self.agents)
+        interval_hist = Histogram()
+        acked_before = 0
+        next_report = start_at + self.interval
+        while any(a.stats is None for a in self.agents):
+            waiting = [a.sock for a in self.agents if a.stats is None]
+            readable, _, _ = select.select(waiting, [], [],
+                                           max(next_report - time.time(), 0))
+            for sock in readable:
+                agent = socks[sock]
+                ftype, body = recv_frame(sock)
+                if ftype is None:
+                    self.log.error("Agent %d went away!", agent.agent_id)
+                    agent.stats = []
+                elif ftype == SNAPSHOT:
+                    when, agent.sent, agent.acked, hist = unpack_snapshot(body)
+                    interval_hist.merge(hist)
+                    self.hist.merge(hist)
+                elif ftype == DONE:
+                    agent.stats = json.loads(body.decode("utf-8"))["stats"]
+            if time.time() >= next_report:
+                acked = sum(a.acked for a in self.agents)
+                self._progress(next_report - start_at, interval_hist,
+                               acked - acked_before)
+                acked_before = acked
+                interval_hist = Histogram()
+                next_report += self.interval
+        time_total = time.time() - start_at
+        for a in self.agents:
+            a.sock.close()
+        self.listener.close()
+
+        stats_set = [s for a in self.agents for s in a.stats]
+        if not stats_set:
+            raise Exception("No agent returned any stats")
+        agg = beem.aggregate_publish_stats(stats_set)
+        agg["clientid"] = ("Swarm stats for %d clients on %d agents"
+                           % (len(stats_set), len(self.agents)))
+        agg["time_total"] = time_total
+        agg["msgs_per_sec"] = agg["count_ok"] / time_total
+        if self.hist.count:
+            # exact over the whole swarm, not averages of averages
+            summary = self.hist.summary()
+            agg["time_min"] = summary["min"]
+            agg["time_max"] = summary["max"]
+            agg["time_mean"] = summary["mean"]
+            agg["time_stddev"] = summary["stddev"]
+            agg["time_percentiles"] = summary["percentiles"]
+            agg["time_histogram"] = self.hist.to_dict()
+        return agg
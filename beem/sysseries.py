@@ -0,0 +1,195 @@
+# Copyright (c) 2013, ReMake Electric ehf
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""
+Time series of broker $SYS metrics.
+
+Brokers publish their $SYS tree every few seconds.  Each numeric metric is
+kept in its own fixed size ring buffer, so a long running watcher has some
+recent history for everything, in bounded memory.  Metric names are
+normalised through SYS_METRICS, so that different broker versions that use
+different topics for the same thing end up in the same series.
+"""
+
+import array
+
+SYS_PREFIX = "$SYS/broker/"
+
+# $SYS/broker/ relative topic -> metric name.
+# Where mosquitto has renamed topics between versions, all the names are
+# listed here, mapping onto a single metric.  Brokers that publish more
+# than one of them only have the first one seen recorded.  Numeric topics not listed
+# here are still recorded, named after their topic.
+SYS_METRICS = {
+    # >= 1.2
+    "clients/connected": "clients_connected",
+    "clients/disconnected": "clients_disconnected",
+    "publish/messages/dropped": "messages_dropped",
+    "heap/current": "heap_current",
+    "heap/maximum": "heap_maximum",
+    # 1.1.x
+    "clients/active": "clients_connected",
+    "clients/inactive": "clients_disconnected",
+    "messages/dropped": "messages_dropped",
+    "heap/current size": "heap_current",
+    "heap/maximum size": "heap_maximum",
+    # >= 1.5 moved the stored count, but still publishes the old one too
+    "messages/stored": "messages_stored",
+    "store/messages/count": "messages_stored",
+    "store/messages/bytes": "messages_stored_bytes",
+    # unchanged, but given friendlier names
+    "clients/total": "clients_total",
+    "clients/maximum": "clients_maximum",
+    "messages/inflight": "messages_inflight",
+    "messages/received": "messages_received",
+    "messages/sent": "messages_sent",
+    "bytes/received": "bytes_received",
+    "bytes/sent": "bytes_sent",
+    "subscriptions/count": "subscriptions",
+    "retained messages/count": "retained_messages",
+    "uptime": "uptime",
+}
+
+# Metrics that only ever count up, (until the broker restarts) as opposed
+# to gauges like clients_connected, which go up and down
+CUMULATIVE = set([
+    "messages_received", "messages_sent", "messages_dropped",
+    "bytes_received", "bytes_sent",
+    "publish_messages_received", "publish_messages_sent",
+    "publish_bytes_received", "publish_bytes_sent",
+])
+
+
+def metric_name(subtopic):
+    """The metric name for a $SYS/broker/ relative topic"""
+    name = SYS_METRICS.get(subtopic, None)
+    if name is None:
+        name = subtopic.replace("/", "_").replace(" ", "_")
+    return name
+
+
+def parse_value(payload):
+    """
+    The numeric value of a $SYS payload, or None if it isn't numeric.
+    Some versions append units, like "1234 seconds" or "5678 bytes"
+    """
+    if isinstance(payload, bytes):
+        payload = payload.decode("utf-8", "replace")
+    fields = payload.split(None, 1)
+    if not fields:
+        return None
+    try:
+        return float(fields[0])
+    except ValueError:
+        return None
+
+
+class SeriesRing():
+    """
+    A fixed size ring buffer of (time, value) samples, backed by arrays.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.times = array.array("d", [0.0] * size)
+        self.values = array.array("d", [0.0] * size)
+        self.count = 0
+        self._history = ()
+
+    def append(self, when, value):
+        idx = self.count % self.size
+        self.times[idx] = when
+        self.values[idx] = value
+        self.count += 1
+        self._history = None
+
+    def latest(self):
+        if not self.count:
+            return None
+        return self.values[(self.count - 1) % self.size]
+
+    def first(self):
+        """The oldest sample still held"""
+        if not self.count:
+            return None
+        return self.values[max(self.count - self.size, 0) % self.size]
+
+    def history(self):
+        """
+        All held samples, oldest first, as an (immutable) tuple of
+        (time, value).  This is cached until the next append.
+        """
+        if self._history is None:
+            start = max(self.count - self.size, 0)
+            self._history = tuple(
+                (self.times[i % self.size], self.values[i % self.size])
+                for i in range(start, self.count))
+        return self._history
+
+
+class SysSeries():
+    """
+    Ingests $SYS/broker/# messages into a SeriesRing per metric.
+    Non numeric topics, like the broker version, are kept in .info
+    At most max_series metrics are tracked, and only the first topic seen
+    for each, where several map onto the same metric.
+    """
+    def __init__(self, size=360, max_series=500):
+        self.size = size
+        self.max_series = max_series
+        self.series = {}
+        self.info = {}
+        # metric name -> the subtopic it's recorded from
+        self._sources = {}
+
+    def ingest(self, topic, payload, when):
+        """
+        Record a $SYS message, returning the metric name and value,
+        or (None, None) if it wasn't recorded.
+        """
+        if not topic.startswith(SYS_PREFIX):
+            return None, None
+        subtopic = topic[len(SYS_PREFIX):]
+        value = parse_value(payload)
+        if value is None:
+            if isinstance(payload, bytes):
+                payload = payload.decode("utf-8", "replace")
+            self.info[subtopic] = payload
+            return None, None
+        name = metric_name(subtopic)
+        if self._sources.setdefault(name, subtopic) != subtopic:
+            # eg, the old name of a topic the broker also publishes anew
+            return None, None
+        ring = self.series.get(name, None)
+        if ring is None:
+            if len(self.series) >= self.max_series:
+                del self._sources[name]
+                return None, None
+            ring = self.series[name] = SeriesRing(self.size)
+        ring.append(when, value)
+        return name, value
+
+    def latest(self, name, default=None):
+        ring = self.series.get(name, None)
+        if ring is None or not ring.count:
+            return default
+        return ring.latest()
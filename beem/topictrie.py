@@ -0,0 +1,153 @@
+# Copyright (c) 2013, ReMake Electric ehf
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""
+Bounded memory message and byte counters for topic prefixes.
+"""
+
+import time
+
+
+class _Node():
+    __slots__ = ("children", "msgs", "bytes", "recent")
+
+    def __init__(self):
+        self.children = {}
+        self.msgs = 0
+        self.bytes = 0
+        self.recent = 0
+
+
+class TopicTrie():
+    """
+    Counts messages and bytes for every topic prefix, up to "depth" levels.
+
+    Each level of a topic is a node, and a message is counted on every node
+    along its path, so a prefix's counts always include everything beneath
+    it.  Adding a message is O(depth).  Empty levels are levels like any
+    other, so "/a/b" is counted under the prefixes "" and "/a".
+
+    Memory is bounded by max_nodes.  When the trie is full, new prefixes are
+    only counted in their nearest existing ancestor, and (at most once every
+    prune_interval seconds) the coldest branches are evicted to make room.
+    "Cold" is the fewest recent messages, where the recent count of every
+    node is halved on each prune.
+
+        trie = TopicTrie(depth=2)
+        trie.add("sensors/kitchen/temp", 5)
+        trie.get("sensors/kitchen")    # (1, 5)
+    """
+    def __init__(self, depth=3, max_nodes=10000, prune_interval=1.0):
+        self.depth = depth
+        self.max_nodes = max_nodes
+        self.prune_interval = prune_interval
+        self.root = _Node()
+        self.node_count = 0
+        self.evicted = 0
+        self._last_prune = 0
+
+    def add(self, topic, size):
+        node = self.root
+        node.msgs += 1
+        node.bytes += size
+        node.recent += 1
+        for level in topic.split("/", self.depth)[:self.depth]:
+            child = node.children.get(level, None)
+            if child is None:
+                if self.node_count >= self.max_nodes:
+                    self._maybe_prune()
+                    break
+                child = node.children[level] = _Node()
+                self.node_count += 1
+            child.msgs += 1
+            child.bytes += size
+            child.recent += 1
+            node = child
+
+    def _maybe_prune(self):
+        now = time.time()
+        if now - self._last_prune >= self.prune_interval:
+            self._last_prune = now
+            self.prune()
+
+    def prune(self, target=None):
+        """
+        Evict the coldest leaf branches until at most target nodes remain,
+        (default 90% of max_nodes) then decay all the recent counts.
+        """
+        if target is None:
+            target = int(self.max_nodes * 0.9)
+        while self.node_count > target:
+            leaves = []
+            self._collect_leaves(self.root, leaves)
+            leaves.sort(key=lambda x: x[0].recent)
+            for node, parent, level in leaves[:self.node_count - target]:
+                del parent.children[level]
+                self.node_count -= 1
+                self.evicted += 1
+        self._decay_recent(self.root)
+
+    def _collect_leaves(self, node, leaves):
+        for level, child in list(node.children.items()):
+            if child.children:
+                self._collect_leaves(child, leaves)
+            else:
+                leaves.append((child, node, level))
+
+    def _decay_recent(self, node):
+        node.recent //= 2
+        for child in list(node.children.values()):
+            self._decay_recent(child)
+
+    def _find(self, prefix):
+        node = self.root
+        for level in prefix.split("/"):
+            node = node.children.get(level, None)
+            if node is None:
+                return None
+        return node
+
+    def get(self, prefix):
+        """(msgs, bytes) for a prefix, or None if it isn't being tracked"""
+        node = self._find(prefix)
+        if node is None:
+            return None
+        return node.msgs, node.bytes
+
+    def items(self):
+        """
+        All tracked prefixes, as a list of (prefix, msgs, bytes)
+        Safe to call while another thread is adding messages.
+        """
+        rval = []
+        stack = [(None, self.root)]
+        while stack:
+            prefix, node = stack.pop()
+            if prefix is not None:
+                rval.append((prefix, node.msgs, node.bytes))
+            for level, child in list(node.children.items()):
+                if prefix is None:
+                    stack.append((level, child))
+                else:
+                    stack.append((prefix + "/" + level, child))
+        return rval
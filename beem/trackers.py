@@ -32,16 +32,16 @@ class SentMessage():
     Allows recording statistics of a published message.
     Used internally to generate statistics for the run.
     """
-    def __init__(self, mid, real_size):
+    def __init__(self, mid, real_size, time_created=None):
         self.mid = mid
         self.size = real_size
         self.received = False
-        self.time_created = time.time()
+        self.time_created = time_created or time.time()
         self.time_received = None
 
-    def receive(self):
+    def receive(self, time_received=None):
         self.received = True
-        self.time_received = time.time()
+        self.time_received = time_received or time.time()
 
     def time_flight(self):
         return self.time_received - self.time_created
@@ -69,8 +69,9 @@ class ObservedMessage():
         segments = msg.topic.split("/")
         self.cid = segments[1]
         self.mid = int(segments[3])
-        payload_segs = msg.payload.split(",")
-        self.time_created = time.mktime(time.localtime(float(payload_segs[0])))
+        payload = msg.payload
+        payload_segs = payload.split(b"," if isinstance(payload, bytes) else ",")
+        self.time_created = float(payload_segs[0])
         self.time_received = time.time()
 
     def time_flight(self):
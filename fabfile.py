@@ -253,6 +253,36 @@ def attack(target, warhead=None):
             fab.run(cmd % fab.env)
 
 
+@fab.task
+@fab.parallel
+def scenario(target, scenario_file):
+    """
+    Run a scenario file against "target" with all nodes from "up"
+
+    "scenario_file" is copied to each node and run with "malaria scenario".
+    See examples in the scenarios directory.
+    """
+    fab.env.malaria_home = fab.run("cat /tmp/malaria-tmp-homedir")
+    remote = "%s/%s" % (fab.env.malaria_home, os.path.basename(scenario_file))
+    fab.put(scenario_file, remote)
+    with fabt.python.virtualenv("%(malaria_home)s/venv" % fab.env):
+        fab.run("malaria scenario -H %s %s" % (target, remote))
+
+
+@fab.task
+@fab.parallel
+def agent(coordinator):
+    """
+    Run a "malaria agent" on all nodes from "up", joining "coordinator"
+
+    "coordinator" is the HOST:PORT of a "malaria coordinator" you have
+    already started, which decides what the agents publish, and when.
+    """
+    fab.env.malaria_home = fab.run("cat /tmp/malaria-tmp-homedir")
+    with fabt.python.virtualenv("%(malaria_home)s/venv" % fab.env):
+        fab.run("malaria agent -N %s %s" % (fab.env.host, coordinator))
+
+
 @fab.task
 @fab.parallel
 def abort():
@@ -22,9 +22,13 @@ setup(
     include_package_data=True,
     zip_safe=False,
     install_requires=[
-        'paho-mqtt>=1.1',
-        'fusepy'
+        'paho-mqtt>=1.1'
     ],
+    extras_require={
+        'analysis': ['numpy'],
+        'statsfs': ['fusepy'],
+        'scenarios': ['pyyaml']
+    },
     tests_require=[
         'fabric',
         'fabtools',